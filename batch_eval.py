@@ -0,0 +1,55 @@
+"""
+Vectorized evaluation of many 5 card hands at once. Requires numpy.
+
+Hands are rows of card codes (game_logic.Card.code, suit * 13 + rank - 2) and
+the results are the same integer strengths evaluator.evaluate returns, so they
+order exactly like Hand.compare.
+"""
+import itertools
+import numpy as np
+import evaluator
+
+# unsuited strengths keyed by the sorted ranks read as a base 13 number
+RANK_KEY_WEIGHTS = np.array([13 ** i for i in range(5)], dtype=np.int64)
+
+
+def _build_tables():
+    unsuited = np.zeros(13 ** 5, dtype=np.int64)
+    for ranks in itertools.combinations_with_replacement(range(13), 5):
+        if max(ranks.count(rank) for rank in ranks) > 4:
+            continue
+        product = 1
+        for rank in ranks:
+            product *= evaluator.PRIMES[rank + 2]
+        unsuited[int(np.dot(ranks, RANK_KEY_WEIGHTS))] = evaluator.UNSUITED[product]
+    flushes = np.zeros(1 << 13, dtype=np.int64)
+    for rank_bits in range(1 << 13):
+        if bin(rank_bits).count('1') == 5:
+            flushes[rank_bits] = evaluator.FLUSHES[rank_bits << 2]
+    return unsuited, flushes
+
+
+UNSUITED_TABLE, FLUSH_TABLE = _build_tables()
+
+
+def evaluate_batch(codes):
+    """
+    takes an (N, 5) array of card codes, returns an N-length int64 array of strengths
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    ranks = codes % 13
+    suits = codes // 13
+    is_flush = (suits == suits[:, :1]).all(axis=1)
+
+    strengths = UNSUITED_TABLE[np.sort(ranks, axis=1) @ RANK_KEY_WEIGHTS]
+    if is_flush.any():
+        rank_bits = np.bitwise_or.reduce(1 << ranks[is_flush], axis=1)
+        strengths[is_flush] = FLUSH_TABLE[rank_bits]
+    return strengths
+
+
+def codes_of(hands):
+    """
+    turns a sequence of 5 card hands (lists of Card) into an (N, 5) code array
+    """
+    return np.array([[card.code for card in cards] for cards in hands], dtype=np.int64).reshape(-1, 5)
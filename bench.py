@@ -0,0 +1,1107 @@
+"""
+Benchmarks for the game logic and server.
+
+usage: python bench.py <name> [options]
+"""
+import argparse
+import itertools
+import random
+import time
+import evaluator
+import game_logic
+import solver
+import utils
+from utils import HAND_STRENGTHS
+
+
+class LegacyHand:
+    """
+    The original Hand.eval / get_*_card / compare chain, kept as the
+    reference the table evaluator is checked and timed against.
+    """
+
+    def __init__(self, cards):
+        self.cards = cards
+        self.hand = None
+
+    def eval(self):
+        ranks = sorted([card.rank for card in self.cards])
+        suits = [card.suit for card in self.cards]
+        diffs = [ranks[i+1] - ranks[i] for i in range(len(ranks) - 1)]
+        self.value_counts = {number: ranks.count(number) for number in set(ranks)}
+        self.suit_counts = {number: suits.count(number) for number in set(suits)}
+
+        if len(self.suit_counts.keys()) == 1:
+            if diffs == [1,1,1,1] or diffs == [1,1,1,9]:
+                self.hand = "STRAIGHT_FLUSH"
+            else:
+                self.hand = "FLUSH"
+        elif len(self.value_counts.keys()) == 2 and max(self.value_counts.values()) == 4:
+            self.hand = "QUADS"
+        elif len(self.value_counts.keys()) == 2 and max(self.value_counts.values()) == 3:
+            self.hand = "FULL_HOUSE"
+        elif diffs == [1,1,1,1] or diffs == [1,1,1,9]:
+            self.hand = "STRAIGHT"
+        elif len(self.value_counts.keys()) == 3 and max(self.value_counts.values()) == 3:
+            self.hand = "SET"
+        elif len(self.value_counts.keys()) == 3 and max(self.value_counts.values()) == 2:
+            self.hand = "TWO_PAIR"
+        elif len(self.value_counts.keys()) == 4:
+            self.hand = "ONE_PAIR"
+        else:
+            self.hand = "HIGH_CARD"
+        return self.hand
+
+    def eval_int(self):
+        if self.hand is None:
+            self.eval()
+        self.hand_int = HAND_STRENGTHS.index(self.hand)
+        return self.hand_int
+
+    def get_primary_card(self):
+        if self.hand is None:
+            self.eval()
+        if self.hand in {'STRAIGHT_FLUSH', 'FLUSH', 'STRAIGHT', 'HIGH_CARD'}:
+            self.primary_card = max(self.value_counts.keys())
+            if self.hand in {'STRAIGHT_FLUSH', 'STRAIGHT'} and self.primary_card == 14:
+                self.primary_card = 5 if 13 not in self.value_counts.keys() else 14
+        elif self.hand == 'TWO_PAIR':
+            self.primary_card = max([card for card in self.value_counts.keys() if self.value_counts[card] == 2])
+        else:
+            self.primary_card = max(self.value_counts, key=self.value_counts.get)
+        return self.primary_card
+
+    def get_secondary_card(self):
+        if self.hand == 'TWO_PAIR':
+            self.secondary_card = max([card for card in self.value_counts.keys() if self.value_counts[card] == 2 and card != self.primary_card])
+        elif self.hand in {'ONE_PAIR', 'HIGH_CARD'}:
+            self.secondary_card = max([card for card in self.value_counts.keys() if card != self.primary_card])
+        else:
+            raise Exception("Shouldn't be calling secondary card on anything besides TWO_PAIR, PAIR_HIGH_CARD")
+        return self.secondary_card
+
+    def get_tertiary_card(self):
+        self.tertiary_card = max([card for card in self.value_counts.keys() if card not in {self.primary_card, self.secondary_card}])
+        return self.tertiary_card
+
+    def get_quatenary_card(self):
+        self.quatenary_card = max([card for card in self.value_counts.keys() if card not in {self.primary_card, self.secondary_card, self.tertiary_card}])
+        return self.quatenary_card
+
+    def get_senary_card(self):
+        self.senary_card = max([card for card in self.value_counts.keys() if card not in {self.primary_card, self.secondary_card, self.tertiary_card, self.quatenary_card}])
+        return self.senary_card
+
+    def compare(self, other):
+        for func1, func2 in zip([self.eval_int, self.get_primary_card, self.get_secondary_card, self.get_tertiary_card, self.get_quatenary_card, self.get_senary_card],
+                                [other.eval_int, other.get_primary_card, other.get_secondary_card, other.get_tertiary_card, other.get_quatenary_card, other.get_senary_card]):
+            val1 = func1()
+            val2 = func2()
+            if val1 > val2:
+                return 1
+            elif val1 < val2:
+                return -1
+        return 0
+
+
+class LegacyCard:
+    def __init__(self, rank, suit):
+        self.rank = rank
+        self.suit = suit
+
+    def __repr__(self):
+        return utils.rank2str(self.rank) + self.suit
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+class LegacyDeck:
+    """
+    The original list-backed Deck: 52 new cards per deck, pop(0) draws.
+    """
+
+    def __init__(self):
+        self.cards = []
+        for rank in utils.ALL_RANKS:
+            for suit in utils.ALL_SUITS:
+                self.cards.append(LegacyCard(rank, suit))
+        random.shuffle(self.cards)
+
+    def draw(self):
+        if len(self.cards) > 0:
+            return self.cards.pop(0)
+        return None
+
+
+def all_cards():
+    return [game_logic.Card(rank, suit) for rank in utils.ALL_RANKS for suit in utils.ALL_SUITS]
+
+
+def legacy_compare(cards1, cards2):
+    """
+    returns the legacy verdict, or None where the legacy chain runs out of
+    tie-breakers and raises (e.g. two flushes with the same high card)
+    """
+    try:
+        return LegacyHand(cards1).compare(LegacyHand(cards2))
+    except Exception:
+        return None
+
+
+def bench_eval(args):
+    hands = list(itertools.combinations(all_cards(), 5))
+    if args.limit:
+        hands = hands[:args.limit]
+    print(f'{len(hands)} hands')
+
+    start = time.perf_counter()
+    for cards in hands:
+        LegacyHand(cards).eval_int()
+    elapsed = time.perf_counter() - start
+    print(f'legacy eval_int:     {elapsed:.2f}s ({len(hands) / elapsed:,.0f} hands/s)')
+
+    start = time.perf_counter()
+    strengths = [game_logic.Hand(cards).strength() for cards in hands]
+    elapsed = time.perf_counter() - start
+    print(f'table strength:      {elapsed:.2f}s ({len(hands) / elapsed:,.0f} hands/s)')
+
+    start = time.perf_counter()
+    for i in range(1, len(hands)):
+        legacy_compare(hands[i - 1], hands[i])
+    elapsed = time.perf_counter() - start
+    print(f'legacy compare:      {elapsed:.2f}s ({len(hands) / elapsed:,.0f} compares/s)')
+
+    start = time.perf_counter()
+    for i in range(1, len(hands)):
+        game_logic.Hand(hands[i - 1]).compare(game_logic.Hand(hands[i]))
+    elapsed = time.perf_counter() - start
+    print(f'table compare:       {elapsed:.2f}s ({len(hands) / elapsed:,.0f} compares/s)')
+
+    if args.no_check:
+        return
+    # Sorting by strength and checking neighbours is enough: the legacy
+    # verdict is a lexicographic key, so agreement between every adjacent
+    # pair extends to every pair by transitivity.
+    order = sorted(range(len(hands)), key=strengths.__getitem__)
+    mismatches = 0
+    undefined = 0
+    for prev, cur in zip(order, order[1:]):
+        expected = 0 if strengths[prev] == strengths[cur] else -1
+        verdict = legacy_compare(hands[prev], hands[cur])
+        if verdict is None:
+            # exact ties run the legacy chain out of kickers as well
+            undefined += expected != 0
+        elif verdict != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print('MISMATCH', hands[prev], hands[cur], verdict, expected)
+    print(f'ordering check: {mismatches} mismatches, {undefined} distinct neighbour pairs the legacy compare cannot decide')
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def random_pile_and_pool(rng, pile_size, pool_size):
+    codes = rng.sample(range(52), pile_size + pool_size)
+    pile_mask = sum(1 << code for code in codes[:pile_size])
+    pool_mask = sum(1 << code for code in codes[pile_size:])
+    return pile_mask, pool_mask
+
+
+def brute_force_completion(pile_mask, pool_mask):
+    pile_size = pile_mask.bit_count()
+    pool = [card.bit for card in game_logic.mask_to_cards(pool_mask)]
+    return max((evaluator.evaluate_mask(pile_mask | sum(extra))
+                for extra in itertools.combinations(pool, 5 - pile_size)), default=-1)
+
+
+def bench_solve(args):
+    rng = random.Random(args.seed)
+    cases = args.limit or 500
+    for pile_size in range(5):
+        timings = []
+        for _ in range(cases):
+            pile_mask, pool_mask = random_pile_and_pool(rng, pile_size, 40)
+            start = time.perf_counter()
+            solver.best_completion(pile_mask, pool_mask)
+            timings.append(time.perf_counter() - start)
+        print(f'pile of {pile_size} vs 40 card pool: mean {sum(timings) / cases * 1e6:.0f}us '
+              f'p99 {percentile(timings, 99) * 1e6:.0f}us max {max(timings) * 1e6:.0f}us')
+
+    if args.no_check:
+        return
+    mismatches = 0
+    for _ in range(cases):
+        pile_size = rng.randrange(5)
+        pile_mask, pool_mask = random_pile_and_pool(rng, pile_size, rng.randrange(5 - pile_size, 16))
+        strength, hand_mask = solver.best_completion(pile_mask, pool_mask)
+        if strength != brute_force_completion(pile_mask, pool_mask) or \
+                evaluator.evaluate_mask(hand_mask) != strength or hand_mask & pile_mask != pile_mask:
+            mismatches += 1
+    print(f'brute force check: {mismatches} mismatches in {cases} cases')
+
+
+def bench_deck(args):
+    decks = args.limit or 100000
+    rng = random.Random(args.seed)
+    for name, make_deck in [('legacy Deck', LegacyDeck),
+                            ('seeded Deck', lambda: game_logic.Deck(rng=rng))]:
+        start = time.perf_counter()
+        for _ in range(decks):
+            deck = make_deck()
+            # up card plus two 5 card hands, as GameState deals
+            for _ in range(11):
+                deck.draw()
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {decks / elapsed:,.0f} decks/s (built and dealt)')
+
+    if args.no_check:
+        return
+    same = [game_logic.Deck(seed=seed).order == game_logic.Deck(seed=seed).order for seed in range(100)]
+    print(f'seeded decks reproducible: {all(same)}')
+
+
+def bench_batch(args):
+    import numpy as np
+    import batch_eval
+
+    combos = itertools.combinations(range(52), 5)
+    if args.limit:
+        combos = itertools.islice(combos, args.limit)
+    codes = np.fromiter(itertools.chain.from_iterable(combos), dtype=np.int64).reshape(-1, 5)
+    print(f'{len(codes)} hands')
+
+    start = time.perf_counter()
+    strengths = batch_eval.evaluate_batch(codes)
+    elapsed = time.perf_counter() - start
+    print(f'batch evaluate_batch: {elapsed:.2f}s ({len(codes) / elapsed:,.0f} hands/s)')
+
+    batch = codes[:10000]
+    start = time.perf_counter()
+    for _ in range(100):
+        batch_eval.evaluate_batch(batch)
+    elapsed = time.perf_counter() - start
+    print(f'batches of 10000:     {100 * len(batch) / elapsed:,.0f} hands/s')
+
+    if args.no_check:
+        return
+    # matching strengths means matching Hand.compare order (see bench eval)
+    cards = game_logic.CARDS
+    mismatches = sum(1 for row, strength in zip(codes.tolist(), strengths.tolist())
+                     if game_logic.Hand([cards[code] for code in row]).strength() != strength)
+    print(f'check against Hand.strength: {mismatches} mismatches')
+
+
+def random_midgame_states(count, seed, moves=None):
+    """
+    returns GameStates advanced by random legal moves, as bots would see them
+    """
+    rng = random.Random(seed)
+    states = []
+    while len(states) < count:
+        state = game_logic.GameState(rng=rng)
+        for _ in range(rng.randrange(40) if moves is None else moves):
+            legal = state.legal_moves()
+            if not legal:
+                break
+            card, pile_idx, take_upcard = rng.choice(legal)
+            state.player_act(card, pile_idx, take_upcard, state.is_p1_turn)
+        states.append(state)
+    return states
+
+
+def bench_equity(args):
+    import equity
+
+    states = random_midgame_states(args.limit or 200, args.seed)
+    for name, call in [('pile_equity', lambda state, seed: equity.pile_equity(state, seed % 5, seed=seed)),
+                       ('game_equity', lambda state, seed: equity.game_equity(state, seed=seed)),
+                       ('game_equity 15ms budget', lambda state, seed: equity.game_equity(state, samples=100000, time_budget=0.015, seed=seed))]:
+        timings = []
+        exact = 0
+        for seed, state in enumerate(states):
+            start = time.perf_counter()
+            result = call(state, seed)
+            timings.append(time.perf_counter() - start)
+            exact += result['exact']
+        print(f'{name}: p50 {percentile(timings, 50) * 1e3:.1f}ms p99 {percentile(timings, 99) * 1e3:.1f}ms '
+              f'max {max(timings) * 1e3:.1f}ms ({exact}/{len(states)} exact)')
+
+
+def bench_cache(args):
+    import simulate
+
+    games = args.limit or 300
+    for cache_entries in [0, 100000]:
+        start = time.perf_counter()
+        stats = simulate.run_games(args.seed, range(games), 'random', 'random', cache_entries)
+        elapsed = time.perf_counter() - start
+        print(f'cache entries {cache_entries}: {stats["moves"] / elapsed:,.0f} moves/s over {games} games')
+
+    cache = solver.CompletionCache(100000)
+    rng = random.Random(args.seed)
+    mismatches = 0
+    for _ in range(games * 10):
+        pile_mask, pool_mask = random_pile_and_pool(rng, rng.randrange(5), rng.randrange(1, 20))
+        expected, _ = solver.best_completion(pile_mask, pool_mask)
+        strength, hand_mask = cache.best_completion(pile_mask, pool_mask)
+        if strength != expected or (strength >= 0 and (evaluator.evaluate_mask(hand_mask) != strength
+                                                       or hand_mask & ~(pile_mask | pool_mask))):
+            mismatches += 1
+    print(f'cached vs uncached: {mismatches} mismatches, {cache.stats()}')
+
+
+class FakeSocket:
+    """
+    In-process stand-in for a server side websocket. Requests are fed through
+    inbox; whatever the server sends lands in outbox, each send taking
+    send_delay seconds to imitate a slow client.
+    """
+
+    def __init__(self, send_delay=0.0):
+        import asyncio
+        self.inbox = asyncio.Queue()
+        self.outbox = asyncio.Queue()
+        self.send_delay = send_delay
+
+    async def recv(self):
+        import websockets.exceptions
+        message = await self.inbox.get()
+        if message is None:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        return message
+
+    async def send(self, message):
+        import asyncio
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.outbox.put_nowait(message)
+
+    async def close(self):
+        self.inbox.put_nowait(None)
+
+    async def request(self, message):
+        """
+        sends a request and waits for its ack; returns (ack, seconds)
+        """
+        import json
+        start = time.perf_counter()
+        self.inbox.put_nowait(message if isinstance(message, (str, bytes)) else json.dumps(message))
+        while True:
+            reply = json.loads(await self.outbox.get())
+            if reply['type'].startswith('ack') or reply['type'].startswith('err'):
+                return reply, time.perf_counter() - start
+
+
+async def play_fake_pair(server, sock1, sock2, rng, latencies1, latencies2):
+    """
+    plays one game between two FakeSockets, picking moves straight from the
+    server's GameState; records each player's action round trips
+    """
+    ack, _ = await sock1.request({'type': 'connect'})
+    player1 = ack['player_id']
+    ack, _ = await sock2.request({'type': 'connect'})
+    player2 = ack['player_id']
+    ack, _ = await sock1.request({'type': 'new_game', 'body': {'player_id': player1}})
+    game_id = ack['game_id']
+    await sock2.request({'type': 'join_game', 'body': {'player_id': player2, 'game_id': game_id}})
+    while True:
+        # re-read every turn: a process pool hands back a new GameState per move
+        state = server.games[game_id].game_state
+        if state.over or not state.legal_moves():
+            break
+        card, pile_idx, take_upcard = rng.choice(state.legal_moves())
+        sock, player_id, latencies = (sock1, player1, latencies1) if state.is_p1_turn else (sock2, player2, latencies2)
+        ack, elapsed = await sock.request({'type': 'action', 'body': {
+            'player_id': player_id, 'game_id': game_id, 'card': repr(card), 'pile': pile_idx, 'take_upcard': take_upcard}})
+        latencies.append(elapsed)
+    await sock1.close()
+    await sock2.close()
+
+
+def bench_slow_clients(args):
+    import asyncio
+    import server_main
+
+    async def scenario(fast_pairs, slow_pairs, slow_delay):
+        rng = random.Random(args.seed)
+        fast = []
+        facing_slow = []
+        tasks = []
+        for i in range(fast_pairs + slow_pairs):
+            sock1 = FakeSocket()
+            sock2 = FakeSocket(slow_delay if i >= fast_pairs else 0.0)
+            tasks.append(asyncio.ensure_future(server_main.handler(sock1)))
+            tasks.append(asyncio.ensure_future(server_main.handler(sock2)))
+            tasks.append(asyncio.ensure_future(play_fake_pair(
+                server_main, sock1, sock2, rng, fast if i < fast_pairs else facing_slow, fast if i < fast_pairs else [])))
+        await asyncio.gather(*tasks)
+        return fast, facing_slow
+
+    pairs = args.limit or 50
+    baseline, _ = asyncio.run(scenario(pairs, 0, 0.0))
+    loaded, facing_slow = asyncio.run(scenario(pairs, pairs // 2, 0.05))
+    for name, latencies in [('fast clients, no slow clients', baseline),
+                            (f'fast clients, {pairs // 2} slow pairs', loaded),
+                            ('fast clients facing a slow opponent', facing_slow)]:
+        print(f'{name}: p50 {percentile(latencies, 50) * 1e3:.2f}ms p99 {percentile(latencies, 99) * 1e3:.2f}ms '
+              f'({len(latencies)} actions)')
+
+
+async def play_fake_games(server, pairs, seed):
+    """
+    plays pairs games at once through server.handler; returns (moves, seconds)
+    """
+    import asyncio
+
+    rng = random.Random(seed)
+    latencies = []
+    tasks = []
+    for _ in range(pairs):
+        sock1 = FakeSocket()
+        sock2 = FakeSocket()
+        tasks += [asyncio.ensure_future(server.handler(sock1)),
+                  asyncio.ensure_future(server.handler(sock2)),
+                  asyncio.ensure_future(play_fake_pair(server, sock1, sock2, rng, latencies, latencies))]
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    return len(latencies), time.perf_counter() - start
+
+
+def bench_move_workers(args):
+    import asyncio
+    import os
+    import server_main
+
+    pairs = args.limit or 40
+    print(f'{os.cpu_count()} cores, {pairs} concurrent games')
+    for kind, workers in [(None, 0), ('thread', 1), ('thread', 4), ('process', 1), ('process', 2), ('process', 4)]:
+        server_main.configure_move_executor(kind, workers)
+        moves, elapsed = asyncio.run(play_fake_games(server_main, pairs, args.seed))
+        print(f'{kind or "inline"} x{workers}: {moves / elapsed:,.0f} moves/s')
+    server_main.configure_move_executor(None)
+
+
+def bench_move_scaling(args):
+    """
+    aggregate moves/s against the number of worker processes, from one up to
+    every core, with the games in play growing along with the workers
+    """
+    import asyncio
+    import os
+    import server_main
+
+    cores = os.cpu_count() or 1
+    per_worker = args.limit or 20
+    counts = sorted({1, cores} | {n for n in (2, 4, 8, 16, 32, 64) if n < cores})
+    print(f'{cores} cores, {per_worker} concurrent games per worker')
+    server_main.configure_move_executor(None)
+    moves, elapsed = asyncio.run(play_fake_games(server_main, per_worker * cores, args.seed))
+    inline = moves / elapsed
+    print(f'inline, {per_worker * cores} games: {inline:,.0f} moves/s')
+    for workers in counts:
+        server_main.configure_move_executor('process', workers)
+        moves, elapsed = asyncio.run(play_fake_games(server_main, per_worker * workers, args.seed))
+        print(f'process x{workers}, {per_worker * workers} games: {moves / elapsed:,.0f} moves/s '
+              f'({moves / elapsed / inline:.2f}x inline)')
+    server_main.configure_move_executor(None)
+
+
+def bench_shards(args):
+    import asyncio
+    import os
+    import loadgen
+
+    games = args.limit or 200
+    port = 8700
+    print(f'{os.cpu_count()} cores, {games} games, 50 at a time')
+    for shards in [1, 2, 4]:
+        summary = asyncio.run(loadgen.run_local(port, shards, games, 50, args.seed))
+        latency = summary['action_latency_ms']
+        print(f"{shards} shard(s): {summary['games_per_sec']:,.1f} games/s, {summary['moves_per_sec']:,.0f} moves/s, "
+              f"action p50 {latency['p50']:.1f}ms p99 {latency['p99']:.1f}ms, {summary['failed_games']} failed")
+        port += 10
+
+
+def bench_protocol(args):
+    import json
+    import protocol
+
+    # the messages one move puts on the wire: the request, its ack and both players' updates
+    rng = random.Random(args.seed)
+    moves = []
+    states = []
+    while len(moves) < (args.limit or 5000):
+        state = game_logic.GameState(rng=rng)
+        while state.legal_moves() and len(moves) < (args.limit or 5000):
+            card, pile_idx, take_upcard = rng.choice(state.legal_moves())
+            state.player_act(card, pile_idx, take_upcard, state.is_p1_turn)
+            moves.append([
+                {'type': 'action', 'body': {'player_id': 10000, 'game_id': 10000, 'card': repr(card),
+                                            'pile': pile_idx, 'take_upcard': take_upcard}},
+                {'type': 'ack_action', 'player_id': 10000, 'game_id': 10000},
+                {'type': 'send_game_update', 'update': state.get_last_update_p1()},
+                {'type': 'send_game_update', 'update': state.get_last_update_p2()},
+            ])
+        states.append({'type': 'send_game_state', 'game_state': state.p1_json()})
+
+    for name, encode, decode in [('json', json.dumps, json.loads), ('binary', protocol.encode, protocol.decode)]:
+        frames = [[encode(message) for message in move] for move in moves]
+        if not args.no_check:
+            assert all(decode(frame) == json.loads(json.dumps(message))
+                       for move, move_frames in zip(moves, frames) for message, frame in zip(move, move_frames))
+        start = time.perf_counter()
+        for move in moves:
+            for message in move:
+                encode(message)
+        encode_us = (time.perf_counter() - start) / len(moves) * 1e6
+        start = time.perf_counter()
+        for move_frames in frames:
+            for frame in move_frames:
+                decode(frame)
+        decode_us = (time.perf_counter() - start) / len(moves) * 1e6
+        sizes = [sum(len(frame) for frame in move_frames) for move_frames in frames]
+        update_sizes = [len(move_frames[2]) for move_frames in frames]
+        state_sizes = [len(encode(state)) for state in states]
+        print(f'{name}: {sum(sizes) / len(sizes):.0f} bytes/move (update {sum(update_sizes) / len(update_sizes):.0f}, '
+              f'full state {sum(state_sizes) / len(state_sizes):.0f}), '
+              f'encode {encode_us:.1f}us/move, decode {decode_us:.1f}us/move')
+
+
+def bench_replay(args):
+    import io
+    import movelog
+    import simulate
+
+    moves = args.limit or 1000000
+    # record random self-play games until there are enough logged moves
+    records = io.BytesIO()
+    logged = 0
+    games = 0
+    while logged < moves:
+        state, log, _ = simulate.play_game(args.seed, games, simulate.random_policy, simulate.random_policy)
+        movelog.write_record(records, games, log, [pile.verdict for pile in state.piles], state.winner)
+        logged += len(log)
+        games += 1
+    data = records.getvalue()
+    print(f'{games} games, {logged} moves, {len(data) / 1e6:.1f}MB of log')
+
+    start = time.perf_counter()
+    parsed = list(movelog.read_records(io.BytesIO(data)))
+    print(f'parse: {logged / (time.perf_counter() - start):,.0f} moves/s')
+    for full in (False, True):
+        mismatches = 0
+        start = time.perf_counter()
+        for _, log, verdicts, winner in parsed:
+            state = log.replay(full=full)
+            if not args.no_check and ([pile.verdict for pile in state.piles] != verdicts or state.winner != winner):
+                mismatches += 1
+        elapsed = time.perf_counter() - start
+        print(f'replay {"judging every move" if full else "judging once per game"}: '
+              f'{logged / elapsed:,.0f} moves/s ({elapsed:.1f}s), {mismatches} mismatches')
+
+
+def bench_snapshot(args):
+    import asyncio
+    import os
+    import tempfile
+    import movelog
+    import server_main
+
+    count = args.limit or 100000
+    # 1000 distinct games part way through, each shared by count / 1000 live games
+    rng = random.Random(args.seed)
+    samples = []
+    while len(samples) < 1000:
+        log = movelog.MoveLog(rng.getrandbits(64))
+        state = game_logic.GameState(seed=log.seed)
+        for _ in range(rng.randrange(45)):
+            if not state.legal_moves():
+                break
+            move = rng.choice(state.legal_moves())
+            state.player_act(*move, state.is_p1_turn)
+            log.append(*move)
+        samples.append((state, log))
+    for i in range(count):
+        game = server_main.Game(2 * i)
+        game.p2 = 2 * i + 1
+        game.state = 'connected'
+        game.game_state, game.log = samples[i % len(samples)]
+        server_main.games[10000 + i] = game
+        server_main.player_tokens[2 * i] = server_main.player_tokens[2 * i + 1] = os.urandom(8).hex()
+
+    async def timed_flush():
+        # a ticker shows how long the flush keeps the event loop from other work
+        gaps = []
+        done = False
+
+        async def ticker():
+            while not done:
+                start = time.perf_counter()
+                await asyncio.sleep(0)
+                gaps.append(time.perf_counter() - start)
+
+        tick = asyncio.ensure_future(ticker())
+        start = time.perf_counter()
+        written = await server_main.snapshot_now()
+        elapsed = time.perf_counter() - start
+        done = True
+        await tick
+        return written, elapsed, max(gaps)
+
+    path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+    server_main.configure_snapshots(path)
+    for game_id in server_main.games:
+        server_main.snapshot_store.mark(game_id)
+    written, elapsed, gap = asyncio.run(timed_flush())
+    print(f'full snapshot of {written} games: {elapsed:.2f}s, {os.path.getsize(path) / 1e6:.1f}MB, '
+          f'longest event loop stall {gap * 1e3:.1f}ms')
+    for game_id in rng.sample(list(server_main.games), count // 100):
+        server_main.snapshot_store.mark(game_id)
+    written, elapsed, gap = asyncio.run(timed_flush())
+    print(f'incremental snapshot of {written} dirty games: {elapsed * 1e3:.1f}ms, longest stall {gap * 1e3:.1f}ms')
+    server_main.snapshot_store.close()
+
+    server_main.games.clear()
+    server_main.player_tokens.clear()
+    start = time.perf_counter()
+    restored = server_main.configure_snapshots(path)
+    elapsed = time.perf_counter() - start
+    print(f'restore of {restored} games: {elapsed:.2f}s')
+    if not args.no_check:
+        mismatches = sum(1 for i in range(count)
+                         if server_main.games[10000 + i].game_state.pack() != samples[i % len(samples)][0].pack())
+        print(f'check against the saved states: {mismatches} mismatches')
+    server_main.snapshot_store.close()
+    os.remove(path)
+
+
+def rss_mb():
+    import os
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+
+def bench_soak(args):
+    import asyncio
+    import server_main
+
+    async def soak(games, sweep, rounds=10, pairs=50):
+        # games finish and players leave in waves, with the sweeper keeping
+        # nothing around; RSS should level off once the heap warms up
+        rng = random.Random(args.seed)
+        server_main.FINISHED_RETENTION = server_main.PLAYER_TIMEOUT = 0.0
+        rss = []
+
+        async def pair():
+            sock1 = FakeSocket()
+            sock2 = FakeSocket()
+            await asyncio.gather(server_main.handler(sock1), server_main.handler(sock2),
+                                 play_fake_pair(server_main, sock1, sock2, rng, [], []))
+
+        for _ in range(rounds):
+            for _ in range(games // rounds // pairs):
+                await asyncio.gather(*[pair() for _ in range(pairs)])
+                if sweep:
+                    await server_main.sweep()
+            rss.append(rss_mb())
+        return rss
+
+    games = args.limit or 10000
+    server_main.configure_move_executor(None)
+    for sweep in (True, False):
+        for table in (server_main.games, server_main.players, server_main.player_tokens, server_main.player_games,
+                      server_main.disconnected_at):
+            table.clear()
+        server_main.removed_counts.update(games=0, players=0)
+        start = time.perf_counter()
+        rss = asyncio.run(soak(games, sweep))
+        elapsed = time.perf_counter() - start
+        print(f'{games} games {"with" if sweep else "without"} sweeping ({games / elapsed:,.0f} games/s): '
+              f'RSS by tenth {" ".join(f"{mb:.0f}" for mb in rss)} MB')
+        print(f'  {server_main.lifecycle_stats()}')
+
+
+def bench_matchmaking(args):
+    import asyncio
+    import json
+    import server_main
+
+    async def wait_for_start(sock, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                reply = json.loads(await asyncio.wait_for(sock.outbox.get(), deadline - loop.time()))
+            except asyncio.TimeoutError:
+                return False
+            if reply['type'] == 'game_start':
+                return True
+
+    async def client(delay, quit, times, outcomes):
+        # quit is None to wait for a match, else 'cancel' or 'disconnect' after
+        # an impatient wait of up to a second
+        sock = FakeSocket()
+        handler = asyncio.ensure_future(server_main.handler(sock))
+        await asyncio.sleep(delay)
+        ack, _ = await sock.request({'type': 'connect'})
+        start = time.perf_counter()
+        sock.inbox.put_nowait(json.dumps({'type': 'quick_match', 'body': {'player_id': ack['player_id']}}))
+        matched = await wait_for_start(sock, 30.0 if quit is None else random.random())
+        if not matched and quit == 'cancel':
+            ack, _ = await sock.request({'type': 'cancel_match', 'body': {'player_id': ack['player_id']}})
+            # a match that raced the cancel still counts
+            matched = ack['type'] == 'err_cancel_match' and await wait_for_start(sock, 1.0)
+        if matched:
+            times.append(time.perf_counter() - start)
+        outcomes[('matched' if matched else quit or 'timed out')] += 1
+        await sock.close()
+        await handler
+
+    async def scenario(clients, rate, quitters):
+        rng = random.Random(args.seed)
+        times = []
+        outcomes = {'matched': 0, 'cancel': 0, 'disconnect': 0, 'timed out': 0}
+        delay = 0.0
+        tasks = []
+        for _ in range(clients):
+            if rate:
+                delay += rng.expovariate(rate)
+            quit = rng.choice(['cancel', 'disconnect']) if rng.random() < quitters else None
+            tasks.append(client(delay, quit, times, outcomes))
+        start = time.perf_counter()
+        await asyncio.gather(*tasks)
+        return times, outcomes, time.perf_counter() - start
+
+    clients = args.limit or 4000
+    for rate, quitters in [(0, 0.0), (1000, 0.0), (1000, 0.2)]:
+        times, outcomes, elapsed = asyncio.run(scenario(clients, rate, quitters))
+        arrivals = f'arriving at {rate}/s' if rate else 'all at once'
+        print(f'{clients} clients {arrivals}, {quitters:.0%} impatient: {outcomes["matched"] // 2 / elapsed:,.0f} pairings/s, '
+              f'time to match p50 {percentile(times, 50) * 1e3:.1f}ms p90 {percentile(times, 90) * 1e3:.1f}ms '
+              f'p99 {percentile(times, 99) * 1e3:.1f}ms; {outcomes}')
+        print(f'  {server_main.lifecycle_stats()["queued"]} left queued')
+
+    async def server_only(clients):
+        # the same requests straight into the server, minus the client side
+        from connection import Connection
+        requests = []
+        for player_id in range(10 ** 6, 10 ** 6 + clients):
+            client = Connection(FakeSocket(), max_queue=16)
+            server_main.players.add(player_id)
+            server_main.id_to_client[player_id] = client
+            server_main.client_to_id[client] = player_id
+            requests.append((client, json.dumps({'type': 'quick_match', 'body': {'player_id': player_id}})))
+        start = time.perf_counter()
+        for client, request in requests:
+            server_main.handle_after_ack(client, await server_main.handle_client_request(client, request))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(server_only(clients))
+    print(f'server side alone: {clients // 2 / elapsed:,.0f} pairings/s')
+
+
+def bench_spectators(args):
+    import asyncio
+    import server_main
+    from connection import Connection
+
+    # a game part way through supplies the updates
+    rng = random.Random(args.seed)
+    state = game_logic.GameState(seed=args.seed)
+    updates = []
+    while len(updates) < 30 and not state.over and state.legal_moves():
+        state.player_act(*rng.choice(state.legal_moves()), state.is_p1_turn)
+        updates.append({'type': 'send_game_update', 'update': state.get_last_update_public()})
+    game = server_main.Game(1)
+
+    def per_recipient(game, message):
+        # what send_to_game does: one encoding per client
+        for client in game.spectators:
+            client.send(server_main.encode_for(client, message))
+
+    async def fan_out(watchers, send):
+        game.spectators = {Connection(FakeSocket(), max_queue=len(updates)) for _ in range(watchers)}
+        for i, client in enumerate(game.spectators):
+            client.protocol = 'binary' if i % 4 == 0 else 'json'
+        start = time.perf_counter()
+        for message in updates:
+            send(game, message)
+        return (time.perf_counter() - start) / len(updates)
+
+    async def delivered(watchers):
+        # through the writer tasks, until every spectator has every update
+        socks = [FakeSocket() for _ in range(watchers)]
+        game.spectators = {Connection(sock) for sock in socks}
+        for client in game.spectators:
+            client.start()
+        start = time.perf_counter()
+        for message in updates:
+            server_main.send_to_spectators(game, message)
+            await asyncio.sleep(0)
+        while any(sock.outbox.qsize() < len(updates) for sock in socks):
+            await asyncio.sleep(0)
+        elapsed = (time.perf_counter() - start) / len(updates)
+        for client in game.spectators:
+            await client.stop()
+        return elapsed
+
+    print(f'{len(updates)} updates, a quarter of the spectators on the binary protocol')
+    for watchers in [1, 10, 100, 1000, 5000]:
+        shared = asyncio.run(fan_out(watchers, server_main.send_to_spectators))
+        each = asyncio.run(fan_out(watchers, per_recipient))
+        sent = asyncio.run(delivered(watchers))
+        print(f'{watchers} spectators: queueing {shared * 1e6:,.0f}us per update shared vs {each * 1e6:,.0f}us encoding '
+              f'per recipient ({each / shared:.1f}x); written out {sent * 1e6:,.0f}us per update '
+              f'({sent / watchers * 1e6:.2f}us per spectator)')
+
+
+def bench_bot(args):
+    import asyncio
+    import bot
+    import server_main
+    import simulate
+
+    games = args.limit or 40
+
+    def play(seed, bot_p1, opponent):
+        rng = random.Random(seed)
+        player = bot.Bot(is_p1=bot_p1, seed=seed)
+        state = game_logic.GameState(seed=seed)
+        while not state.over and state.legal_moves():
+            if state.is_p1_turn == bot_p1:
+                move = player.choose_move(state)
+            else:
+                move = opponent(state, rng)
+            state.player_act(*move, state.is_p1_turn)
+        return state.winner * (1 if bot_p1 else -1), player
+
+    print(f'{bot.BUDGET * 1000:.0f}ms per move, {games} games against each policy, seats alternating')
+    for name, opponent in simulate.POLICIES.items():
+        results = []
+        iterations = nodes = 0
+        search_time = 0.0
+        for seed in range(args.seed, args.seed + games):
+            result, player = play(seed, seed % 2 == 0, opponent)
+            results.append(result)
+            iterations += player.iterations
+            nodes += player.nodes
+            search_time += player.search_time
+        print(f'vs {name}: {results.count(1)} won, {results.count(-1)} lost, {results.count(0)} undecided; '
+              f'{iterations / search_time:,.0f} iterations/s, '
+              f'{nodes / search_time:,.0f} nodes/s')
+
+    async def stalls(thinkers, limit):
+        # bots thinking at once, at most limit searching at a time as in
+        # server_main.bot_move, while a ticker measures the longest event loop stall
+        states = random_midgame_states(thinkers, args.seed, moves=10)
+        players = [bot.Bot(is_p1=state.is_p1_turn, seed=i) for i, state in enumerate(states)]
+        searching = asyncio.Semaphore(limit or thinkers)
+        longest = 0.0
+        done = False
+
+        async def ticker():
+            nonlocal longest
+            last = time.perf_counter()
+            while not done:
+                await asyncio.sleep(0)
+                now = time.perf_counter()
+                longest = max(longest, now - last)
+                last = now
+
+        async def think(player, state):
+            async with searching:
+                await player.think(state)
+
+        tick = asyncio.ensure_future(ticker())
+        start = time.perf_counter()
+        await asyncio.gather(*[think(player, state) for player, state in zip(players, states)])
+        elapsed = time.perf_counter() - start
+        done = True
+        await tick
+        return elapsed, longest
+
+    runs = [(thinkers, limit, asyncio.run(stalls(thinkers, limit)))
+            for thinkers in [1, 10, 100] for limit in [0, server_main.BOT_THINKERS]]
+    for thinkers, limit, (elapsed, longest) in runs:
+        print(f'{thinkers} bots thinking at once, {limit or "all"} searching at a time: '
+              f'{elapsed * 1000:,.0f}ms for a move each, longest event loop stall {longest * 1000:.1f}ms')
+
+
+def bench_metrics(args):
+    import asyncio
+    import metrics
+    import server_main
+
+    histogram = metrics.Histogram()
+    values = [random.Random(args.seed).expovariate(2000) for _ in range(100000)]
+    start = time.perf_counter()
+    for value in values:
+        histogram.observe(value)
+    observe = (time.perf_counter() - start) / len(values)
+
+    async def games(pairs):
+        # the same games each run, moves judged inline so the instrumented path dominates
+        rng = random.Random(args.seed)
+        latencies = []
+        tasks = []
+        for _ in range(pairs):
+            sock1 = FakeSocket()
+            sock2 = FakeSocket()
+            tasks.append(asyncio.ensure_future(server_main.handler(sock1)))
+            tasks.append(asyncio.ensure_future(server_main.handler(sock2)))
+            tasks.append(asyncio.ensure_future(play_fake_pair(server_main, sock1, sock2, rng, latencies, latencies)))
+        start = time.perf_counter()
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        return len(latencies) / (time.perf_counter() - start)
+
+    pairs = args.limit or 200
+    server_main.configure_move_executor(None)
+    rates = {False: [], True: []}
+    for _ in range(5):
+        for enabled in (False, True):
+            server_main.server_metrics = metrics.Metrics(server_main.lifecycle_stats) if enabled else None
+            server_main.games.clear()
+            rates[enabled].append(asyncio.run(games(pairs)))
+    scrape = server_main.server_metrics
+    start = time.perf_counter()
+    text = scrape.render()
+    render = time.perf_counter() - start
+    server_main.server_metrics = None
+    off = percentile(rates[False], 50)
+    on = percentile(rates[True], 50)
+    print(f'Histogram.observe: {observe * 1e9:.0f}ns')
+    print(f'{pairs} games at once, median of 5: {off:,.0f} moves/s without metrics, {on:,.0f} with '
+          f'({(off - on) / off * 100:+.1f}% overhead, {(1 / on - 1 / off) * 1e6:.1f}us per move)')
+    print(f'scrape: {len(text.splitlines())} lines rendered in {render * 1e3:.2f}ms')
+
+
+def bench_logging(args):
+    import asyncio
+    import os
+    import logs
+    import server_main
+
+    async def served(pairs):
+        rng = random.Random(args.seed)
+        latencies = []
+        tasks = []
+        for _ in range(pairs):
+            sock1 = FakeSocket()
+            sock2 = FakeSocket()
+            tasks.append(asyncio.ensure_future(server_main.handler(sock1)))
+            tasks.append(asyncio.ensure_future(server_main.handler(sock2)))
+            tasks.append(asyncio.ensure_future(play_fake_pair(server_main, sock1, sock2, rng, latencies, latencies)))
+        start = time.perf_counter()
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        return len(latencies) / (time.perf_counter() - start)
+
+    def self_play(games):
+        rng = random.Random(args.seed)
+        moves = 0
+        start = time.perf_counter()
+        for game_idx in range(games):
+            state = game_logic.GameState(seed=game_idx)
+            while not state.over and state.legal_moves():
+                state.player_act(*rng.choice(state.legal_moves()), state.is_p1_turn)
+                moves += 1
+        return moves / (time.perf_counter() - start)
+
+    pairs = args.limit or 200
+    server_main.configure_move_executor(None)
+    defaults = dict(logs.SAMPLE_RATES)
+    with open(os.devnull, 'w') as devnull:
+        for name, level, sample_rates in [('INFO (default)', 'INFO', defaults),
+                                          ('DEBUG, sampled', 'DEBUG', defaults),
+                                          ('DEBUG, every record', 'DEBUG', {category: 1 for category in logs.SAMPLE_RATES})]:
+            logs.configure(level, stream=devnull, sample_rates=sample_rates)
+            server_rates = []
+            logic_rates = []
+            for _ in range(3):
+                server_main.games.clear()
+                server_rates.append(asyncio.run(served(pairs)))
+                logic_rates.append(self_play(500))
+            server_rate = percentile(server_rates, 50)
+            logic_rate = percentile(logic_rates, 50)
+            logs.stop()
+            print(f'{name}, median of 3: {server_rate:,.0f} moves/s served ({pairs} games at once), '
+                  f'{logic_rate:,.0f} moves/s self-play, {logs.queue_handler.dropped} records dropped')
+
+
+def bench_requests(args):
+    import json
+    import protocol
+    import server_main
+
+    # one of each request, as a client would send it
+    requests = [
+        {'type': 'connect'},
+        {'type': 'new_game', 'body': {'player_id': 10000}},
+        {'type': 'join_game', 'body': {'player_id': 10001, 'game_id': 10000}},
+        {'type': 'action', 'body': {'player_id': 10000, 'game_id': 10000, 'card': 'QH', 'pile': 3,
+                                    'take_upcard': True}},
+        {'type': 'resync', 'body': {'player_id': 10000, 'game_id': 10000, 'from_seq': 12}},
+        {'type': 'quick_match', 'body': {'player_id': 10000}},
+        {'type': 'cancel_match', 'body': {'player_id': 10000}},
+        {'type': 'spectate', 'body': {'player_id': 10002, 'game_id': 10000}},
+        {'type': 'unspectate', 'body': {'player_id': 10002, 'game_id': 10000}},
+        {'type': 'bot_game', 'body': {'player_id': 10000}},
+    ]
+    codecs = [('json', json.loads, json.dumps)]
+    if protocol.orjson is not None:
+        codecs.append(('orjson', protocol.orjson.loads, json.dumps))
+    codecs.append(('binary', None, protocol.encode))
+    rounds = args.limit or 20000
+    default_loads = protocol.json_loads
+    print(f'parse + validate + dispatch lookup, {rounds} of each message'
+          f'{"" if protocol.orjson is not None else " (orjson not installed)"}')
+    for name, loads, encode in codecs:
+        if loads is not None:
+            protocol.json_loads = loads
+        costs = []
+        for req in requests:
+            frame = encode(req)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                req_json, err = server_main.parse_request(frame)
+                server_main.REQUEST_HANDLERS[req_json['type']]
+            costs.append((req['type'], (time.perf_counter() - start) / rounds))
+            assert err is None, err
+        print(f'{name}: ' + ', '.join(f'{req_type} {cost * 1e6:.2f}us' for req_type, cost in costs))
+    protocol.json_loads = default_loads
+
+
+BENCHMARKS = {
+    'eval': bench_eval,
+    'solve': bench_solve,
+    'deck': bench_deck,
+    'batch': bench_batch,
+    'equity': bench_equity,
+    'cache': bench_cache,
+    'slow_clients': bench_slow_clients,
+    'move_workers': bench_move_workers,
+    'move_scaling': bench_move_scaling,
+    'shards': bench_shards,
+    'protocol': bench_protocol,
+    'replay': bench_replay,
+    'snapshot': bench_snapshot,
+    'soak': bench_soak,
+    'matchmaking': bench_matchmaking,
+    'spectators': bench_spectators,
+    'bot': bench_bot,
+    'metrics': bench_metrics,
+    'logging': bench_logging,
+    'requests': bench_requests,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--limit', type=int, default=0, help='only use the first N items')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-check', action='store_true', help='skip correctness checks')
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
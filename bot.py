@@ -0,0 +1,293 @@
+"""
+A computer opponent: Monte Carlo tree search over determinized deals.
+
+The bot cannot see the other hand or the deck, so every iteration deals those
+unseen cards at random (a determinization) and walks the tree in that world:
+UCB1 picks among the moves legal there, a few random unjudged moves follow,
+and the position is scored by how each pile leans. At the root, priors in the
+spirit of simulate.greedy_policy steer the search towards moves that leave a
+strong hand reachable on their pile. Nodes live in a transposition table keyed
+on what the bot can see -- the piles, the up card, its own hand and whose turn
+it is -- so positions reached by different move orders share statistics, and
+the table carries over from one turn to the next.
+
+Searching is bounded by a per-move budget of seconds spent inside search();
+think() spends it a slice at a time, yielding to the event loop in between.
+"""
+import asyncio
+import math
+import random
+import time
+import game_logic
+import movelog
+import solver
+
+BUDGET = 0.02
+SLICE = 0.002
+MAX_NODES = 200000
+EXPLORATION = 0.7
+# random moves played past the tree before scoring
+PLAYOUT_DEPTH = 2
+# weight of the root priors, fading as a move gathers visits
+PRIOR_WEIGHT = 1.0
+# share of a root prior given to the draw: take the up card when it is a ten
+# or better, as greedy_policy does
+DRAW_PRIOR = 0.25
+
+
+class Node:
+    __slots__ = ('visits', 'moves', 'priors')
+
+    def __init__(self):
+        self.visits = 0
+        # packed move -> [visits, total reward for the player to move]
+        self.moves = {}
+        # packed move -> prior in [0, 1], at the root only
+        self.priors = None
+
+
+def info_key(state, hand):
+    """
+    returns the transposition table key of a position as seen by the holder of
+    hand: every pile side, the up card, the hand and whose turn it is
+    """
+    key = hand.mask | (state.up_card.code + 1 if state.up_card is not None else 0) << 52
+    for pile in state.piles:
+        key = key << 104 | pile.p1_mask << 52 | pile.p2_mask
+    return key << 1 | state.is_p1_turn
+
+
+def determinize(state, is_p1, rng):
+    """
+    returns a copy of state with the cards is_p1 cannot see, the other hand and
+    the deck, dealt afresh at random
+    """
+    clone = game_logic.GameState.unpack(state.pack())
+    own = clone.p1_hand if is_p1 else clone.p2_hand
+    other = clone.p2_hand if is_p1 else clone.p1_hand
+    unseen_mask = clone.pool_mask & ~own.mask
+    if clone.up_card is not None:
+        unseen_mask &= ~clone.up_card.bit
+    unseen = [card.code for card in game_logic.mask_to_cards(unseen_mask)]
+    rng.shuffle(unseen)
+    dealt = len(other.cards)
+    other.cards = [game_logic.CARDS[code] for code in unseen[:dealt]]
+    other.mask = game_logic.cards_to_mask(other.cards)
+    pos = state.deck.pos
+    clone.deck = game_logic.Deck.from_order(state.deck.order[:pos] + unseen[dealt:], pos)
+    return clone
+
+
+def legal_moves(state):
+    """
+    returns the packed moves (see movelog.pack_move) of the player to move
+    """
+    hand = state.p1_hand if state.is_p1_turn else state.p2_hand
+    draws = []
+    if state.up_card is not None:
+        draws.append(1)
+    if len(state.deck) > 0:
+        draws.append(0)
+    if not draws:
+        return []
+    open_piles = [i for i in range(5)
+                  if len(state.piles[i].p1_pile if state.is_p1_turn else state.piles[i].p2_pile) < 5]
+    return [card.code | pile_idx << 6 | take << 9 for card in hand.cards for pile_idx in open_piles for take in draws]
+
+
+def playout(state, rng, depth=PLAYOUT_DEPTH):
+    """
+    plays up to depth random moves unjudged; returns the number played
+    """
+    played = 0
+    while played < depth:
+        hand = state.p1_hand if state.is_p1_turn else state.p2_hand
+        side = 'p1_pile' if state.is_p1_turn else 'p2_pile'
+        open_piles = [i for i in range(5) if len(getattr(state.piles[i], side)) < 5]
+        can_take = state.up_card is not None
+        can_draw = len(state.deck) > 0
+        if not open_piles or not (can_take or can_draw):
+            break
+        take_upcard = can_take and (not can_draw or rng.random() < 0.5)
+        state.move(rng.choice(hand.cards), rng.choice(open_piles), take_upcard, state.is_p1_turn)
+        played += 1
+    return played
+
+
+class Bot:
+    """
+    Plays one side of one game; keep the same Bot for the whole game so its
+    tables carry over between turns.
+    """
+
+    def __init__(self, is_p1=False, budget=BUDGET, seed=None, max_nodes=MAX_NODES):
+        self.is_p1 = is_p1
+        self.budget = budget
+        self.rng = random.Random(seed)
+        self.max_nodes = max_nodes
+        self.table = {}
+        # pile side mask -> (strength, best hand mask, pool it was solved in)
+        self.completions = {}
+        self.root_pool = game_logic.FULL_MASK
+        self.iterations = 0
+        self.nodes = 0
+        self.search_time = 0.0
+
+    def completion(self, side_mask, pool_mask):
+        """
+        returns the strength of side_mask's best completion from pool_mask
+        A completion found in a larger pool stays the best for as long as its
+        cards remain, and pools only shrink, so most lookups skip the solver.
+        """
+        entry = self.completions.get(side_mask)
+        if entry is None or pool_mask & ~entry[2]:
+            # solve in the root's pool, which holds every pool searched below it
+            pool = self.root_pool if not pool_mask & ~self.root_pool else pool_mask
+            entry = self.completions[side_mask] = solver.best_completion(side_mask, pool) + (pool,)
+        strength, best_mask, _ = entry
+        if best_mask & ~side_mask & ~pool_mask:
+            # a card of that hand has been played since
+            strength, _ = solver.best_completion(side_mask, pool_mask)
+        return strength
+
+    def score(self, state):
+        """
+        returns how the piles lean for p1, in [-1, 1]: a pile counts fully for
+        a full side that beats the other side's best completion (a decided
+        verdict) and half for the side with the stronger best completion
+        """
+        total = 0.0
+        for pile in state.piles:
+            strength1 = self.completion(pile.p1_mask, state.pool_mask)
+            strength2 = self.completion(pile.p2_mask, state.pool_mask)
+            if strength1 > strength2:
+                total += 1.0 if len(pile.p1_pile) == 5 else 0.5
+            elif strength1 < strength2:
+                total -= 1.0 if len(pile.p2_pile) == 5 else 0.5
+        return total / 5
+
+    def priors(self, state, moves):
+        """
+        returns move -> prior in [0, 1] for the player to move, mostly from the
+        rank of the strongest hand the move leaves reachable on its pile side
+        """
+        sides = [pile.p1_mask if state.is_p1_turn else pile.p2_mask for pile in state.piles]
+        strengths = {}
+        for move in moves:
+            card = game_logic.CARDS[move & 63]
+            pile_idx = move >> 6 & 7
+            if (card.code, pile_idx) not in strengths:
+                strengths[card.code, pile_idx] = self.completion(sides[pile_idx] | card.bit,
+                                                                 state.pool_mask & ~card.bit)
+        ranked = sorted(set(strengths.values()))
+        rank = {strength: i / max(len(ranked) - 1, 1) for i, strength in enumerate(ranked)}
+        take_preferred = state.up_card is not None and state.up_card.rank >= 10
+        return {move: (1 - DRAW_PRIOR) * rank[strengths[move & 63, move >> 6 & 7]]
+                + DRAW_PRIOR * (bool(move >> 9 & 1) == take_preferred) for move in moves}
+
+    def root(self, state):
+        """
+        returns the table node for state, with priors for its moves
+        """
+        key = info_key(state, state.p1_hand if self.is_p1 else state.p2_hand)
+        node = self.table.get(key)
+        if node is None:
+            node = self.table[key] = Node()
+        if node.priors is None:
+            node.priors = self.priors(state, legal_moves(state))
+        return node
+
+    def select(self, node, moves):
+        if node.priors is None:
+            untried = [move for move in moves if move not in node.moves]
+            if untried:
+                return self.rng.choice(untried)
+        log_visits = math.log(node.visits + 1)
+        best = None
+        best_value = None
+        for move in moves:
+            visits, total = node.moves.get(move, (0, 0.0))
+            value = (total / visits if visits else 0.0) + EXPLORATION * math.sqrt(log_visits / (visits + 1))
+            if node.priors is not None:
+                value += PRIOR_WEIGHT * node.priors.get(move, 0.0) / (visits + 1)
+            if best_value is None or value > best_value:
+                best = move
+                best_value = value
+        return best
+
+    def iterate(self, state):
+        """
+        runs one determinize, select, expand, playout, update pass from state
+        """
+        world = determinize(state, self.is_p1, self.rng)
+        own = world.p1_hand if self.is_p1 else world.p2_hand
+        path = []
+        while True:
+            moves = legal_moves(world)
+            if not moves:
+                break
+            key = info_key(world, own)
+            node = self.table.get(key)
+            expand = node is None
+            if expand:
+                if len(self.table) >= self.max_nodes:
+                    break
+                node = self.table[key] = Node()
+            move = self.select(node, moves)
+            if move not in node.moves:
+                node.moves[move] = [0, 0.0]
+            path.append((node, move, world.is_p1_turn))
+            world.move(*movelog.unpack_move(move), world.is_p1_turn)
+            self.nodes += 1
+            if expand:
+                break
+        self.nodes += playout(world, self.rng)
+        result = self.score(world)
+        for node, move, is_p1 in path:
+            node.visits += 1
+            stats = node.moves[move]
+            stats[0] += 1
+            stats[1] += result if is_p1 else -result
+        self.iterations += 1
+
+    def search(self, state, budget):
+        """
+        iterates from state for about budget seconds (at least once); returns the seconds spent
+        """
+        if len(self.table) >= self.max_nodes:
+            self.table.clear()
+            self.completions.clear()
+        start = time.perf_counter()
+        deadline = start + budget
+        self.root_pool = state.pool_mask
+        self.root(state)
+        self.iterate(state)
+        while time.perf_counter() < deadline:
+            self.iterate(state)
+        elapsed = time.perf_counter() - start
+        self.search_time += elapsed
+        return elapsed
+
+    def best_move(self, state):
+        """
+        returns the most visited (card, pile_idx, take_upcard) at the root
+        """
+        node = self.root(state)
+        moves = legal_moves(state)
+        moves.sort(key=lambda move: (node.moves.get(move, (0,))[0], node.priors.get(move, 0.0)), reverse=True)
+        return movelog.unpack_move(moves[0])
+
+    def choose_move(self, state):
+        self.search(state, self.budget)
+        return self.best_move(state)
+
+    async def think(self, state):
+        """
+        choose_move for the event loop: searches in slices, yielding between
+        them; the caller must keep state unchanged meanwhile
+        """
+        spent = 0.0
+        while spent < self.budget:
+            spent += self.search(state, min(SLICE, self.budget - spent))
+            await asyncio.sleep(0)
+        return self.best_move(state)
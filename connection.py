@@ -0,0 +1,139 @@
+"""
+Per-client outbound queues.
+
+Every connected websocket gets a Connection with a bounded queue of outgoing
+messages drained by its own writer task, so sending to one client never waits
+on another. What happens when a client falls behind and its queue fills up is
+set by the overflow policy:
+
+    'drop'        the new message is discarded
+    'disconnect'  the client is closed
+    'coalesce'    the backlog is thrown away, all but the messages queued with
+                  keep (acks and errors, which a client waits on), and replaced
+                  by the messages returned by the connection's resync callback
+                  (fresh snapshots); a client whose queue is still full after
+                  that is not reading at all, and is closed
+"""
+import asyncio
+import time
+from collections import deque
+
+POLICIES = ('drop', 'disconnect', 'coalesce')
+MAX_QUEUE = 256
+LATENCY_SAMPLES = 1024
+
+# messages dropped or coalesced away and clients closed for falling behind,
+# over every connection so far
+totals = {'dropped': 0, 'coalesced': 0, 'closed_slow': 0}
+
+
+class Connection:
+
+    def __init__(self, websocket, max_queue=MAX_QUEUE, policy='coalesce', resync=None):
+        assert policy in POLICIES
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        # called with the connection, returns the messages that replace a dropped backlog
+        self.resync = resync
+        self.pending = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.writer = None
+        # 'json' or 'binary' (see protocol.py), chosen by the client when it connects
+        self.protocol = 'json'
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        # seconds between send() and the frame being written, most recent last
+        self.send_latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+        return self.writer
+
+    def send(self, message, keep=False):
+        """
+        queues a str or bytes message without waiting; returns False if it was
+        not queued. A message sent with keep survives coalescing
+        """
+        if self.closed:
+            return False
+        now = time.perf_counter()
+        if len(self.pending) >= self.max_queue:
+            if self.policy == 'drop':
+                self.dropped += 1
+                totals['dropped'] += 1
+                return False
+            if self.policy == 'disconnect' or self.resync is None:
+                totals['closed_slow'] += 1
+                self.close()
+                return False
+            kept = [entry for entry in self.pending if entry[2]]
+            self.coalesced += len(self.pending) - len(kept)
+            totals['coalesced'] += len(self.pending) - len(kept)
+            self.pending = deque(kept)
+            self.pending.extend((resync, now, False) for resync in self.resync(self))
+            if len(self.pending) >= self.max_queue:
+                # still full: the client is not reading even its acks, and
+                # coalescing again on every send would get nowhere
+                totals['closed_slow'] += 1
+                self.close()
+                return False
+            if not keep:
+                # the snapshots already cover it
+                message = None
+        if message is not None:
+            self.pending.append((message, now, keep))
+        self.max_depth = max(self.max_depth, len(self.pending))
+        self.ready.set()
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.clear()
+        self.ready.set()
+        asyncio.ensure_future(self.websocket.close())
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self.pending:
+                    if self.closed:
+                        return
+                    self.ready.clear()
+                    await self.ready.wait()
+                message, queued_at, _ = self.pending.popleft()
+                await self.websocket.send(message)
+                self.sent += 1
+                self.send_latencies.append(time.perf_counter() - queued_at)
+        except Exception:
+            # the reader side notices the closed socket and cleans up
+            self.closed = True
+            self.pending.clear()
+
+    async def stop(self):
+        self.closed = True
+        self.ready.set()
+        if self.writer is not None:
+            self.writer.cancel()
+            try:
+                await self.writer
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        latencies = sorted(self.send_latencies)
+        return {
+            'depth': len(self.pending),
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'send_latency_p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'send_latency_p99': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] if latencies else 0.0,
+        }
@@ -0,0 +1,223 @@
+"""
+Win probabilities for each pile and for the whole game. Requires numpy.
+
+The unknown future is modelled as a uniformly random deal of the cards not yet
+on a pile into every open pile slot. When the number of distinct deals is at
+most exact_limit they are all enumerated; otherwise deals are sampled in
+vectorized batches until the sample or time budget runs out. Passing a
+concurrent.futures executor splits the samples into one chunk per worker
+(or chunks) and samples them in parallel, each chunk stopping at the time
+budget on its own.
+
+Results are dicts of fractions: per pile {'p1', 'p2', 'tie'}, and for the
+game {'p1', 'p2', 'none'}, where 'none' covers deals in which neither or both
+players complete a win line.
+
+This is an offline analysis tool: a game_equity call costs milliseconds,
+too much for the bot's per-move search or the server's request path. Run on
+a move log (see movelog.py), it prints how the odds moved over a game:
+
+    python equity.py games.log --game-id 3 --workers 4
+"""
+import argparse
+import itertools
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import batch_eval
+import game_logic
+import movelog
+
+BATCH_SIZE = 512
+
+
+def snapshot(state, pile_indices=range(5)):
+    """
+    returns (sides, pool): the card codes already on each side of the given
+    piles (p1 then p2 per pile) and the codes of every card not yet on a pile
+    """
+    sides = []
+    for pile_idx in pile_indices:
+        pile = state.piles[pile_idx]
+        sides.append([card.code for card in pile.p1_pile])
+        sides.append([card.code for card in pile.p2_pile])
+    pool = [card.code for card in game_logic.mask_to_cards(state.pool_mask)]
+    return sides, pool
+
+
+def count_deals(pool_size, needs):
+    count = 1
+    for need in needs:
+        count *= math.comb(pool_size, need)
+        pool_size -= need
+    return count
+
+
+def _exact_deals(pool, needs):
+    """
+    yields every deal as one flat tuple of codes, side after side
+    """
+    if not needs:
+        yield ()
+        return
+    for chosen in itertools.combinations(pool, needs[0]):
+        rest = [code for code in pool if code not in chosen]
+        for tail in _exact_deals(rest, needs[1:]):
+            yield chosen + tail
+
+
+def _random_deals(rng, pool, total_need, count):
+    """
+    returns a (count, total_need) array of deals drawn without replacement
+    """
+    order = np.argsort(rng.random((count, len(pool))), axis=1)[:, :total_need]
+    return np.asarray(pool, dtype=np.int64)[order]
+
+
+def _tally(sides, deals):
+    """
+    evaluates every deal, returns (pile_counts, game_counts)
+    pile_counts is (piles, 3) of [p1, p2, tie] wins, game_counts is [p1, p2, none]
+    """
+    strengths = []
+    offset = 0
+    for side in sides:
+        need = 5 - len(side)
+        fixed = np.broadcast_to(np.asarray(side, dtype=np.int64), (len(deals), len(side)))
+        hands = np.concatenate([fixed, deals[:, offset:offset + need]], axis=1)
+        strengths.append(batch_eval.evaluate_batch(hands))
+        offset += need
+    verdicts = [np.sign(strengths[i] - strengths[i + 1]) for i in range(0, len(strengths), 2)]
+    pile_counts = np.array([[(v == 1).sum(), (v == -1).sum(), (v == 0).sum()] for v in verdicts])
+
+    game_counts = np.zeros(3, dtype=np.int64)
+    if len(verdicts) == 5:
+        p1_line = np.zeros(len(deals), dtype=bool)
+        p2_line = np.zeros(len(deals), dtype=bool)
+        for line in game_logic.WIN_LINES:
+            p1_line |= np.logical_and.reduce([verdicts[i] == 1 for i in line])
+            p2_line |= np.logical_and.reduce([verdicts[i] == -1 for i in line])
+        p1_only = (p1_line & ~p2_line).sum()
+        p2_only = (p2_line & ~p1_line).sum()
+        game_counts[:] = [p1_only, p2_only, len(deals) - p1_only - p2_only]
+    return pile_counts, game_counts
+
+
+def sample_chunk(sides, pool, samples, seed, time_budget=None):
+    """
+    returns (pile_counts, game_counts, total) for up to samples random deals,
+    fewer if time_budget seconds run out first; a top level function so it
+    can run in a process pool
+    """
+    rng = np.random.default_rng(seed)
+    total_need = sum(5 - len(side) for side in sides)
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    pile_counts = np.zeros((len(sides) // 2, 3), dtype=np.int64)
+    game_counts = np.zeros(3, dtype=np.int64)
+    total = 0
+    while total < samples and (deadline is None or total == 0 or time.perf_counter() < deadline):
+        count = min(samples - total, BATCH_SIZE)
+        counts = _tally(sides, _random_deals(rng, pool, total_need, count))
+        pile_counts += counts[0]
+        game_counts += counts[1]
+        total += count
+    return pile_counts, game_counts, total
+
+
+def estimate(sides, pool, samples=2000, time_budget=None, exact_limit=4000, seed=None, executor=None,
+             chunks=None):
+    """
+    returns (pile_counts, game_counts, total, exact) for the given sides;
+    with an executor, samples are split into chunks, by default one per worker
+    """
+    needs = [5 - len(side) for side in sides]
+    total_need = sum(needs)
+    if total_need == 0:
+        deals = np.zeros((1, 0), dtype=np.int64)
+        return _tally(sides, deals) + (1, True)
+    if count_deals(len(pool), needs) <= exact_limit:
+        deals = np.array(list(_exact_deals(pool, needs)), dtype=np.int64).reshape(-1, total_need)
+        return _tally(sides, deals) + (len(deals), True)
+
+    seeds = np.random.SeedSequence(seed)
+    if executor is None:
+        return sample_chunk(sides, pool, samples, seeds, time_budget) + (False,)
+    if chunks is None:
+        # both pools in concurrent.futures keep their size here
+        chunks = getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+    futures = [executor.submit(sample_chunk, sides, pool, samples // chunks + (i < samples % chunks), child, time_budget)
+               for i, child in enumerate(seeds.spawn(chunks))]
+    results = [future.result() for future in futures]
+    return sum(r[0] for r in results), sum(r[1] for r in results), sum(r[2] for r in results), False
+
+
+def _fractions(counts, total, names):
+    return {name: float(count) / total for name, count in zip(names, counts)}
+
+
+def pile_equity(state, pile_idx, samples=2000, time_budget=None, exact_limit=4000, seed=None, executor=None,
+                chunks=None):
+    """
+    returns {'p1', 'p2', 'tie', 'exact', 'samples'} for one pile
+    """
+    sides, pool = snapshot(state, [pile_idx])
+    pile_counts, _, total, exact = estimate(sides, pool, samples, time_budget, exact_limit, seed, executor, chunks)
+    result = _fractions(pile_counts[0], total, ['p1', 'p2', 'tie'])
+    result.update(exact=exact, samples=total)
+    return result
+
+
+def game_equity(state, samples=2000, time_budget=None, exact_limit=4000, seed=None, executor=None, chunks=None):
+    """
+    returns {'p1', 'p2', 'none', 'piles', 'exact', 'samples'}, where piles holds
+    the per pile fractions measured on the same deals
+    """
+    sides, pool = snapshot(state)
+    pile_counts, game_counts, total, exact = estimate(sides, pool, samples, time_budget, exact_limit, seed, executor,
+                                                      chunks)
+    result = _fractions(game_counts, total, ['p1', 'p2', 'none'])
+    result.update(
+        piles=[_fractions(counts, total, ['p1', 'p2', 'tie']) for counts in pile_counts],
+        exact=exact,
+        samples=total,
+    )
+    return result
+
+
+def equity_curve(log, samples=2000, seed=None, executor=None):
+    """
+    returns the game_equity of a logged game before its first move and after
+    each move, up to the move that ended it
+    """
+    state = game_logic.GameState(seed=log.seed)
+    curve = [game_equity(state, samples, seed=seed, executor=executor)]
+    for card, pile_idx, take_upcard in log:
+        state.player_act(card, pile_idx, take_upcard, state.is_p1_turn)
+        curve.append(game_equity(state, samples, seed=seed, executor=executor))
+        if state.over:
+            break
+    return curve
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='a move log file')
+    parser.add_argument('--game-id', type=int, help='the game to follow; the first in the file by default')
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=0, help='processes to sample in')
+    args = parser.parse_args()
+    with open(args.path, 'rb') as f:
+        logs = {game_id: log for game_id, log, _, _ in movelog.read_records(f)}
+    game_id = args.game_id if args.game_id is not None else next(iter(logs))
+    executor = ProcessPoolExecutor(args.workers) if args.workers else None
+    try:
+        curve = equity_curve(logs[game_id], args.samples, args.seed, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    for move_idx, result in enumerate(curve):
+        exact = 'exact' if result['exact'] else f"{result['samples']} deals"
+        print(f"move {move_idx:2}: p1 {result['p1']:.3f} p2 {result['p2']:.3f} none {result['none']:.3f} ({exact})")
@@ -0,0 +1,137 @@
+"""
+Table driven 5 card hand evaluator.
+
+Every 5 card hand maps to a single integer strength. Higher is better, and
+two hands tie exactly when their strengths are equal. The category index
+(into utils.HAND_STRENGTHS) sits in the high bits, followed by one nibble per
+rank in tie-break order, so `strength >> CATEGORY_SHIFT` recovers the category.
+
+The tables are built once at import: one keyed by the rank bitmask for
+flushes, one keyed by the product of per-rank primes for everything else.
+The same pass lists every distinct hand class strongest first, which the
+solver scans when completing partial piles.
+
+Card masks use the layout of game_logic.Card.bit: 13 rank bits per suit.
+"""
+import itertools
+import utils
+from utils import HAND_STRENGTHS
+
+CATEGORY_SHIFT = 20
+
+# prime per rank, indexed by the rank itself (2..14)
+PRIMES = [0, 0, 2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41]
+
+STRAIGHTS = [list(range(high, high - 5, -1)) for high in range(14, 5, -1)] + [[5, 4, 3, 2, 14]]
+
+
+def straight_high(ranks):
+    """
+    returns the high card of the straight formed by 5 distinct ranks, or 0
+    """
+    rank_set = set(ranks)
+    for straight in STRAIGHTS:
+        if rank_set == set(straight):
+            return straight[0]
+    return 0
+
+
+def make_strength(category, ranks):
+    """
+    packs a category name and up to 5 ranks (in tie-break order) into a strength
+    """
+    strength = HAND_STRENGTHS.index(category)
+    for i in range(5):
+        strength = (strength << 4) | (ranks[i] if i < len(ranks) else 0)
+    return strength
+
+
+def category(strength):
+    return HAND_STRENGTHS[strength >> CATEGORY_SHIFT]
+
+
+def _straight_ranks(high):
+    return [high - i for i in range(5)] if high != 5 else [5, 4, 3, 2, 1]
+
+
+def _unsuited_strength(ranks):
+    counts = {rank: ranks.count(rank) for rank in set(ranks)}
+    # tie-break order: bigger groups first, then higher rank
+    ordered = sorted(counts, key=lambda rank: (counts[rank], rank), reverse=True)
+    shape = sorted(counts.values(), reverse=True)
+    if shape == [4, 1]:
+        return make_strength('QUADS', ordered)
+    if shape == [3, 2]:
+        return make_strength('FULL_HOUSE', ordered)
+    if shape == [3, 1, 1]:
+        return make_strength('SET', ordered)
+    if shape == [2, 2, 1]:
+        return make_strength('TWO_PAIR', ordered)
+    if shape == [2, 1, 1, 1]:
+        return make_strength('ONE_PAIR', ordered)
+    high = straight_high(ranks)
+    if high:
+        return make_strength('STRAIGHT', _straight_ranks(high))
+    return make_strength('HIGH_CARD', ordered)
+
+
+def _suited_strength(ranks):
+    high = straight_high(ranks)
+    if high:
+        return make_strength('STRAIGHT_FLUSH', _straight_ranks(high))
+    return make_strength('FLUSH', sorted(ranks, reverse=True))
+
+
+def _build_tables():
+    flushes = [0] * (1 << 15)
+    unsuited = {}
+    flush_classes = []
+    unsuited_classes = []
+    for ranks in itertools.combinations_with_replacement(utils.ALL_RANKS, 5):
+        if max(ranks.count(rank) for rank in ranks) > 4:
+            continue
+        key = 1
+        counts = 0
+        for rank in ranks:
+            key *= PRIMES[rank]
+            counts += 1 << (4 * (rank - 2))
+        unsuited[key] = _unsuited_strength(list(ranks))
+        unsuited_classes.append((unsuited[key], counts))
+        if len(set(ranks)) == 5:
+            rank_bits = sum(1 << rank for rank in ranks)
+            flushes[rank_bits] = _suited_strength(list(ranks))
+            flush_classes.append((flushes[rank_bits], rank_bits >> 2))
+    flush_classes.sort(reverse=True)
+    unsuited_classes.sort(reverse=True)
+    return flushes, unsuited, flush_classes, unsuited_classes
+
+
+# FLUSH_CLASSES holds (strength, 13 bit rank mask) and UNSUITED_CLASSES holds
+# (strength, rank counts packed 4 bits per rank), both strongest first
+FLUSHES, UNSUITED, FLUSH_CLASSES, UNSUITED_CLASSES = _build_tables()
+
+
+def evaluate(cards):
+    """
+    returns the strength of exactly 5 cards
+    """
+    a, b, c, d, e = cards
+    if a.suit == b.suit == c.suit == d.suit == e.suit:
+        return FLUSHES[(1 << a.rank) | (1 << b.rank) | (1 << c.rank) | (1 << d.rank) | (1 << e.rank)]
+    return UNSUITED[PRIMES[a.rank] * PRIMES[b.rank] * PRIMES[c.rank] * PRIMES[d.rank] * PRIMES[e.rank]]
+
+
+def evaluate_mask(mask):
+    """
+    returns the strength of a card mask holding exactly 5 cards
+    """
+    product = 1
+    for suit in range(4):
+        ranks = (mask >> (13 * suit)) & 0x1FFF
+        if ranks.bit_count() == 5:
+            return FLUSHES[ranks << 2]
+        while ranks:
+            low = ranks & -ranks
+            product *= PRIMES[low.bit_length() + 1]
+            ranks ^= low
+    return UNSUITED[product]
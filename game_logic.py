@@ -1,23 +1,51 @@
+import logging
+import math
 import random
+import struct
 import utils
-from utils import HAND_STRENGTHS
-
-def arbitrate_game(verdicts):
-    pairs_to_win = [[0, 1], [1, 2], [2, 3], [3, 4], [0, 2, 4]]
+import evaluator
+import logs
+import solver
+
+deck_log = logs.get('game.deck')
+arbitrate_log = logs.get('game.arbitrate')
+
+# sets of piles that win the game when one player takes all of them
+WIN_LINES = [[0, 1], [1, 2], [2, 3], [3, 4], [0, 2, 4]]
+
+def arbitrate_game(verdicts, p1_moved):
+    """
+    returns 1 or -1 for the player holding a win line, or -2 while nobody
+    does. One move can settle piles on both sides and hand each player a
+    line at once; the player who made it wins
+    """
     is_p1_win = False
     is_p2_win = False
-    for pair_to_win in pairs_to_win:
+    for pair_to_win in WIN_LINES:
         if all([verdicts[i] == 1 for i in pair_to_win]):
             is_p1_win = True
         if all([verdicts[i] == -1 for i in pair_to_win]):
             is_p2_win = True    
-    assert not (is_p1_win and is_p2_win)
+    if is_p1_win and is_p2_win:
+        return 1 if p1_moved else -1
     if is_p1_win:
         return 1
     if is_p2_win:
         return -1
     return -2
 
+# fixed size image of a GameState (see GameState.pack): turn and game over
+# flags, winner, seq, deck cursor, up card, deck order, both hands, the pile
+# verdicts and the pile cards, 5 + 5 per pile; NO_CARD marks an empty slot
+STATE_RECORD = struct.Struct('<BbHBB52s5s5s5b50s')
+NO_CARD = 0xFF
+
+def _codes(cards, size=5):
+    return bytes([card.code for card in cards] + [NO_CARD] * (size - len(cards)))
+
+def _cards(codes):
+    return [CARDS[code] for code in codes if code != NO_CARD]
+
 class IllegalPlayError(Exception):
     def __init__(self, message):
         self.message = message
@@ -26,10 +54,12 @@ class IllegalPlayError(Exception):
 class Hand:
     def __init__(self, cards=None):
         self.cards = [] if not cards else cards
+        self.mask = cards_to_mask(self.cards)
         self.hand = None
 
     def add_card(self, card):
         self.cards.append(card)
+        self.mask |= card.bit
 
     def __repr__(self) -> str:
         return str(self.cards)
@@ -42,89 +72,25 @@ class Hand:
         return idx
     
     def remove_idx(self, idx):
-        self.cards.pop(idx)
+        self.mask ^= self.cards.pop(idx).bit
 
     def eval(self):
         """
         returns current hand
         """
-        if len(self.cards) != 5:
-            raise Exception("Need 5 cards to evaluate")
-
-        ranks = sorted([card.rank for card in self.cards])
-        suits = [card.suit for card in self.cards]
-        diffs = [ranks[i+1] - ranks[i] for i in range(len(ranks) - 1)]
-        self.value_counts = {number: ranks.count(number) for number in set(ranks)}
-        self.suit_counts = {number: suits.count(number) for number in set(suits)}
-
-
-        if len(self.suit_counts.keys()) == 1:
-            # must be flush or straight flush
-            diffs = [ranks[i+1] - ranks[i] for i in range(len(ranks) - 1)]
-            if diffs == [1,1,1,1] or diffs == [1,1,1,9]:
-                self.hand =  "STRAIGHT_FLUSH"
-            else:
-                self.hand =  "FLUSH"
-        elif len(self.value_counts.keys()) == 2 and max(self.value_counts.values()) == 4:
-            self.hand = "QUADS"
-        elif len(self.value_counts.keys()) == 2 and max(self.value_counts.values()) == 3:
-            self.hand = "FULL_HOUSE"
-        elif diffs == [1,1,1,1] or diffs == [1,1,1,9]:
-            self.hand = "STRAIGHT"
-        elif len(self.value_counts.keys()) == 3 and max(self.value_counts.values()) == 3:
-            self.hand = "SET"
-        elif len(self.value_counts.keys()) == 3 and max(self.value_counts.values()) == 2:
-            self.hand = "TWO_PAIR"
-        elif len(self.value_counts.keys()) == 4:
-            self.hand = "ONE_PAIR"
-        else:
-            self.hand = "HIGH_CARD"
-
+        self.hand = evaluator.category(self.strength())
         return self.hand
 
     def eval_int(self):
-        if self.hand is None:
-            self.eval()
-        self.hand_int = HAND_STRENGTHS.index(self.hand)
-        return self.hand_int
-
-    def get_primary_card(self):
-        if self.hand is None:
-            self.eval()
-        
-        if self.hand in {'STRAIGHT_FLUSH', 'FLUSH', 'STRAIGHT', 'HIGH_CARD'}:
-            self.primary_card = max(self.value_counts.keys())
-            if self.hand in {'STRAIGHT_FLUSH', 'STRAIGHT'} and self.primary_card == 14:
-                self.primary_card = 5 if 13 not in self.value_counts.keys() else 14
-        elif self.hand == 'TWO_PAIR':
-            self.primary_card = max([card for card in self.value_counts.keys() if self.value_counts[card] == 2])
-        else:
-            self.primary_card = max(self.value_counts, key=self.value_counts.get)
-        return self.primary_card
-
-    def get_secondary_card(self):
-        # can only be two pair or pair
-        if self.hand == 'TWO_PAIR':
-            self.secondary_card = max([card for card in self.value_counts.keys() if self.value_counts[card] == 2 and card != self.primary_card])
-        elif self.hand in {'ONE_PAIR', 'HIGH_CARD'}:
-            self.secondary_card = max([card for card in self.value_counts.keys() if card != self.primary_card])
-        else:
-            raise Exception("Shouldn't be calling secondary card on anything besides TWO_PAIR, PAIR_HIGH_CARD")
-
-        return self.secondary_card
-
-    def get_tertiary_card(self):
-        self.tertiary_card = max([card for card in self.value_counts.keys() if card not in {self.primary_card, self.secondary_card}])
-        return self.tertiary_card
-
-    def get_quatenary_card(self):
-        self.quatenary_card = max([card for card in self.value_counts.keys() if card not in {self.primary_card, self.secondary_card, self.tertiary_card}])
-        return self.quatenary_card
+        return self.strength() >> evaluator.CATEGORY_SHIFT
 
-    def get_senary_card(self):
-        self.senary_card = max([card for card in self.value_counts.keys() if card not in {self.primary_card, self.secondary_card, self.tertiary_card, self.quatenary_card}])
-        return self.senary_card
-        
+    def strength(self):
+        """
+        returns a single integer covering category and kickers, higher is better
+        """
+        if len(self.cards) != 5:
+            raise Exception("Need 5 cards to evaluate")
+        return evaluator.evaluate(self.cards)
 
     def compare(self, other):
         """
@@ -135,177 +101,28 @@ class Hand:
         """
         if len(self.cards) != 5 and len(other.cards) != 5:
             return -2
+        if len(self.cards) != 5:
+            return -1
+        if len(other.cards) != 5:
+            return 1
 
-        for func1, func2 in zip([self.eval_int, self.get_primary_card, self.get_secondary_card, self.get_tertiary_card, self.get_quatenary_card, self.get_senary_card],
-                                [other.eval_int, other.get_primary_card, other.get_secondary_card, other.get_tertiary_card, other.get_quatenary_card, other.get_senary_card]):
-            val1 = func1()
-            val2 = func2()
-            if val1 > val2:
-                return 1
-            elif val1 < val2:
-                return -1
-            else:
-                pass # cycle through
+        strength1 = self.strength()
+        strength2 = other.strength()
+        if strength1 > strength2:
+            return 1
+        elif strength1 < strength2:
+            return -1
         return 0
 
-    def get_rank_groups(self, cards):
-        rank_groups = {}
-        for card in cards:
-            if card.rank not in rank_groups:
-                rank_groups[card.rank] = []
-            rank_groups[card.rank].append(card)
-        return rank_groups
-
-    def get_suit_groups(self, cards):
-        suit_groups = {}
-        for card in cards:
-            if card.suit not in suit_groups:
-                suit_groups[card.suit] = []
-            suit_groups[card.suit].append(card)
-        return suit_groups
-
-    def greedy_best_hand(self, pool):
-        if len(self.cards) == 5:
-            return self.cards
-        pool = pool.union(set(self.cards))
-        rank_groups = self.get_rank_groups(pool)
-        suit_groups = self.get_suit_groups(pool)
-        # Convert to sets for efficient lookups
-        played_set = set(self.cards)
-        trips = [c for c in rank_groups.values() if len(c) >= 3]
-        trips = sorted(trips, key = lambda x: x[0].rank, reverse=True)
-        pairs = [c for c in rank_groups.values() if len(c) >= 2]
-        pairs = sorted(pairs, key = lambda x: x[0].rank, reverse=True)
-        print('Debug greedy best hand')
-        print(pool)
-        print(rank_groups)
-        print(suit_groups)
-        print(trips)
-        print(pairs)
-
-        # 1. Try Royal Flush / Straight Flush
-        for suit, suited_cards in suit_groups.items():
-            ranks = sorted(set(c.rank for c in suited_cards), reverse=True)
-            # Check for straight flush
-            for i in range(len(ranks) - 4):
-                slice_ = ranks[i:i+5]
-                if slice_[0] - slice_[-1] == 4:
-                    hand = [Card(r, suit) for r in slice_ if Card(r, suit) in pool]
-                    used = set(hand)
-                    if played_set.issubset(used):
-                        return hand
-            # Special case: A-2-3-4-5
-            if all(r in ranks for r in [14, 2, 3, 4, 5]):
-                hand = [Card(r, suit) for r in [14, 5, 4, 3, 2] if Card(r, suit) in pool]
-                if played_set.issubset(set(hand)):
-                    return hand
-
-        # 2. Four of a Kind
-        for rank, group in rank_groups.items():
-            if len(group) >= 4:
-                hand = [c for c in group[:4]]
-                kicker = max([Card(c.rank, c.suit) for c in pool if c.rank != rank], default=None)
-                if kicker:
-                    hand.append(kicker)
-                if played_set.issubset(set(hand)):
-                    return hand
-
-        # 3. Full House
-        hand = list(played_set)
-        for t in trips:
-            for p in pairs:
-                if t[0].rank != p[0].rank:
-                    t1 = set(t)
-                    p1 = set(p)
-                    hand += list((t1 - played_set))[:3-len(played_set.intersection(t1))]
-                    hand += list((p1 - played_set))[:2-len(played_set.intersection(p1))]
-                    # hand = t[:3] + p[:2]
-                    if len(hand) == 5 and played_set.issubset(set(hand)):
-                        return hand
-
-        # 4. Flush
-        for suit, suited in suit_groups.items():
-            if len(suited) >= 5:
-                flush_hand = sorted(suited, reverse=True)[:5]
-                if played_set.issubset(set(flush_hand)):
-                    return flush_hand
-
-        # 5. Straight
-        all_ranks = sorted(set(card.rank for card in pool), reverse=True)
-        for i in range(len(all_ranks) - 4):
-            slice_ = all_ranks[i:i+5]
-            if slice_[0] - slice_[-1] == 4:
-                straight = []
-                for r in slice_:
-                    cards_with_rank = [card for card in pool if card.rank == r]
-                    if cards_with_rank:
-                        if r in [card.rank for card in played_set]:
-                            straight.append([card for card in played_set if card.rank == r][0])
-                        else:
-                            straight.append(cards_with_rank[0])
-                if played_set.issubset(set(straight)):
-                    return straight
-        # Special case A-2-3-4-5
-        if all(r in all_ranks for r in [14, 2, 3, 4, 5]):
-            straight = []
-            for r in [14, 5, 4, 3, 2]:
-                cards_with_rank = [card for card in pool if card.rank == r]
-                if cards_with_rank:
-                    if r in [card.rank for card in played_set]:
-                        straight.append([card for card in played_set if card.rank == r][0])
-                    else:
-                        straight.append(cards_with_rank[0])
-            if played_set.issubset(set(straight)):
-                return straight
-
-        # 6. Three of a Kind
-        for group in rank_groups.values():
-            if len(group) >= 3:
-                hand = group[:3]
-                kickers = sorted([c for c in pool if c.rank != group[0].rank], reverse=True)[:2]
-                hand += kickers
-                if played_set.issubset(set(hand)):
-                    return hand
-
-        # 7. Two Pair
-        if len(pairs) >= 2:
-            p1, p2 = pairs[:2]
-            hand = p1[:2] + p2[:2]
-            kicker = max([c for c in pool if c.rank != p1[0].rank and c.rank != p2[0].rank], default=None)
-            if kicker:
-                hand.append(kicker)
-            if played_set.issubset(set(hand)):
-                print("HERE2")
-                return hand
-
-        # 8. One Pair
-        if len(pairs) >= 1:
-            print('debug')
-            print(pairs[0])
-            print(played_set)
-
-            for pair in pairs:
-                if len(played_set.union(set(pair[:2]))) <= 5:
-                    hand = played_set.union(set(pair[:2]))
-                    break
-            else:
-                hand = played_set
-            print(hand)
-            hand = list(hand)
-            kickers = sorted([c for c in pool if c.rank != group[0].rank and c not in hand], reverse=True)[:5-len(hand)]
-            hand += kickers
-            if played_set.issubset(set(hand)):
-                return hand
-
-        # 9. High Card
-        hand = list(played_set)
-        rest = sorted([c for c in pool if c not in hand], reverse=True)[:5-len(hand)]
-        hand += rest
-        if played_set.issubset(set(hand)):
-            return hand
-
-        return "Invalid", []
-
+    def best_hand(self, pool_mask):
+        """
+        returns the strongest 5 cards made of these cards plus cards in pool_mask,
+        or these cards alone if the pool cannot complete them
+        """
+        strength, hand_mask = solver.best_completion(self.mask, pool_mask)
+        if strength < 0:
+            return list(self.cards)
+        return mask_to_cards(hand_mask)
 
     def json(self):
         return [c.__repr__() for c in self.cards]
@@ -316,13 +133,17 @@ class Pile:
     def __init__(self):
         self.p1_pile = []
         self.p2_pile = []
+        self.p1_mask = 0
+        self.p2_mask = 0
         self.verdict = 0 # 0 means undecided, 1 means p1, 2 means p2
 
     def p1_play(self, card):
         self.p1_pile.append(card)
+        self.p1_mask |= card.bit
 
     def p2_play(self, card):
         self.p2_pile.append(card)
+        self.p2_mask |= card.bit
 
     def __repr__(self) -> str:
         return f"P1 pile: {self.p1_pile.__repr__()}, P2 pile: {self.p2_pile.__repr__()}, verdict {self.verdict}"
@@ -335,16 +156,32 @@ class Pile:
         }
 
 class Card:
-
-    def __init__(self, rank, suit):
-        self.rank = rank
-        self.suit = suit
+    """
+    Cards are interned: there is exactly one instance per card, so Card(rank, suit)
+    hands back the shared singleton and equality is identity.
+
+    code is suit * 13 + (rank - 2), in 0..51, and bit is 1 << code, so a set of
+    cards fits in one int (see cards_to_mask / mask_to_cards).
+    """
+    __slots__ = ('rank', 'suit', 'code', 'bit')
+
+    def __new__(cls, rank, suit):
+        return CARDS[card_code(rank, suit)]
+
+    @classmethod
+    def _intern(cls, code):
+        card = object.__new__(cls)
+        card.rank = code % 13 + 2
+        card.suit = utils.ALL_SUITS[code // 13]
+        card.code = code
+        card.bit = 1 << code
+        return card
+
+    def __reduce__(self):
+        return (card_from_code, (self.code,))
 
     def __repr__(self):
-        return utils.rank2str(self.rank) + self.suit
-    
-    def __eq__(self, other):
-        return self.rank == other.rank and self.suit == other.suit
+        return CARD_NAMES[self.code]
 
     def __lt__(self, other):
         return self.rank < other.rank
@@ -361,36 +198,126 @@ class Card:
             return 0
 
     def __hash__(self):
-        return hash(str(self))
+        return self.code
+
+def card_code(rank, suit):
+    return utils.SUIT_INDEX[suit] * 13 + rank - 2
+
+def card_from_code(code):
+    return CARDS[code]
+
+CARDS = [Card._intern(code) for code in range(52)]
+CARD_NAMES = [utils.rank2str(card.rank) + card.suit for card in CARDS]
+CARDS_BY_NAME = {name: card for name, card in zip(CARD_NAMES, CARDS)}
+FULL_MASK = (1 << 52) - 1
+
+def parse_card(card_string):
+    """
+    returns the interned card for a string like 'AH', or None if it is not a card
+    """
+    return CARDS_BY_NAME.get(card_string)
+
+def cards_to_mask(cards):
+    mask = 0
+    for card in cards:
+        mask |= card.bit
+    return mask
+
+def mask_to_cards(mask):
+    cards = []
+    while mask:
+        low = mask & -mask
+        cards.append(CARDS[low.bit_length() - 1])
+        mask ^= low
+    return cards
 
 class Deck:
-
-    def __init__(self):
-        self.cards = []
-        for rank in utils.ALL_RANKS:
-            for suit in utils.ALL_SUITS:
-                self.cards.append(Card(rank, suit))
-
-        random.shuffle(self.cards)
+    """
+    A shuffled order of card codes plus a read cursor: order[:pos] has been
+    drawn, order[pos:] is still in the deck.
+
+    Pass seed (or an existing random.Random as rng) for a reproducible order.
+    """
+
+    def __init__(self, seed=None, rng=None):
+        if rng is None:
+            rng = random.Random(seed) if seed is not None else random
+        self.order = shuffled_codes(rng)
+        self.pos = 0
+        self.mask = FULL_MASK
+
+    @classmethod
+    def from_order(cls, order, pos):
+        deck = cls.__new__(cls)
+        deck.order = list(order)
+        deck.pos = pos
+        deck.mask = 0
+        for code in deck.order[pos:]:
+            deck.mask |= 1 << code
+        return deck
+
+    @property
+    def cards(self):
+        return [CARDS[code] for code in self.order[self.pos:]]
+
+    def __len__(self):
+        return 52 - self.pos
 
     def draw(self, card=None):
         if card is None:
-            if len(self.cards) > 0:
-                return self.cards.pop(0)
+            if self.pos < 52:
+                card = CARDS[self.order[self.pos]]
+                self.pos += 1
+                self.mask ^= card.bit
+                return card
             else:
                 return None
-        return self.cards.remove(card)
+        if not self.mask & card.bit:
+            raise ValueError(f'{card} is not in the deck')
+        # swap the requested card under the cursor, then draw it
+        idx = self.order.index(card.code, self.pos)
+        self.order[idx] = self.order[self.pos]
+        self.order[self.pos] = card.code
+        self.pos += 1
+        self.mask ^= card.bit
+        return card
+
+ALL_CODES = list(range(52))
+FACTORIAL_52 = math.factorial(52)
+
+def shuffled_codes(rng):
+    """
+    returns a uniformly shuffled copy of ALL_CODES
+
+    One getrandbits call (rejection sampled below 52!) supplies every swap of
+    the Fisher-Yates shuffle, which is about twice as fast as rng.shuffle's
+    per-element calls.
+    """
+    r = rng.getrandbits(FACTORIAL_52.bit_length())
+    while r >= FACTORIAL_52:
+        r = rng.getrandbits(FACTORIAL_52.bit_length())
+    order = ALL_CODES.copy()
+    for n in range(51, 0, -1):
+        r, j = divmod(r, n + 1)
+        order[n], order[j] = order[j], order[n]
+    return order
 
 class GameState:
-
-    def __init__(self):
-        self.deck = Deck()
+    # re-arbitrate every pile after every move and assert the incremental verdicts
+    # and the live pool match a full recompute
+    check_incremental = False
+
+    def __init__(self, seed=None, rng=None, cache=None):
+        self.deck = Deck(seed, rng)
+        # optional solver.CompletionCache, usually shared between games
+        self.cache = cache
         self.p1_hand = Hand()
         self.p2_hand = Hand()
         self.is_p1_turn = True
         self.piles = [Pile() for i in range(5)]
 
-        print('Deck at beginning is:', self.deck.cards)
+        if deck_log.isEnabledFor(logging.DEBUG):
+            deck_log.debug('Deck at beginning is: %s', self.deck.cards)
 
         self.up_card = self.deck.draw()
         for i in range(5):
@@ -399,10 +326,64 @@ class GameState:
         
         self.last_update_p1 = None
         self.last_update_p2 = None
+        # number of moves played; each update carries the seq it brings the game to
+        self.seq = 0
         self.over = False
         self.winner = 0
+        # cards not yet on a pile; shared by every arbitration
+        self.pool_mask = FULL_MASK
+        # per pile, the pool cards its verdict depends on (None until first arbitrated)
+        self.pile_deps = [None] * 5
 
     def player_act(self, card, pile_idx:int, take_upcard:bool, is_p1: bool):
+        drawn_card = self.move(card, pile_idx, take_upcard, is_p1)
+
+        # Only the played card leaves the pool, so a pile needs re-arbitrating
+        # when it was just played on or when its verdict leaned on that card.
+        if self.check_incremental:
+            assert self.pool_mask == self.available_mask(), 'live pool out of sync'
+        verdicts = []
+        verdict_updates = {}
+        for i in range(5):
+            deps = self.pile_deps[i]
+            if deps is None or deps & card.bit or (i == pile_idx and self.piles[i].verdict not in (1, -1)):
+                verdict, self.pile_deps[i] = self._arbitrate(i, self.pool_mask)
+            else:
+                verdict = self.piles[i].verdict
+            if self.check_incremental:
+                assert verdict == self.arbitrate(i), f'incremental verdict for pile {i} is stale'
+            if self.piles[i].verdict != verdict:
+                self.piles[i].verdict = verdict
+                verdict_updates[i] = verdict
+            verdicts.append(verdict)
+        game_verdict = arbitrate_game(verdicts, is_p1)
+        if game_verdict != -2:
+            verdict_updates[-1] = game_verdict
+            self.over = True
+            self.winner = game_verdict
+
+        # a delta against the previous seq: the card played onto one side of one
+        # pile, the new up card and the verdicts that changed; the mover's copy
+        # also names the card that replaced the played one in their hand
+        shared_update = {
+            'seq': self.seq,
+            'player': 1 if is_p1 else 2,
+            'pile_idx': pile_idx,
+            'card': card.__repr__(),
+            'up_card': self.up_card.__repr__(),
+            'verdict_updates': verdict_updates,
+        }
+        mover_update = dict(shared_update, add_card=drawn_card.__repr__())
+        if is_p1:
+            self.last_update_p1, self.last_update_p2 = mover_update, shared_update
+        else:
+            self.last_update_p1, self.last_update_p2 = shared_update, mover_update
+
+    def move(self, card, pile_idx, take_upcard, is_p1):
+        """
+        checks and applies a move to the hands, piles and deck without judging
+        any pile; returns the card drawn into the mover's hand
+        """
         if self.over:
             raise IllegalPlayError('Illegal play: game is over')
         if is_p1 != self.is_p1_turn:
@@ -411,17 +392,22 @@ class GameState:
         card_idx = hand.idx_of(card)
         if card_idx < 0:
             raise IllegalPlayError("Illegal play: don't have card")
-        
+        if not 0 <= pile_idx < 5:
+            raise IllegalPlayError('No such pile')
+        if len(self.piles[pile_idx].p1_pile if is_p1 else self.piles[pile_idx].p2_pile) >= 5:
+            raise IllegalPlayError('Pile is full')
+        if take_upcard and self.up_card is None:
+            raise IllegalPlayError('No up card to take')
+        if not take_upcard and len(self.deck) == 0:
+            raise IllegalPlayError('Tried to draw from empty pile')
+
         hand.remove_idx(card_idx)
 
         if is_p1:
-            if len(self.piles[pile_idx].p1_pile) >= 5:
-                raise IllegalPlayError('Pile is full')
             self.piles[pile_idx].p1_play(card)
         else:
-            if len(self.piles[pile_idx].p2_pile) >= 5:
-                raise IllegalPlayError('Pile is full')
             self.piles[pile_idx].p2_play(card)
+        self.pool_mask ^= card.bit
 
         drawn_card = None
         if take_upcard:
@@ -429,41 +415,102 @@ class GameState:
             self.up_card = self.deck.draw()
         else:
             drawn_card = self.deck.draw()
-            if drawn_card is None:
-                raise IllegalPlayError('Tried to draw from empty pile')
         hand.add_card(drawn_card)
 
         self.is_p1_turn = not self.is_p1_turn
+        self.seq += 1
+        return drawn_card
 
+    def rejudge(self):
+        """
+        arbitrates every pile and the game from scratch, as after a run of
+        unjudged moves; verdicts only ever settle, so this matches judging
+        move by move
+        """
         verdicts = []
-        verdict_updates = {}
         for i in range(5):
-            verdict = self.arbitrate(i)
-            if self.piles[i].verdict != verdict:
-                self.piles[i].verdict = verdict
-                verdict_updates[i] = verdict
-            verdicts.append(verdict)
-        game_verdict = arbitrate_game(verdicts)
-        if game_verdict > 0:
-            verdict_updates[-1] = game_verdict
+            self.piles[i].verdict, self.pile_deps[i] = self._arbitrate(i, self.pool_mask)
+            verdicts.append(self.piles[i].verdict)
+        # the turn has passed on from whoever made the last move
+        game_verdict = arbitrate_game(verdicts, not self.is_p1_turn)
+        if game_verdict != -2:
             self.over = True
             self.winner = game_verdict
-        
-        shared_update = {
-            'verdict_updates': verdict_updates,
-            'up_card': self.up_card.__repr__(),
-            'pile_idx': pile_idx,
-            'pile': self.piles[pile_idx].json(),
-        }
-        self.last_update_p1 = shared_update.copy()
-        self.last_update_p2 = shared_update.copy()
-        if is_p1:
-            self.last_update_p1['remove_card'] = card.__repr__()
-            self.last_update_p1['add_card'] = drawn_card.__repr__()
-        else:
-            self.last_update_p2['remove_card'] = card.__repr__()
-            self.last_update_p2['add_card'] = drawn_card.__repr__()
     
+    def pack(self):
+        """
+        returns the state as a STATE_RECORD; the cache and last updates are left out
+        """
+        pile_codes = b''.join(_codes(pile.p1_pile) + _codes(pile.p2_pile) for pile in self.piles)
+        return STATE_RECORD.pack(
+            self.is_p1_turn | self.over << 1, self.winner, self.seq, self.deck.pos,
+            NO_CARD if self.up_card is None else self.up_card.code, bytes(self.deck.order),
+            _codes(self.p1_hand.cards), _codes(self.p2_hand.cards), *[pile.verdict for pile in self.piles], pile_codes)
+
+    @classmethod
+    def unpack(cls, data, cache=None):
+        """
+        returns the GameState packed into data by pack()
+        """
+        flags, winner, seq, pos, up_card, order, p1_hand, p2_hand, *verdicts, pile_codes = STATE_RECORD.unpack(data)
+        state = cls.__new__(cls)
+        state.deck = Deck.from_order(order, pos)
+        state.cache = cache
+        state.p1_hand = Hand(_cards(p1_hand))
+        state.p2_hand = Hand(_cards(p2_hand))
+        state.is_p1_turn = bool(flags & 1)
+        state.piles = []
+        for i in range(5):
+            pile = Pile()
+            for card in _cards(pile_codes[10 * i:10 * i + 5]):
+                pile.p1_play(card)
+            for card in _cards(pile_codes[10 * i + 5:10 * i + 10]):
+                pile.p2_play(card)
+            pile.verdict = verdicts[i]
+            state.piles.append(pile)
+        state.up_card = None if up_card == NO_CARD else CARDS[up_card]
+        state.last_update_p1 = None
+        state.last_update_p2 = None
+        state.seq = seq
+        state.over = bool(flags & 2)
+        state.winner = winner
+        state.pool_mask = state.available_mask()
+        # every pile gets arbitrated afresh on the next move
+        state.pile_deps = [None] * 5
+        return state
+
+    def __getstate__(self):
+        # the shared cache stays behind when a state is pickled to a worker
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def legal_moves(self):
+        """
+        returns every (card, pile_idx, take_upcard) the player to move may play
+        """
+        if self.over:
+            return []
+        hand = self.p1_hand if self.is_p1_turn else self.p2_hand
+        draws = []
+        if self.up_card is not None:
+            draws.append(True)
+        if len(self.deck) > 0:
+            draws.append(False)
+        open_piles = [i for i in range(5)
+                      if len(self.piles[i].p1_pile if self.is_p1_turn else self.piles[i].p2_pile) < 5]
+        return [(card, pile_idx, take_upcard) for card in hand.cards for pile_idx in open_piles for take_upcard in draws]
+
+    def available_mask(self):
+        """
+        recomputes the mask of cards not yet on a pile from the deck, both hands
+        and the up card; self.pool_mask is the live copy of this
+        """
+        pool_mask = self.deck.mask | self.p1_hand.mask | self.p2_hand.mask
+        if self.up_card is not None:
+            pool_mask |= self.up_card.bit
+        return pool_mask
+
     def arbitrate(self, pile_idx):
         """
         return -2 if non deterministic
@@ -471,23 +518,31 @@ class GameState:
         return -1 if p2_pile wins
         return 0 if tie
         """
+        return self._arbitrate(pile_idx, self.pool_mask)[0]
 
-        if len(self.piles[pile_idx].p1_pile) != 5 and len(self.piles[pile_idx].p2_pile) != 5:
-            return -2
-
-        hand1 = Hand(self.piles[pile_idx].p1_pile)
-        hand2 = Hand(self.piles[pile_idx].p2_pile)
-        available_cards = self.deck.cards
-        available_cards += self.p1_hand.cards
-        available_cards += self.p2_hand.cards
-        available_cards = set(available_cards)
-        best_hand1 = Hand(hand1.greedy_best_hand(available_cards))
-        best_hand2 = Hand(hand2.greedy_best_hand(available_cards))
-        print('Arbitrate:')
-        print(best_hand1)
-        print(best_hand2)
-        result = best_hand1.compare(best_hand2)
-        return result if (result == 1 and len(hand1.cards) == 5) or (result == -1 and len(hand2.cards)==5) else -2
+    def _arbitrate(self, pile_idx, pool_mask):
+        """
+        returns (verdict, deps) where deps is the mask of pool cards the verdict
+        relies on; it cannot change until one of them leaves the pool or the
+        pile itself is played on
+        """
+        pile = self.piles[pile_idx]
+        if len(pile.p1_pile) != 5 and len(pile.p2_pile) != 5:
+            return -2, 0
+
+        # The pool only ever shrinks, so an incomplete pile's best completion
+        # stays optimal for as long as all of its cards remain available.
+        best_completion = solver.best_completion if self.cache is None else self.cache.best_completion
+        strength1, best_mask1 = best_completion(pile.p1_mask, pool_mask)
+        strength2, best_mask2 = best_completion(pile.p2_mask, pool_mask)
+        if arbitrate_log.isEnabledFor(logging.DEBUG):
+            arbitrate_log.debug('Arbitrate: %s %s', mask_to_cards(best_mask1), mask_to_cards(best_mask2))
+        deps = (best_mask1 & ~pile.p1_mask) | (best_mask2 & ~pile.p2_mask)
+        if strength1 > strength2 and len(pile.p1_pile) == 5:
+            return 1, 0
+        if strength1 < strength2 and len(pile.p2_pile) == 5:
+            return -1, 0
+        return -2, deps
 
     def __repr__(self) -> str:
         return f"""
@@ -513,6 +568,7 @@ class GameState:
             'up_card': self.up_card.__repr__(),
             'is_my_turn': self.is_p1_turn,
             'player': 1,
+            'seq': self.seq,
         }
         for idx in range(5):
             result[f'pile{idx}'] = self.piles[idx].json() 
@@ -524,11 +580,29 @@ class GameState:
             'up_card': self.up_card.__repr__(),
             'is_my_turn': not self.is_p1_turn,
             'player': 2,
-        } 
+            'seq': self.seq,
+        }
         for idx in range(5):
             result[f'pile{idx}'] = self.piles[idx].json() 
         return result
       
+    def public_json(self):
+        """
+        returns the spectators' view: the up card and piles, no hands
+        """
+        result = {
+            'up_card': self.up_card.__repr__(),
+            'is_p1_turn': self.is_p1_turn,
+            'seq': self.seq,
+        }
+        for idx in range(5):
+            result[f'pile{idx}'] = self.piles[idx].json()
+        return result
+
+    def get_last_update_public(self):
+        # the copy sent to the player who did not move names no drawn card
+        return self.last_update_p2 if 'add_card' in self.last_update_p1 else self.last_update_p1
+
     def get_last_update_p1(self):
         return self.last_update_p1
 
@@ -0,0 +1,353 @@
+"""
+Websocket clients that play complete games against a running server.
+
+Each simulated player only knows what the server tells it (its hand, the up
+card, the piles and whose turn it is) and plays a random legal looking move
+on its turn, after think_time seconds. Games start as fast as concurrency
+allows or, with --rate, as Poisson arrivals of that many games a second
+(still at most concurrency at once). --local starts a server_main on
+127.0.0.1 for the run and stops it after.
+
+The summary is one JSON object on stdout: the settings, the commit checked
+out, connections and moves per second, connect, action and whole game
+latency percentiles, and errors per request, so runs can be compared across
+commits.
+
+usage: python loadgen.py --uri ws://127.0.0.1:8000 --games 100 --concurrency 20
+       python loadgen.py --local --clients 2000 --concurrency 500 --rate 200 --think-time 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import websockets
+import websockets.exceptions
+import protocol
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Player:
+
+    def __init__(self, websocket, rng, wire='json'):
+        self.websocket = websocket
+        self.rng = rng
+        self.encode = protocol.encode if wire == 'binary' else protocol.json_dumps
+        self.inbox = asyncio.Queue()
+        self.reader = asyncio.create_task(self.read_loop())
+        self.player_id = None
+        self.token = None
+        self.game_id = None
+        self.side = None
+        self.hand = []
+        self.up_card = None
+        self.pile_sizes = [0] * 5
+        self.my_turn = False
+        self.seq = 0
+        self.resyncs = 0
+        self.over = False
+        self.latencies = []
+        self.connect_latency = None
+        self.requests = 0
+        self.errors = {}
+
+    @classmethod
+    async def connect(cls, uri, rng, wire='json'):
+        start = time.perf_counter()
+        player = cls(await websockets.connect(uri), rng, wire)
+        ack, _ = await player.request({'type': 'connect'})
+        # the websocket handshake included
+        player.connect_latency = time.perf_counter() - start
+        player.player_id = ack['player_id']
+        player.token = ack['token']
+        return player
+
+    async def reconnect(self, uri):
+        """
+        drops the connection and reattaches to the same game on a new one,
+        asking for the updates missed since the last seq applied
+        """
+        await self.close()
+        self.websocket = await websockets.connect(uri)
+        self.inbox = asyncio.Queue()
+        self.reader = asyncio.create_task(self.read_loop())
+        ack, _ = await self.request({'type': 'connect', 'body': {
+            'player_id': self.player_id, 'token': self.token, 'game_id': self.game_id, 'from_seq': self.seq}})
+        return ack
+
+    async def read_loop(self):
+        try:
+            async for message in self.websocket:
+                self.inbox.put_nowait(protocol.decode(message) if isinstance(message, bytes) else protocol.json_loads(message))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        self.inbox.put_nowait(None)
+
+    def apply(self, message):
+        """
+        returns False for an update that skips a seq, which needs a resync
+        """
+        if message['type'] == 'send_game_state':
+            state = message['game_state']
+            self.side = state['player']
+            self.hand = list(state['hand'])
+            self.up_card = state['up_card']
+            self.pile_sizes = [len(state[f'pile{i}']['p1' if self.side == 1 else 'p2']) for i in range(5)]
+            self.my_turn = state['is_my_turn']
+            self.seq = state['seq']
+        elif message['type'] == 'send_game_update':
+            update = message['update']
+            if update['seq'] <= self.seq:
+                return True
+            if update['seq'] != self.seq + 1:
+                return False
+            self.seq = update['seq']
+            if update['player'] == self.side:
+                self.pile_sizes[update['pile_idx']] += 1
+            # only the mover's own update carries the card that replaced the played one
+            if 'add_card' in update:
+                self.hand.remove(update['card'])
+                self.hand.append(update['add_card'])
+            self.up_card = update['up_card']
+            self.my_turn = 'add_card' not in update
+            if '-1' in update['verdict_updates']:
+                self.over = True
+        return True
+
+    async def next_message(self):
+        message = await self.inbox.get()
+        if message is None:
+            self.over = True
+            raise ConnectionError('server closed the connection')
+        if not self.apply(message):
+            self.resyncs += 1
+            await self.websocket.send(self.encode({'type': 'resync', 'body': {
+                'player_id': self.player_id, 'game_id': self.game_id, 'from_seq': self.seq}}))
+        return message
+
+    async def request(self, req):
+        """
+        sends a request, returns (ack or err reply, seconds until it arrived)
+        """
+        start = time.perf_counter()
+        self.requests += 1
+        await self.websocket.send(self.encode(req))
+        while True:
+            message = await self.next_message()
+            if message['type'] == 'ack_' + req['type'] or message['type'].startswith('err'):
+                elapsed = time.perf_counter() - start
+                if message['type'].startswith('err'):
+                    self.errors[message['type']] = self.errors.get(message['type'], 0) + 1
+                return message, elapsed
+
+    async def wait_for_start(self):
+        while self.side is None:
+            await self.next_message()
+
+    async def take_turn(self):
+        """
+        plays one move, trying the other draw source if the first is refused;
+        returns False if no move was accepted
+        """
+        open_piles = [i for i in range(5) if self.pile_sizes[i] < 5]
+        if not open_piles or not self.hand:
+            return False
+        card = self.rng.choice(self.hand)
+        pile_idx = self.rng.choice(open_piles)
+        draws = [True, False] if self.up_card not in (None, 'None') else [False]
+        self.rng.shuffle(draws)
+        for take_upcard in draws:
+            ack, elapsed = await self.request({'type': 'action', 'body': {
+                'player_id': self.player_id, 'game_id': self.game_id,
+                'card': card, 'pile': pile_idx, 'take_upcard': take_upcard}})
+            if ack['type'] == 'ack_action':
+                self.latencies.append(elapsed)
+                # the update for this move follows the ack
+                while self.my_turn and not self.over:
+                    await self.next_message()
+                return True
+        return False
+
+    async def play(self, think_time=0.0):
+        await self.wait_for_start()
+        while not self.over:
+            if not self.my_turn:
+                await self.next_message()
+                continue
+            if think_time:
+                await asyncio.sleep(think_time)
+            if not await self.take_turn():
+                break
+
+    async def close(self):
+        await self.websocket.close()
+        self.reader.cancel()
+
+
+async def play_game(uri, rng, think_time=0.0, wire='json'):
+    """
+    connects two players, plays one game between them, returns both players
+    """
+    player1 = await Player.connect(uri, rng, wire)
+    try:
+        player2 = await Player.connect(uri, rng, wire)
+    except BaseException:
+        await player1.close()
+        raise
+    try:
+        ack, _ = await player1.request({'type': 'new_game', 'body': {'player_id': player1.player_id}})
+        player1.game_id = player2.game_id = ack['game_id']
+        await player2.request({'type': 'join_game', 'body': {'player_id': player2.player_id, 'game_id': ack['game_id']}})
+        # whoever is stuck first ends the game for both
+        done, pending = await asyncio.wait([asyncio.ensure_future(player1.play(think_time)),
+                                            asyncio.ensure_future(player2.play(think_time))],
+                                           return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+    finally:
+        await player1.close()
+        await player2.close()
+    return player1, player2
+
+
+def latency_ms(latencies):
+    ordered = sorted(latencies)
+    return {
+        'p50': percentile(ordered, 50) * 1e3,
+        'p90': percentile(ordered, 90) * 1e3,
+        'p99': percentile(ordered, 99) * 1e3,
+        'max': (ordered[-1] if ordered else 0.0) * 1e3,
+    }
+
+
+async def run(uri, games, concurrency, seed=0, think_time=0.0, wire='json', rate=None):
+    """
+    plays games games, concurrency at a time, and returns a summary dict;
+    rate starts them as Poisson arrivals of rate games a second instead of all at once
+    """
+    rng = random.Random(seed)
+    semaphore = asyncio.Semaphore(concurrency)
+    players = []
+    game_latencies = []
+    failures = []
+
+    async def one_game(game_rng):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                players.extend(await play_game(uri, game_rng, think_time, wire))
+            except (OSError, ConnectionError, websockets.exceptions.WebSocketException) as e:
+                failures.append(repr(e))
+                return
+            game_latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if rate:
+        tasks = []
+        for _ in range(games):
+            tasks.append(asyncio.ensure_future(one_game(random.Random(rng.random()))))
+            await asyncio.sleep(rng.expovariate(rate))
+        await asyncio.gather(*tasks)
+    else:
+        await asyncio.gather(*[one_game(random.Random(rng.random())) for _ in range(games)])
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for player in players for latency in player.latencies]
+    requests = sum(player.requests for player in players)
+    errors = {}
+    for player in players:
+        for err_type, count in player.errors.items():
+            errors[err_type] = errors.get(err_type, 0) + count
+    return {
+        'games': len(players) // 2,
+        'failed_games': len(failures),
+        'failed_game_rate': len(failures) / games if games else 0.0,
+        'connections': len(players),
+        'moves': len(latencies),
+        'requests': requests,
+        'seconds': elapsed,
+        'connections_per_sec': len(players) / elapsed,
+        'games_per_sec': len(players) / 2 / elapsed,
+        'moves_per_sec': len(latencies) / elapsed,
+        'connect_latency_ms': latency_ms([player.connect_latency for player in players]),
+        'action_latency_ms': latency_ms(latencies),
+        'game_latency_ms': latency_ms(game_latencies),
+        'errors': errors,
+        'error_rate': sum(errors.values()) / requests if requests else 0.0,
+        'failures': sorted(set(failures))[:10],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def start_local_server(port, shards=1, timeout=10.0):
+    """
+    starts server_main on 127.0.0.1:port in a child process, returns it once
+    it accepts connections
+    """
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, 'server_main.py', '--host', '127.0.0.1', '--port', str(port), '--shards', str(shards),
+        '--log-level', 'WARNING', cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.monotonic() + timeout
+    # the router answers before its shards do (see router.shard_port)
+    ports = [port] + ([port + 1 + shard_index for shard_index in range(shards)] if shards > 1 else [])
+    for probe_port in ports:
+        while True:
+            try:
+                websocket = await websockets.connect(f'ws://127.0.0.1:{probe_port}')
+                await websocket.close()
+                break
+            except OSError:
+                if server.returncode is not None or time.monotonic() > deadline:
+                    server.kill()
+                    raise
+                await asyncio.sleep(0.1)
+    return server
+
+
+async def run_local(port, shards, games, concurrency, seed=0, think_time=0.0, wire='json', rate=None):
+    server = await start_local_server(port, shards)
+    try:
+        return await run(f'ws://127.0.0.1:{port}', games, concurrency, seed, think_time, wire, rate)
+    finally:
+        server.terminate()
+        await server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', default='ws://127.0.0.1:8000')
+    parser.add_argument('--local', action='store_true', help='start a server_main on 127.0.0.1 --port for the run')
+    parser.add_argument('--port', type=int, default=8765, help='port of the --local server')
+    parser.add_argument('--shards', type=int, default=1, help='shards of the --local server')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--clients', type=int, help='simulated clients, two per game; overrides --games')
+    parser.add_argument('--concurrency', type=int, default=20, help='games in play at once')
+    parser.add_argument('--rate', type=float, help='games started per second, Poisson arrivals')
+    parser.add_argument('--think-time', type=float, default=0.0, help='seconds a player waits before each move')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--wire', choices=protocol.PROTOCOLS, default='json')
+    args = parser.parse_args()
+    games = args.clients // 2 if args.clients else args.games
+    if args.local:
+        summary = asyncio.run(run_local(args.port, args.shards, games, args.concurrency, args.seed, args.think_time,
+                                        args.wire, args.rate))
+    else:
+        summary = asyncio.run(run(args.uri, games, args.concurrency, args.seed, args.think_time, args.wire, args.rate))
+    settings = {name: getattr(args, name) for name in ('concurrency', 'rate', 'think_time', 'seed', 'wire')}
+    settings.update(games=games, server='local' if args.local else args.uri, shards=args.shards if args.local else None)
+    print(json.dumps(dict(settings=settings, commit=git_commit(), **summary)))
@@ -0,0 +1,138 @@
+"""
+Leveled logging for the server and the game logic, on the standard logging
+module.
+
+Each category is a logger under 'poker' (get('server.request') is
+'poker.server.request'), so its level can be switched on its own:
+configure(categories={'server.request': 'DEBUG'}) or, on the command line,
+--log server.request=DEBUG. Records go through a bounded queue to a
+background thread that formats and writes them, so nothing that logs waits
+on the terminal; when the writer falls behind, records are dropped and
+counted rather than queued without limit. Debug records of the categories in
+SAMPLE_RATES are sampled, one kept in every N.
+
+Hot paths pass arguments for lazy %-formatting and guard anything costly to
+compute with isEnabledFor, so at the default INFO level a debug call does a
+level check and nothing else.
+
+    game.deck        the deck order at the start of every game     DEBUG
+    game.arbitrate   the best completions of both sides of a pile  DEBUG
+    server.request   every request                                 DEBUG
+    server.ack       every ack                                     DEBUG
+    server.state     the game states sent when a game starts       DEBUG
+    server.client    clients leaving                               INFO
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+ROOT = 'poker'
+LEVEL = logging.INFO
+# category -> level, on top of LEVEL
+CATEGORY_LEVELS = {}
+# category -> keep one debug record in this many
+SAMPLE_RATES = {'game.arbitrate': 100, 'server.request': 100, 'server.ack': 100}
+QUEUE_SIZE = 10000
+FORMAT = '%(asctime)s %(levelname)s %(name)s %(message)s'
+
+listener = None
+queue_handler = None
+
+
+def get(category):
+    return logging.getLogger(f'{ROOT}.{category}')
+
+
+class Sampler(logging.Filter):
+    """
+    passes the first debug record in every rate, and every record above debug
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.seen = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        keep = self.seen % self.rate == 0
+        self.seen += 1
+        return keep
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    hands records to the writer thread unformatted, so callers must not
+    mutate what they log; drops them when the queue is full
+    """
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure(level=None, categories=None, stream=None, sample_rates=None, queue_size=QUEUE_SIZE):
+    """
+    sets the levels and sampling of the categories and (re)starts the writer
+    thread, writing to stream (stderr by default); arguments left as None keep
+    the module settings
+    """
+    global LEVEL, listener, queue_handler
+    stop()
+    if level is not None:
+        LEVEL = level
+    if categories:
+        CATEGORY_LEVELS.update(categories)
+    if sample_rates is not None:
+        SAMPLE_RATES.update(sample_rates)
+    root = logging.getLogger(ROOT)
+    root.setLevel(LEVEL)
+    root.propagate = False
+    for category, category_level in CATEGORY_LEVELS.items():
+        get(category).setLevel(category_level)
+    for category, rate in SAMPLE_RATES.items():
+        logger = get(category)
+        for old in [f for f in logger.filters if isinstance(f, Sampler)]:
+            logger.removeFilter(old)
+        if rate > 1:
+            logger.addFilter(Sampler(rate))
+    writer = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    writer.setFormatter(logging.Formatter(FORMAT))
+    record_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(record_queue)
+    root.handlers[:] = [queue_handler]
+    listener = logging.handlers.QueueListener(record_queue, writer)
+    listener.start()
+
+
+def stop():
+    """
+    writes out whatever is queued and stops the writer thread
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def parse_category(text):
+    """
+    returns (category, level) for a category=LEVEL command line argument
+    """
+    category, _, level = text.partition('=')
+    return category, level.upper() or 'DEBUG'
+
+
+atexit.register(stop)
@@ -1,11 +1,9 @@
 import game_logic
-import utils
 
 def parse_card(card_string):
-    assert len(card_string) == 2
-    assert card_string[0] in utils.ALL_RANKS
-    assert card_string[1] in utils.ALL_SUITS
-    return game_logic.Card(card_string[0], card_string[1])
+    card = game_logic.parse_card(card_string)
+    assert card is not None
+    return card
 
 
 # Caller can 
@@ -0,0 +1,147 @@
+"""
+Server metrics in the Prometheus text format, served over plain HTTP on a
+local port (GET /metrics).
+
+Histograms keep cumulative-free bucket counts and are only summed up when
+scraped, so observing costs a bisect and two additions. Gauges are read from
+a callback at scrape time rather than kept up to date as things change.
+
+    server_request_seconds{type}       handle_client_request, by request type
+    server_after_ack_seconds{type}     the ack plus handle_after_ack, by request type
+    server_send_to_game_seconds        queueing one update for both players
+    server_errors_total{type}          err_* acks, by type
+    server_event_loop_lag_seconds      how late a LAG_INTERVAL sleep wakes up
+    server_<gauge>                     each entry of the gauges callback
+"""
+import asyncio
+import bisect
+import time
+
+# 50us to 1s, roughly three buckets per decade
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LAG_INTERVAL = 0.25
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # one count per bucket plus +Inf, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def lines(self, name, labels=''):
+        """
+        returns the exposition lines of this histogram
+        """
+        sep = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.total}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+
+class Metrics:
+    """
+    gauges is a callable returning name -> number, read at every scrape.
+    """
+
+    def __init__(self, gauges=None):
+        self.gauges = gauges
+        # request type -> Histogram
+        self.request_seconds = {}
+        self.after_ack_seconds = {}
+        self.send_to_game_seconds = Histogram()
+        # err_* type -> count
+        self.errors = {}
+        self.loop_lag = Histogram()
+        # ack type -> (request histogram, after ack histogram), so a request
+        # costs one lookup
+        self.by_ack = {}
+
+    def observe_request(self, ack_type, request_seconds, after_ack_seconds):
+        """
+        records one request, named after its ack: ack_join_game and
+        err_join_game both count as join_game
+        """
+        histograms = self.by_ack.get(ack_type)
+        if histograms is None:
+            histograms = self.by_ack[ack_type] = self.request_histograms(ack_type)
+        histograms[0].observe(request_seconds)
+        histograms[1].observe(after_ack_seconds)
+        if ack_type[:3] == 'err':
+            self.errors[ack_type] = self.errors.get(ack_type, 0) + 1
+
+    def request_histograms(self, ack_type):
+        req_type = ack_type[4:] or 'unknown'
+        if req_type not in self.request_seconds:
+            self.request_seconds[req_type] = Histogram()
+            self.after_ack_seconds[req_type] = Histogram()
+        return self.request_seconds[req_type], self.after_ack_seconds[req_type]
+
+    def render(self):
+        """
+        returns every metric in the Prometheus text format
+        """
+        lines = []
+        for name, histograms, doc in (
+                ('server_request_seconds', self.request_seconds, 'time in handle_client_request'),
+                ('server_after_ack_seconds', self.after_ack_seconds, 'time sending the ack and in handle_after_ack')):
+            lines += [f'# HELP {name} {doc}', f'# TYPE {name} histogram']
+            for req_type, histogram in sorted(histograms.items()):
+                lines += histogram.lines(name, f'type="{req_type}"')
+        lines += ['# HELP server_send_to_game_seconds time queueing an update for both players',
+                  '# TYPE server_send_to_game_seconds histogram']
+        lines += self.send_to_game_seconds.lines('server_send_to_game_seconds')
+        lines += ['# HELP server_errors_total error acks by type', '# TYPE server_errors_total counter']
+        lines += [f'server_errors_total{{type="{err_type}"}} {count}' for err_type, count in sorted(self.errors.items())]
+        lines += ['# HELP server_event_loop_lag_seconds how late the event loop wakes a sleeping task',
+                  '# TYPE server_event_loop_lag_seconds histogram']
+        lines += self.loop_lag.lines('server_event_loop_lag_seconds')
+        for name, value in (self.gauges() if self.gauges is not None else {}).items():
+            lines += [f'# TYPE server_{name} gauge', f'server_{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    async def lag_loop(self, interval=LAG_INTERVAL):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(time.perf_counter() - start - interval, 0.0))
+
+    async def handle_scrape(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # the headers are of no interest
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        """
+        starts the event loop lag probe and the scrape endpoint; returns the asyncio server
+        """
+        asyncio.ensure_future(self.lag_loop())
+        return await asyncio.start_server(self.handle_scrape, host, port)
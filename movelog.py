@@ -0,0 +1,120 @@
+"""
+Append-only move logs. A game is its deck seed plus the moves played, two
+bytes per move, and that is enough to rebuild its GameState exactly.
+
+A move packs card code | pile_idx << 6 | take_upcard << 9; whose move it was
+follows from the turn order. A log file is a run of records, one per game:
+
+    game_id:I seed:Q count:H verdicts:5b winner:b   then count moves of H
+
+verdicts and winner are what the server had judged when the record was
+written, so replaying a file checks arbitration against them:
+
+    python movelog.py check games.log [--full]
+"""
+import argparse
+import struct
+import sys
+from array import array
+import game_logic
+
+RECORD = struct.Struct('<IQH5bb')
+
+
+def pack_move(card, pile_idx, take_upcard):
+    return card.code | pile_idx << 6 | take_upcard << 9
+
+
+def unpack_move(move):
+    return game_logic.CARDS[move & 63], move >> 6 & 7, bool(move >> 9 & 1)
+
+
+class MoveLog:
+
+    def __init__(self, seed, moves=b''):
+        self.seed = seed
+        self.moves = array('H')
+        self.moves.frombytes(moves)
+        if sys.byteorder == 'big':
+            self.moves.byteswap()
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __iter__(self):
+        return map(unpack_move, self.moves)
+
+    def append(self, card, pile_idx, take_upcard):
+        self.moves.append(pack_move(card, pile_idx, take_upcard))
+
+    def to_bytes(self):
+        if sys.byteorder == 'big':
+            moves = array('H', self.moves)
+            moves.byteswap()
+            return moves.tobytes()
+        return self.moves.tobytes()
+
+    def replay(self, upto=None, full=False, cache=None):
+        """
+        returns the GameState after the first upto moves (all by default)
+        The moves are applied unjudged and every pile arbitrated once at the
+        end, unless full is set, which judges each move like the server did.
+        """
+        state = game_logic.GameState(seed=self.seed, cache=cache)
+        moves = self.moves if upto is None else self.moves[:upto]
+        if full:
+            for move in moves:
+                card, pile_idx, take_upcard = unpack_move(move)
+                state.player_act(card, pile_idx, take_upcard, state.is_p1_turn)
+        elif moves:
+            for move in moves:
+                card, pile_idx, take_upcard = unpack_move(move)
+                state.move(card, pile_idx, take_upcard, state.is_p1_turn)
+            state.rejudge()
+        return state
+
+
+def write_record(f, game_id, log, verdicts, winner):
+    f.write(RECORD.pack(game_id, log.seed, len(log), *verdicts, winner) + log.to_bytes())
+
+
+def read_records(f):
+    """
+    yields (game_id, log, verdicts, winner) for every record in a log file
+    """
+    while True:
+        header = f.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        game_id, seed, count, *verdicts, winner = RECORD.unpack(header)
+        yield game_id, MoveLog(seed, f.read(2 * count)), verdicts, winner
+
+
+def check_file(path, full=False):
+    """
+    replays every game in a log file, returns (games, moves, mismatches) where
+    mismatches lists the game ids whose verdicts or winner came out differently
+    """
+    games = moves = 0
+    mismatches = []
+    with open(path, 'rb') as f:
+        for game_id, log, verdicts, winner in read_records(f):
+            state = log.replay(full=full)
+            games += 1
+            moves += len(log)
+            if len(log) and ([pile.verdict for pile in state.piles] != verdicts or state.winner != winner):
+                mismatches.append(game_id)
+    return games, moves, mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['check'])
+    parser.add_argument('path')
+    parser.add_argument('--full', action='store_true', help='judge every move instead of once per game')
+    args = parser.parse_args()
+    games, moves, mismatches = check_file(args.path, args.full)
+    print(f'{games} games, {moves} moves replayed, {len(mismatches)} mismatches')
+    if mismatches:
+        print('mismatched game ids:', ' '.join(map(str, mismatches[:50])))
+        sys.exit(1)
@@ -0,0 +1,265 @@
+"""
+Compact binary encoding of the websocket messages, sent as binary frames.
+
+A client opts in by sending its connect request as a binary frame, or as JSON
+with body {'protocol': 'binary'}; the server then answers and pushes in binary.
+Other clients keep talking JSON. encode/decode work on the same dicts the
+JSON path uses, and decode(encode(m)) == json.loads(json.dumps(m)). The JSON
+path goes through json_dumps/json_loads, which use orjson when it is
+installed and the standard json module otherwise.
+
+Every message starts with a one byte type tag. Integers are little endian,
+a card is its one byte code (NO_CARD for none or padding), a hand is 5 card
+bytes, and a pile is a signed verdict byte followed by 5 + 5 card bytes.
+
+    connect           [player_id:I token:8s [game_id:I from_seq:I]]   (to reconnect)
+    new_game          player_id:I
+    join_game         player_id:I game_id:I
+    action            player_id:I game_id:I card:B pile:B take_upcard:B
+    resync            player_id:I game_id:I from_seq:I
+    quick_match       player_id:I
+    cancel_match      player_id:I
+    spectate          player_id:I game_id:I
+    unspectate        player_id:I game_id:I
+    bot_game          player_id:I
+    ack_connect       player_id:I token:8s reattached:B [game_id:I from_seq:I]
+    ack_new_game      player_id:I game_id:I
+    ack_join_game     player_id:I game_id:I
+    ack_action        player_id:I game_id:I
+    ack_resync        player_id:I game_id:I from_seq:I
+    ack_quick_match   player_id:I [game_id:I]   (no game id: queued)
+    ack_cancel_match  player_id:I
+    ack_spectate      player_id:I game_id:I
+    ack_unspectate    player_id:I game_id:I
+    ack_bot_game      player_id:I game_id:I
+    err               kind:B message:utf8  (kind indexes ERR_TYPES)
+    game_start        [game_id:I]
+    send_game_state   seq:I player:B is_my_turn:B up_card:B hand:5B pile*5
+    send_public_state seq:I is_p1_turn:B up_card:B pile*5
+    send_game_update  seq:I player:B pile_idx:B card:B up_card:B add_card:B
+                      count:B (index:b verdict:b)*count
+"""
+import json
+import struct
+import game_logic
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PROTOCOLS = ('json', 'binary')
+
+NO_CARD = 0xFF
+TAGS = {
+    'connect': 1,
+    'new_game': 2,
+    'join_game': 3,
+    'action': 4,
+    'resync': 5,
+    'quick_match': 6,
+    'cancel_match': 7,
+    'spectate': 8,
+    'unspectate': 9,
+    'bot_game': 10,
+    'ack_connect': 16,
+    'ack_new_game': 17,
+    'ack_join_game': 18,
+    'ack_action': 19,
+    'err': 20,
+    'game_start': 21,
+    'send_game_state': 22,
+    'send_game_update': 23,
+    'ack_resync': 24,
+    'ack_quick_match': 25,
+    'ack_cancel_match': 26,
+    'ack_spectate': 27,
+    'ack_unspectate': 28,
+    'send_public_state': 29,
+    'ack_bot_game': 30,
+}
+TYPES = {tag: name for name, tag in TAGS.items()}
+ERR_TYPES = ['err', 'err_new_game', 'err_join_game', 'err_action', 'err_resync', 'err_quick_match',
+             'err_cancel_match', 'err_spectate', 'err_unspectate', 'err_bot_game']
+
+ID = struct.Struct('<I')
+TWO_IDS = struct.Struct('<II')
+PLAYER = struct.Struct('<I8s')
+ACK_CONNECT = struct.Struct('<I8sB')
+ACTION = struct.Struct('<IIBBB')
+RESYNC = struct.Struct('<III')
+PILE = struct.Struct('<b10B')
+STATE_HEAD = struct.Struct('<IBBB5B')
+PUBLIC_HEAD = struct.Struct('<IBB')
+UPDATE_HEAD = struct.Struct('<I6B')
+
+CARD_CODES = {name: card.code for name, card in zip(game_logic.CARD_NAMES, game_logic.CARDS)}
+CARD_CODES['None'] = NO_CARD
+CODE_NAMES = {code: name for name, code in CARD_CODES.items()}
+
+
+if orjson is not None:
+    def json_dumps(message):
+        # a str, so websockets still sends a text frame; int keys become strings as with json
+        return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    json_loads = orjson.loads
+else:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+
+def _cards(names, size=5):
+    codes = [CARD_CODES[name] for name in names]
+    return codes + [NO_CARD] * (size - len(codes))
+
+
+def _names(codes):
+    return [CODE_NAMES[code] for code in codes if code != NO_CARD]
+
+
+def _pack_pile(pile):
+    return PILE.pack(pile['verdict'], *_cards(pile['p1']), *_cards(pile['p2']))
+
+
+def _unpack_pile(data, offset):
+    fields = PILE.unpack_from(data, offset)
+    return {'p1': _names(fields[1:6]), 'p2': _names(fields[6:11]), 'verdict': fields[0]}
+
+
+def encode(message):
+    """
+    returns the binary frame for a request or server message dict
+    """
+    msg_type = message['type']
+    if msg_type.startswith('err'):
+        return bytes((TAGS['err'], ERR_TYPES.index(msg_type))) + message['message'].encode()
+    tag = bytes((TAGS[msg_type],))
+    body = message.get('body', message)
+    if msg_type in ('connect', 'ack_connect'):
+        frame = tag
+        if msg_type == 'ack_connect':
+            frame += ACK_CONNECT.pack(body['player_id'], bytes.fromhex(body['token']), body.get('reattached', False))
+        elif 'token' in body:
+            frame += PLAYER.pack(body['player_id'], bytes.fromhex(body['token']))
+        if 'game_id' in body:
+            frame += TWO_IDS.pack(body['game_id'], body['from_seq'])
+        return frame
+    if msg_type in ('new_game', 'quick_match', 'cancel_match', 'ack_cancel_match', 'bot_game'):
+        return tag + ID.pack(body['player_id'])
+    if msg_type == 'ack_quick_match':
+        return tag + ID.pack(body['player_id']) + (ID.pack(body['game_id']) if 'game_id' in body else b'')
+    if msg_type in ('join_game', 'ack_new_game', 'ack_join_game', 'ack_action', 'spectate', 'unspectate',
+                    'ack_spectate', 'ack_unspectate', 'ack_bot_game'):
+        return tag + TWO_IDS.pack(body['player_id'], body['game_id'])
+    if msg_type in ('resync', 'ack_resync'):
+        return tag + RESYNC.pack(body['player_id'], body['game_id'], body['from_seq'])
+    if msg_type == 'action':
+        return tag + ACTION.pack(body['player_id'], body['game_id'], CARD_CODES[body['card']],
+                                 int(body['pile']), bool(body['take_upcard']))
+    if msg_type == 'game_start':
+        return tag + (ID.pack(body['game_id']) if 'game_id' in body else b'')
+    if msg_type == 'send_game_state':
+        state = message['game_state']
+        return b''.join([tag, STATE_HEAD.pack(state['seq'], state['player'], state['is_my_turn'],
+                                              CARD_CODES[state['up_card']], *_cards(state['hand']))]
+                        + [_pack_pile(state[f'pile{idx}']) for idx in range(5)])
+    if msg_type == 'send_public_state':
+        state = message['game_state']
+        return b''.join([tag, PUBLIC_HEAD.pack(state['seq'], state['is_p1_turn'], CARD_CODES[state['up_card']])]
+                        + [_pack_pile(state[f'pile{idx}']) for idx in range(5)])
+    if msg_type == 'send_game_update':
+        update = message['update']
+        verdicts = update['verdict_updates']
+        return b''.join([
+            tag,
+            UPDATE_HEAD.pack(update['seq'], update['player'], update['pile_idx'], CARD_CODES[update['card']],
+                             CARD_CODES[update['up_card']], CARD_CODES[update.get('add_card', 'None')], len(verdicts)),
+            struct.pack(f'<{2 * len(verdicts)}b', *[v for item in verdicts.items() for v in map(int, item)]),
+        ])
+    raise ValueError(f'cannot encode message type {msg_type}')
+
+
+def decode(data):
+    """
+    returns the message dict for a binary frame, shaped like its JSON equivalent
+    """
+    msg_type = TYPES.get(data[0]) if data else None
+    if msg_type is None:
+        raise ValueError('unknown message tag')
+    if msg_type == 'err':
+        return {'type': ERR_TYPES[data[1]], 'message': data[2:].decode()}
+    if msg_type == 'connect':
+        if len(data) == 1:
+            return {'type': 'connect'}
+        player_id, token = PLAYER.unpack_from(data, 1)
+        body = {'player_id': player_id, 'token': token.hex()}
+        if len(data) > 1 + PLAYER.size:
+            body['game_id'], body['from_seq'] = TWO_IDS.unpack_from(data, 1 + PLAYER.size)
+        return {'type': 'connect', 'body': body}
+    if msg_type == 'ack_connect':
+        player_id, token, reattached = ACK_CONNECT.unpack_from(data, 1)
+        ack = {'type': msg_type, 'player_id': player_id, 'token': token.hex()}
+        if reattached:
+            ack['reattached'] = True
+        if len(data) > 1 + ACK_CONNECT.size:
+            ack['game_id'], ack['from_seq'] = TWO_IDS.unpack_from(data, 1 + ACK_CONNECT.size)
+        return ack
+    if msg_type in ('new_game', 'quick_match', 'cancel_match', 'bot_game'):
+        return {'type': msg_type, 'body': {'player_id': ID.unpack_from(data, 1)[0]}}
+    if msg_type == 'ack_cancel_match':
+        return {'type': msg_type, 'player_id': ID.unpack_from(data, 1)[0]}
+    if msg_type == 'ack_quick_match':
+        ack = {'type': msg_type, 'player_id': ID.unpack_from(data, 1)[0]}
+        if len(data) > 1 + ID.size:
+            ack['game_id'] = ID.unpack_from(data, 1 + ID.size)[0]
+        else:
+            ack['queued'] = True
+        return ack
+    if msg_type in ('join_game', 'spectate', 'unspectate'):
+        player_id, game_id = TWO_IDS.unpack_from(data, 1)
+        return {'type': msg_type, 'body': {'player_id': player_id, 'game_id': game_id}}
+    if msg_type == 'resync':
+        player_id, game_id, from_seq = RESYNC.unpack_from(data, 1)
+        return {'type': 'resync', 'body': {'player_id': player_id, 'game_id': game_id, 'from_seq': from_seq}}
+    if msg_type == 'ack_resync':
+        player_id, game_id, from_seq = RESYNC.unpack_from(data, 1)
+        return {'type': msg_type, 'player_id': player_id, 'game_id': game_id, 'from_seq': from_seq}
+    if msg_type == 'action':
+        player_id, game_id, card, pile_idx, take_upcard = ACTION.unpack_from(data, 1)
+        return {'type': 'action', 'body': {'player_id': player_id, 'game_id': game_id, 'card': CODE_NAMES[card],
+                                           'pile': pile_idx, 'take_upcard': bool(take_upcard)}}
+    if msg_type in ('ack_new_game', 'ack_join_game', 'ack_action', 'ack_spectate', 'ack_unspectate',
+                    'ack_bot_game'):
+        player_id, game_id = TWO_IDS.unpack_from(data, 1)
+        return {'type': msg_type, 'player_id': player_id, 'game_id': game_id}
+    if msg_type == 'game_start':
+        if len(data) > 1:
+            return {'type': msg_type, 'game_id': ID.unpack_from(data, 1)[0]}
+        return {'type': msg_type}
+    if msg_type == 'send_game_state':
+        fields = STATE_HEAD.unpack_from(data, 1)
+        state = {'hand': _names(fields[4:]), 'up_card': CODE_NAMES[fields[3]],
+                 'is_my_turn': bool(fields[2]), 'player': fields[1], 'seq': fields[0]}
+        offset = 1 + STATE_HEAD.size
+        for idx in range(5):
+            state[f'pile{idx}'] = _unpack_pile(data, offset)
+            offset += PILE.size
+        return {'type': msg_type, 'game_state': state}
+    if msg_type == 'send_public_state':
+        seq, is_p1_turn, up_card = PUBLIC_HEAD.unpack_from(data, 1)
+        state = {'up_card': CODE_NAMES[up_card], 'is_p1_turn': bool(is_p1_turn), 'seq': seq}
+        offset = 1 + PUBLIC_HEAD.size
+        for idx in range(5):
+            state[f'pile{idx}'] = _unpack_pile(data, offset)
+            offset += PILE.size
+        return {'type': msg_type, 'game_state': state}
+    # send_game_update
+    seq, player, pile_idx, card, up_card, add_card, count = UPDATE_HEAD.unpack_from(data, 1)
+    pairs = struct.unpack_from(f'<{2 * count}b', data, 1 + UPDATE_HEAD.size)
+    update = {'seq': seq, 'player': player, 'pile_idx': pile_idx, 'card': CODE_NAMES[card],
+              'up_card': CODE_NAMES[up_card],
+              'verdict_updates': {str(pairs[i]): pairs[i + 1] for i in range(0, len(pairs), 2)}}
+    if add_card != NO_CARD:
+        update['add_card'] = CODE_NAMES[add_card]
+    return {'type': msg_type, 'update': update}
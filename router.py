@@ -0,0 +1,191 @@
+"""
+Sharded mode: N server_main worker processes behind one public port.
+
+Each shard is a full server_main listening on a private localhost port and
+owns the games whose ids it hands out (see server_main.configure_shard). The
+router accepts every client, answers `connect` itself with a globally unique
+player id and token, and passes every later request on to the shard it
+belongs to: anything naming a game_id (join_game, action, resync, spectate,
+unspectate) to the shard that owns the game, quick_match and cancel_match to
+MATCH_SHARD, whose queue pairs every matchmade game, and new_game or bot_game
+to the next shard in turn. A client gets its own connection to each shard it
+uses, opened on its first request there, and whatever a shard sends back is
+piped to the client unparsed. A reconnect (connect with a token) must name
+its game_id and goes to that game's shard, which checks the token.
+
+usage: python server_main.py --host 0.0.0.0 --port 8000 --shards 4
+"""
+import asyncio
+import itertools
+import json
+import multiprocessing
+import secrets
+import signal
+import struct
+import websockets
+import websockets.exceptions
+import protocol
+import server_main
+import snapshot
+
+
+MATCH_SHARD = 0
+
+
+def shard_of(game_id, shard_count):
+    return (game_id - 10000) % shard_count
+
+
+def shard_port(port, shard_index):
+    return port + 1 + shard_index
+
+
+class Router:
+
+    def __init__(self, port, shard_count, key, first_player_id=10000):
+        self.shard_ports = [shard_port(port, i) for i in range(shard_count)]
+        # proves to the shards that a connect introducing a player comes from here
+        self.key = key
+        self.player_ids = itertools.count(first_player_id)
+        self.next_shard = itertools.cycle(range(shard_count))
+
+    def route(self, req):
+        """
+        returns the shard a request goes to
+        """
+        body = req.get('body') or {}
+        if isinstance(body, dict) and isinstance(body.get('game_id'), int):
+            return shard_of(body['game_id'], len(self.shard_ports))
+        if req.get('type') in ('quick_match', 'cancel_match'):
+            return MATCH_SHARD
+        return next(self.next_shard)
+
+    async def handler(self, websocket, path=None):
+        player_id = None
+        connect_body = {}
+        token = None
+        # shard -> this client's connection to it, each with a pump task
+        # piping what the shard sends back to the client
+        backends = {}
+        pumps = []
+        try:
+            async for message in websocket:
+                try:
+                    req = protocol.decode(message) if isinstance(message, bytes) else protocol.json_loads(message)
+                except (ValueError, KeyError, IndexError, struct.error):
+                    req = {}
+                if not isinstance(req, dict):
+                    req = {}
+                body = req.get('body') or {}
+                if not isinstance(body, dict):
+                    body = {}
+                if req.get('type') == 'connect':
+                    if backends:
+                        await websocket.send(json.dumps({'type': 'err', 'message': 'Already connected'}))
+                        continue
+                    connect_body = {'protocol': 'binary'} if isinstance(message, bytes) or body.get('protocol') == 'binary' else {}
+                    if 'token' not in body:
+                        player_id = next(self.player_ids)
+                        token = secrets.token_hex(8)
+                        encode = protocol.encode if connect_body else protocol.json_dumps
+                        await websocket.send(encode({'type': 'ack_connect', 'player_id': player_id, 'token': token}))
+                        continue
+                    if not isinstance(body.get('game_id'), int):
+                        await websocket.send(json.dumps({'type': 'err', 'message': 'Failed to reconnect: game_id required'}))
+                        continue
+                    # the owning shard checks the token and answers the client itself
+                    shard = self.route(req)
+                    backend = await self.connect_shard(shard)
+                    await backend.send(message)
+                    reply = await backend.recv()
+                    await websocket.send(reply)
+                    ack = protocol.decode(reply) if isinstance(reply, bytes) else protocol.json_loads(reply)
+                    if ack['type'] != 'ack_connect':
+                        await backend.close()
+                        continue
+                    player_id = ack['player_id']
+                    token = ack['token']
+                    backends[shard] = backend
+                    pumps.append(asyncio.create_task(self.pump(backend, websocket)))
+                    continue
+                if player_id is None:
+                    await websocket.send(json.dumps({'type': 'err', 'message': 'Connect first'}))
+                    continue
+
+                shard = self.route(req)
+                backend = backends.get(shard)
+                if backend is None:
+                    backend = await self.connect_shard(shard)
+                    await backend.send(json.dumps({'type': 'connect', 'body': dict(
+                        connect_body, player_id=player_id, token=token, router_key=self.key)}))
+                    # the client already has its ack_connect from us, unless the shard refuses the id
+                    reply = await backend.recv()
+                    if (protocol.decode(reply) if isinstance(reply, bytes) else protocol.json_loads(reply))['type'] == 'err':
+                        await websocket.send(reply)
+                        await backend.close()
+                        continue
+                    backends[shard] = backend
+                    pumps.append(asyncio.create_task(self.pump(backend, websocket)))
+                await backend.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for backend in backends.values():
+                await backend.close()
+            for pump in pumps:
+                pump.cancel()
+
+    def connect_shard(self, shard):
+        return websockets.connect(f'ws://127.0.0.1:{self.shard_ports[shard]}')
+
+    async def pump(self, backend, websocket):
+        try:
+            async for message in backend:
+                await websocket.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            await websocket.close()
+
+
+def first_player_id(snapshot_path, shard_count):
+    """
+    returns the id to start handing out players from: past every player restored
+    from the shards' snapshots, whose tokens those ids would otherwise collide with
+    """
+    restored = [snapshot.highest_player_id(f'{snapshot_path}.{shard_index}', ignore={server_main.BOT_PLAYER_ID})
+                for shard_index in range(shard_count)] if snapshot_path else []
+    return max([10000] + [player_id + 1 for player_id in restored])
+
+
+async def start_router(host, port, shard_count, key, snapshot_path=None):
+    router = Router(port, shard_count, key, first_player_id(snapshot_path, shard_count))
+    return await websockets.serve(router.handler, host, port)
+
+
+def run(host, port, shard_count, move_log_path=None, snapshot_path=None, metrics_port=None, cache_entries=0,
+        move_executor_kind=None, move_workers=server_main.MOVE_WORKERS):
+    key = secrets.token_hex(16)
+    # not daemonic, so a shard may start a process pool to judge moves; the
+    # finally below terminates them instead
+    shards = [multiprocessing.Process(target=server_main.run_shard,
+                                      args=(shard_index, shard_count, shard_port(port, shard_index), key, move_log_path,
+                                            snapshot_path, metrics_port, cache_entries, move_executor_kind,
+                                            move_workers))
+              for shard_index in range(shard_count)]
+    for shard in shards:
+        shard.start()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # stop cleanly on SIGTERM too, so the shards are not left running
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_until_complete(start_router(host, port, shard_count, key, snapshot_path))
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for shard in shards:
+            shard.terminate()
+        for shard in shards:
+            shard.join()
@@ -0,0 +1,131 @@
+"""
+The fields every request type carries in its body, checked by validators
+compiled once at import rather than by a chain of key lookups per request.
+
+validate(req) checks a decoded request and coerces its body in place (a
+pile number sent as "3" becomes 3, a card name becomes its game_logic.Card),
+so request handlers read the body without checking anything again. It
+returns None for a good request, or the err reply to send back.
+
+    connect        [player_id token game_id from_seq protocol router_key]
+    new_game       player_id
+    join_game      player_id game_id
+    action         player_id game_id card pile take_upcard
+    resync         player_id game_id from_seq
+    quick_match    player_id
+    cancel_match   player_id
+    spectate       player_id game_id
+    unspectate     player_id game_id
+    bot_game       player_id
+"""
+import game_logic
+
+
+# ids and sequence numbers go out as unsigned 32 bit fields (see protocol.py)
+MAX_INTEGER = 2 ** 32 - 1
+
+
+def integer(value):
+    # True is an int to Python, but not an id
+    if type(value) is not int or not 0 <= value <= MAX_INTEGER:
+        raise ValueError
+    return value
+
+
+def number(value):
+    """
+    an int, or a string of one, as int() has always accepted for these fields
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError
+    value = int(value)
+    if not 0 <= value <= MAX_INTEGER:
+        raise ValueError
+    return value
+
+
+def text(value):
+    if not isinstance(value, str):
+        raise ValueError
+    return value
+
+
+def flag(value):
+    if not isinstance(value, int):
+        raise ValueError
+    return bool(value)
+
+
+def card(value):
+    parsed = game_logic.parse_card(value) if isinstance(value, str) else None
+    if parsed is None:
+        raise ValueError
+    return parsed
+
+
+# request type -> (required fields, optional fields), each field name -> coercion
+REQUESTS = {
+    'connect': ({}, {'player_id': integer, 'token': text, 'game_id': integer, 'from_seq': number, 'protocol': text,
+                     'router_key': text}),
+    'new_game': ({'player_id': integer}, {}),
+    'join_game': ({'player_id': integer, 'game_id': integer}, {}),
+    'action': ({'player_id': integer, 'game_id': integer, 'card': card, 'pile': number, 'take_upcard': flag}, {}),
+    'resync': ({'player_id': integer, 'game_id': integer, 'from_seq': number}, {}),
+    'quick_match': ({'player_id': integer}, {}),
+    'cancel_match': ({'player_id': integer}, {}),
+    'spectate': ({'player_id': integer, 'game_id': integer}, {}),
+    'unspectate': ({'player_id': integer, 'game_id': integer}, {}),
+    'bot_game': ({'player_id': integer}, {}),
+}
+# only connect may leave its body out
+OPTIONAL_BODY = {'connect'}
+
+
+def compile_validator(req_type, required, optional):
+    """
+    returns a function that checks and coerces a body in place, returning
+    None or the err reply
+    """
+    err_type = 'err' if req_type == 'connect' else f'err_{req_type}'
+    required = tuple(required.items())
+    optional = tuple(optional.items())
+
+    def validate_body(body):
+        for name, coerce in required:
+            if name not in body:
+                return {'type': err_type, 'message': 'insufficient fields'}
+            try:
+                body[name] = coerce(body[name])
+            except ValueError:
+                return {'type': err_type, 'message': f'bad field: {name}'}
+        for name, coerce in optional:
+            if name in body:
+                try:
+                    body[name] = coerce(body[name])
+                except ValueError:
+                    return {'type': err_type, 'message': f'bad field: {name}'}
+        return None
+
+    return validate_body
+
+
+VALIDATORS = {req_type: compile_validator(req_type, *fields) for req_type, fields in REQUESTS.items()}
+
+
+def validate(req):
+    """
+    returns None if req is a well formed request, else the err reply; fills in
+    an empty body where one may be left out
+    """
+    if not isinstance(req, dict) or not isinstance(req.get('type'), str):
+        return {'type': 'err', 'message': 'Malformed json: missing type'}
+    validate_body = VALIDATORS.get(req['type'])
+    if validate_body is None:
+        return {'type': 'err', 'message': 'Unknown request type'}
+    if 'body' not in req:
+        if req['type'] not in OPTIONAL_BODY:
+            return {'type': 'err', 'message': 'Malformed json: missing body'}
+        req['body'] = {}
+    if not isinstance(req['body'], dict):
+        return {'type': 'err', 'message': 'Malformed json: body is not an object'}
+    return validate_body(req['body'])
@@ -1,20 +1,46 @@
 import logging
 import asyncio
 import websockets
-import json
+import websockets.exceptions
+import argparse
+import gc
+import os
+import pickle
+import random
+import secrets
+import signal
+import struct
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import bot
+import connection
 import game_logic
-import utils
+import logs
+import metrics
+import movelog
+import protocol
+import schema
+import snapshot
+import solver
+from connection import Connection
 
-def parse_card(card_string):
-    assert len(card_string) == 2
-    assert card_string[0] in utils.RANKS_MAP.keys()
-    assert card_string[1] in utils.ALL_SUITS
-    return game_logic.Card(utils.RANKS_MAP[card_string[0]], card_string[1])
+request_log = logs.get('server.request')
+ack_log = logs.get('server.ack')
+state_log = logs.get('server.state')
+client_log = logs.get('server.client')
 
 global next_player_id
 global next_game_id
 next_game_id = 10000
 next_player_id = 10000
+# in sharded mode shard i of n hands out game ids i, i + n, i + 2n... past
+# the first id, so ids never collide and router.shard_of can find the owner
+GAME_ID_STEP = 1
+# shards sit behind the router, which assigns every player id itself and
+# introduces each player to a shard with a connect carrying this key; set by
+# configure_shard
+ROUTER_KEY = None
 
 def get_player_id():
     global next_player_id
@@ -25,11 +51,99 @@ def get_player_id():
 def get_game_id():
     global next_game_id
     old_id = next_game_id
-    next_game_id+=1
+    next_game_id+=GAME_ID_STEP
     return old_id
 
+def configure_shard(shard_index, shard_count, router_key):
+    global next_game_id, GAME_ID_STEP, ROUTER_KEY
+    next_game_id = 10000 + shard_index
+    GAME_ID_STEP = shard_count
+    ROUTER_KEY = router_key
+
+# set above 0 to share a best completion cache of that many entries between
+# every game on this server; it pays off when positions repeat (bots, late games)
+COMPLETION_CACHE_ENTRIES = 0
+completion_cache = solver.CompletionCache(COMPLETION_CACHE_ENTRIES) if COMPLETION_CACHE_ENTRIES > 0 else None
+
+def configure_completion_cache(entries):
+    """
+    replaces the shared completion cache with an empty one of that many
+    entries, or none for 0, in every game
+    """
+    global COMPLETION_CACHE_ENTRIES, completion_cache
+    COMPLETION_CACHE_ENTRIES = entries
+    completion_cache = solver.CompletionCache(entries) if entries > 0 else None
+    for game in games.values():
+        if game.game_state is not None:
+            game.game_state.cache = completion_cache
+
+# Moves can be judged in a worker pool so the event loop keeps serving other
+# games meanwhile. MOVE_EXECUTOR is 'thread', 'process' or None (judge moves
+# inline on the event loop); see configure_move_executor. Judging is pure
+# Python, so threads only take turns on the GIL and come out slower than
+# inline; 'process' is the one that spreads moves over cores (bench.py
+# move_scaling). Either way a pool judges a copy of the state and the new one
+# is swapped in, so the loop never reads a state that is half way through a move.
+MOVE_EXECUTOR = None
+MOVE_WORKERS = 4
+move_executor = None
+
+# updates each game keeps for clients that ask to resync; anyone further
+# behind than this gets a full snapshot instead
+UPDATE_HISTORY = 64
+
+# set to a path to append every finished game to a move log file there
+# (see movelog.py); configure_move_log opens it
+MOVE_LOG_PATH = None
+move_log_file = None
+
+# set to a path to keep a memory-mapped snapshot of every game there, rewritten
+# every SNAPSHOT_INTERVAL seconds and on SIGUSR1; configure_snapshots restores
+# from it at startup
+SNAPSHOT_PATH = None
+SNAPSHOT_INTERVAL = 5.0
+snapshot_store = None
+
+# the sweeper runs every SWEEP_INTERVAL seconds and removes games that ended
+# more than FINISHED_RETENTION seconds ago (so players can still resync for a
+# while), games nobody has moved in for IDLE_GAME_TIMEOUT, and players gone
+# for PLAYER_TIMEOUT who have no game left; removed games go to the move log
+SWEEP_INTERVAL = 10.0
+FINISHED_RETENTION = 60.0
+IDLE_GAME_TIMEOUT = 1800.0
+PLAYER_TIMEOUT = 600.0
+SWEEP_CHUNK = 1024
+removed_counts = {'games': 0, 'players': 0}
+
+# set to a port to serve Prometheus metrics on (see metrics.py), local only
+# by default; configure_metrics turns the instrumentation on
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+server_metrics = None
+
+# the seconds a bot may think per move, and the p2 id every bot plays under
+BOT_BUDGET = bot.BUDGET
+BOT_PLAYER_ID = 0xFFFFFFFF
+# game id -> the bot.Bot playing p2 in it
+bots = {}
+# bots searching at once; the rest wait their turn, so other clients never
+# wait on more than a few search slices (bot.SLICE) in a row
+BOT_THINKERS = 1
+bot_thinkers = asyncio.Semaphore(BOT_THINKERS)
+
 games = {}
 players = set()
+# player id -> the token that lets a dropped player reattach
+player_tokens = {}
+# player id -> ids of the games they are in
+player_games = {}
+# player id -> when their last connection closed
+disconnected_at = {}
+# players waiting for a quick_match opponent, longest waiting first; an
+# ordered dict so pairing pops the head and cancelling drops any entry in O(1)
+match_queue = OrderedDict()
+# connection -> ids of the games it is spectating
+spectating = {}
 connected_clients = set()
 id_to_client = {}
 client_to_id = {}
@@ -40,155 +154,780 @@ class Game:
         self.p1 = p1_id
         self.p2 = None
         self.game_state = None
+        self.log = None
+        # serializes moves: only one move per game is judged at a time
+        self.lock = asyncio.Lock()
+        # (p1 update, p2 update) for the most recent moves, oldest first
+        self.updates = deque(maxlen=UPDATE_HISTORY)
+        # connections watching the game read-only
+        self.spectators = set()
+        # time.monotonic() of the last move (or of creation), and of the end
+        self.last_active = time.monotonic()
+        self.ended_at = None
+        self.archived = False
 
     def connect(self, p2_id):
         self.p2 = p2_id
-        self.game_state = game_logic.GameState()
+        self.last_active = time.monotonic()
+        # the seed plus the move log is enough to rebuild the game
+        self.log = movelog.MoveLog(random.getrandbits(64))
+        self.game_state = game_logic.GameState(seed=self.log.seed, cache=completion_cache)
         self.state = 'connected'
 
 
-def handle_client_request(websocket, req):
-    req_json = json.loads(req)
-    print(req_json)
+def configure_move_log(path):
+    global MOVE_LOG_PATH, move_log_file
+    if move_log_file is not None:
+        move_log_file.close()
+    MOVE_LOG_PATH = path
+    move_log_file = open(path, 'ab') if path else None
+
+def configure_metrics(port):
+    global METRICS_PORT, server_metrics
+    METRICS_PORT = port
+    server_metrics = metrics.Metrics(metrics_gauges) if port else None
+
+def configure_snapshots(path):
+    """
+    opens the snapshot file at path and restores the games in it; returns how many
+    """
+    global SNAPSHOT_PATH, snapshot_store
+    SNAPSHOT_PATH = path
+    snapshot_store = snapshot.SnapshotStore(path) if path else None
+    if snapshot_store is None:
+        return 0
+    # restoring allocates millions of objects that all survive; keep the cyclic
+    # collector from rescanning them over and over meanwhile
+    gc.disable()
+    try:
+        return _restore_snapshot()
+    finally:
+        gc.enable()
+
+def _restore_snapshot():
+    global next_game_id, next_player_id
+    saved_game_id, saved_player_id, saved_games = snapshot_store.load(completion_cache)
+    next_game_id = max(next_game_id, saved_game_id)
+    next_player_id = max(next_player_id, saved_player_id)
+    now = time.monotonic()
+    finished = {}
+    if MOVE_LOG_PATH and os.path.exists(MOVE_LOG_PATH):
+        # games that ended after the snapshot are complete in the move log
+        saved_ids = {saved[0] for saved in saved_games}
+        with open(MOVE_LOG_PATH, 'rb') as f:
+            finished = {game_id: log for game_id, log, _, _ in movelog.read_records(f) if game_id in saved_ids}
+    for game_id, state, p1, p1_token, p2, p2_token, game_state, log in saved_games:
+        game = Game(p1)
+        game.state = state
+        game.p2 = p2
+        game.game_state = game_state
+        game.log = log
+        if game_id in finished and len(finished[game_id]) > len(log):
+            game.log = finished[game_id]
+            game.game_state = game.log.replay(cache=completion_cache)
+        if game.game_state is not None and (game.game_state.over or not game.game_state.legal_moves()):
+            game.ended_at = now
+        games[game_id] = game
+        if p2 == BOT_PLAYER_ID:
+            bots[game_id] = bot.Bot(is_p1=False, budget=BOT_BUDGET)
+        for player_id, token in ((p1, p1_token), (p2, p2_token)):
+            if player_id is not None and player_id != BOT_PLAYER_ID:
+                players.add(player_id)
+                player_tokens[player_id] = token
+                player_games.setdefault(player_id, set()).add(game_id)
+                # nobody is connected yet: players who do not come back are swept
+                disconnected_at[player_id] = now
+    return len(saved_games)
+
+async def snapshot_now():
+    """
+    writes every game changed since the last snapshot; returns how many were written
+    """
+    if snapshot_store is None:
+        return 0
+    return await snapshot_store.flush(games, player_tokens, next_game_id, next_player_id)
+
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        await snapshot_now()
+
+def archive_game(game_id):
+    """
+    appends a game's move log record to the log file, when one is configured
+    """
+    game = games[game_id]
+    if move_log_file is None or game.log is None or game.archived:
+        return
+    movelog.write_record(move_log_file, game_id, game.log, [pile.verdict for pile in game.game_state.piles],
+                         game.game_state.winner)
+    move_log_file.flush()
+    game.archived = True
+
+def remove_game(game_id):
+    """
+    drops a game from the server, archiving it first
+    """
+    archive_game(game_id)
+    game = games.pop(game_id)
+    bots.pop(game_id, None)
+    if snapshot_store is not None:
+        snapshot_store.drop(game_id)
+    for client in game.spectators:
+        game_ids = spectating.get(client)
+        if game_ids is not None:
+            game_ids.discard(game_id)
+            if not game_ids:
+                del spectating[client]
+    for player_id in (game.p1, game.p2):
+        game_ids = player_games.get(player_id)
+        if game_ids is not None:
+            game_ids.discard(game_id)
+            if not game_ids:
+                del player_games[player_id]
+
+def remove_player(player_id):
+    players.discard(player_id)
+    player_tokens.pop(player_id, None)
+    disconnected_at.pop(player_id, None)
+    client = id_to_client.pop(player_id, None)
+    if client is not None:
+        client_to_id.pop(client, None)
+
+def game_expired(game, now):
+    if game.ended_at is not None:
+        return now - game.ended_at >= FINISHED_RETENTION
+    return now - game.last_active >= IDLE_GAME_TIMEOUT
+
+async def sweep(now=None, chunk=SWEEP_CHUNK):
+    """
+    removes expired games, chunk per event loop iteration, then the players
+    gone for good; returns (games removed, players removed)
+    """
+    now = time.monotonic() if now is None else now
+    game_ids = list(games)
+    removed_games = 0
+    for start in range(0, len(game_ids), chunk):
+        for game_id in game_ids[start:start + chunk]:
+            game = games.get(game_id)
+            # a game with a move in flight is active by definition
+            if game is not None and not game.lock.locked() and game_expired(game, now):
+                remove_game(game_id)
+                removed_games += 1
+        await asyncio.sleep(0)
+    gone = [player_id for player_id, since in disconnected_at.items()
+            if now - since >= PLAYER_TIMEOUT and player_id not in player_games]
+    for player_id in gone:
+        remove_player(player_id)
+    removed_counts['games'] += removed_games
+    removed_counts['players'] += len(gone)
+    return removed_games, len(gone)
+
+async def sweep_loop():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        await sweep()
+
+def lifecycle_stats():
+    """
+    returns gauges of the games, players and connections the server holds,
+    plus how many of each the sweeper has removed so far and how the
+    completion cache is doing
+    """
+    stats = {
+        'games': len(games),
+        'games_waiting': sum(1 for game in games.values() if game.state == 'created'),
+        'games_finished': sum(1 for game in games.values() if game.ended_at is not None),
+        'players': len(players),
+        'players_disconnected': len(disconnected_at),
+        'tokens': len(player_tokens),
+        'clients': len(connected_clients),
+        'queued': len(match_queue),
+        'spectators': len(spectating),
+        'bots': len(bots),
+        'games_removed': removed_counts['games'],
+        'players_removed': removed_counts['players'],
+    }
+    if completion_cache is not None:
+        stats.update({f'completion_cache_{name}': value for name, value in completion_cache.stats().items()})
+    return stats
+
+
+async def play_move(game_id, card, pile_idx, take_upcard, is_p1):
+    """
+    judges a move and records it in the game's log; the caller holds the game's lock
+    """
+    game = games[game_id]
+    await run_move(game, card, pile_idx, take_upcard, is_p1)
+    game.log.append(card, pile_idx, take_upcard)
+    game.last_active = time.monotonic()
+    # a game also ends when the deck and up card run dry undecided
+    if game.game_state.over or not game.game_state.legal_moves():
+        game.ended_at = game.last_active
+        archive_game(game_id)
+
+def publish_move(game_id):
+    """
+    sends the last move of a game to its players and spectators
+    """
+    game = games[game_id]
+    game.updates.append((game.game_state.get_last_update_p1(), game.game_state.get_last_update_p2()))
+    send_to_game(
+        {
+            'type': 'send_game_update',
+            'update': game.game_state.get_last_update_p1()
+        },
+        {
+            'type': 'send_game_update',
+            'update': game.game_state.get_last_update_p2()
+        },
+        game_id
+    )
+    if game.spectators:
+        send_to_spectators(game, {'type': 'send_game_update', 'update': game.game_state.get_last_update_public()})
+
+async def bot_move(game_id):
+    """
+    has the bot in a game think within its budget and play when it is its
+    turn, then sends the move out like a player's
+    """
+    game = games.get(game_id)
+    player_bot = bots.get(game_id)
+    if game is None or player_bot is None:
+        return
+    async with game.lock:
+        state = game.game_state
+        if state.over or state.is_p1_turn != player_bot.is_p1 or not state.legal_moves():
+            return
+        async with bot_thinkers:
+            card, pile_idx, take_upcard = await player_bot.think(state)
+        await play_move(game_id, card, pile_idx, take_upcard, player_bot.is_p1)
+    if snapshot_store is not None:
+        snapshot_store.mark(game_id)
+    publish_move(game_id)
+
+def configure_move_executor(kind=MOVE_EXECUTOR, workers=MOVE_WORKERS, initializer=None):
+    global MOVE_EXECUTOR, move_executor
+    if move_executor is not None:
+        # waiting matters on the way out of a shard: left to exit on its own,
+        # multiprocessing tears the call queue down before the pool's workers
+        # are told to stop, and both hang waiting on each other
+        move_executor.shutdown(wait=True)
+    MOVE_EXECUTOR = kind
+    if kind == 'process':
+        move_executor = ProcessPoolExecutor(max_workers=workers, initializer=initializer)
+    elif kind == 'thread':
+        move_executor = ThreadPoolExecutor(max_workers=workers, initializer=initializer)
+    else:
+        move_executor = None
+
+def apply_move(game_state, card, pile_idx, take_upcard, is_p1):
+    """
+    runs a move in a worker process and hands the updated state back
+    """
+    game_state.player_act(card, pile_idx, take_upcard, is_p1)
+    return game_state
+
+def apply_move_to_copy(game_state, card, pile_idx, take_upcard, is_p1):
+    """
+    runs a move in a worker thread on a copy of game_state, which the event
+    loop goes on reading meanwhile, and hands the copy back
+    """
+    return apply_move(pickle.loads(pickle.dumps(game_state)), card, pile_idx, take_upcard, is_p1)
+
+async def run_move(game, card, pile_idx, take_upcard, is_p1):
+    """
+    judges a move off the event loop; the caller holds game.lock
+    """
+    if move_executor is None:
+        game.game_state.player_act(card, pile_idx, take_upcard, is_p1)
+        return
+    loop = asyncio.get_running_loop()
+    # the worker judges a copy (a process gets a pickled one anyway), so take
+    # its result as the new state
+    move = apply_move if MOVE_EXECUTOR == 'process' else apply_move_to_copy
+    game_state = await loop.run_in_executor(move_executor, move, game.game_state, card, pile_idx, take_upcard, is_p1)
+    game_state.cache = completion_cache
+    game.game_state = game_state
+
+def encode_for(client, message):
+    if client.protocol == 'binary':
+        return protocol.encode(message)
+    return protocol.json_dumps(message)
+
+def parse_request(req):
+    """
+    returns (request dict, None) for a frame, or (None, err reply) when it is
+    not a well formed request; binary frames carry the compact encoding, text
+    frames json
+    """
+    try:
+        req_json = protocol.decode(req) if isinstance(req, bytes) else protocol.json_loads(req)
+    except (ValueError, KeyError, IndexError, struct.error):
+        return None, {'type': 'err', 'message': 'Malformed request'}
+    return req_json, schema.validate(req_json)
+
+async def handle_client_request(client, req):
+    req_json, err = parse_request(req)
+    request_log.debug('%s', req_json)
+    if err is not None:
+        return err
+    req_type = req_json['type']
+    if req_type == 'connect':
+        if isinstance(req, bytes):
+            client.protocol = 'binary'
+    elif client_to_id.get(client) != req_json['body']['player_id']:
+        # a connection only ever acts as the player it connected as: ids are
+        # easy to guess, the tokens proving them are not
+        return {'type': 'err_' + req_type, 'message': 'Not connected as that player'}
+    return await REQUEST_HANDLERS[req_type](client, req_type, req_json['body'])
 
-    if 'type' not in req_json.keys():
-        return {'type': 'err', 'message': 'Malformed json: missing type'}
-    
-    if req_json['type'] != 'connect' and 'body' not in req_json.keys():
-        return {'type': 'err', 'message': 'Malformed json: missing body'}
+# Each handler takes (client, request type, body) with the body already
+# checked and coerced by schema.validate, and returns the ack or err reply.
+# Every request but connect comes from the player it names.
 
-    if req_json['type'] == 'connect':
+async def handle_connect(client, req_type, body):
+    if body.get('protocol') == 'binary':
+        client.protocol = 'binary'
+    reattached = False
+    if body.get('player_id') in player_tokens:
+        # a dropped player coming back takes over its id and games
+        id = body['player_id']
+        if body.get('token') != player_tokens[id]:
+            return {'type': 'err', 'message': 'Failed to reconnect: bad token'}
+        old_client = id_to_client.get(id)
+        if old_client is not None and old_client is not client:
+            old_client.close()
+        reattached = True
+    elif ROUTER_KEY is not None:
+        # a shard never makes up ids, and only takes new ones from the router:
+        # a client claiming one it has no token for is turned away
+        if body.get('router_key') != ROUTER_KEY or 'player_id' not in body or 'token' not in body:
+            return {'type': 'err', 'message': 'Failed to reconnect: unknown player'}
+        id = body['player_id']
+        player_tokens[id] = body['token']
+    else:
         id = get_player_id()
-        players.add(id)
-        id_to_client[id] = websocket
-        client_to_id[websocket] = id
-        return {'type': 'ack_connect', 'player_id': id}
-    elif req_json['type'] == 'new_game':
-        if 'player_id' not in req_json['body'].keys():
-            return {'type': 'err_new_game', 'message': 'insufficient fields'}
-        player_id = req_json['body']['player_id']
-        if player_id not in players:
-            return {'type': 'err_new_game', 'message': 'Failed to create game: user does not exist'}
-        game_id = get_game_id()
-        games[game_id] = Game(player_id)
+        player_tokens[id] = secrets.token_hex(8)
+    players.add(id)
+    disconnected_at.pop(id, None)
+    id_to_client[id] = client
+    client_to_id[client] = id
+    ack = {'type': 'ack_connect', 'player_id': id, 'token': player_tokens[id]}
+    if reattached:
+        ack['reattached'] = True
+        # only a game the player is in: anyone else's would hand over its hands
+        if 'from_seq' in body and body.get('game_id') in player_games.get(id, ()):
+            ack['game_id'] = body['game_id']
+            ack['from_seq'] = body['from_seq']
+    return ack
+
+async def handle_new_game(client, req_type, body):
+    player_id = body['player_id']
+    if player_id not in players:
+        return {'type': 'err_new_game', 'message': 'Failed to create game: user does not exist'}
+    game_id = get_game_id()
+    games[game_id] = Game(player_id)
+    player_games.setdefault(player_id, set()).add(game_id)
+    return {
+        'type': 'ack_new_game',
+        'player_id': player_id,
+        'game_id': game_id,
+    }
+
+async def handle_join_game(client, req_type, body):
+    game_id = body['game_id']
+    player_id = body['player_id']
+    if game_id not in games.keys():
+        return {'type': 'err_join_game', 'message': 'Failed to join game: game does not exist'}
+    if games[game_id].state != 'created':
+        return {'type': 'err_join_game', 'message': 'Failed to join game: game is already started'}
+    else:
+        games[game_id].connect(player_id)
+        player_games.setdefault(player_id, set()).add(game_id)
         return {
-            'type': 'ack_new_game',
+            'type': 'ack_join_game',
             'player_id': player_id,
-            'game_id': game_id,
+            'game_id': game_id
         }
-    elif req_json['type'] == 'join_game':
-        if 'player_id' not in req_json['body'].keys() or 'game_id' not in req_json['body'].keys():
-            return {'type': 'err_join_game', 'message': 'insufficient fields'}
-        game_id = req_json['body']['game_id']
-        player_id = req_json['body']['player_id']
-        if game_id not in games.keys():
-            return {'type': 'err_join_game', 'message': 'Failed to join game: game does not exist'}
-        if games[game_id].state != 'created':
-            return {'type': 'err_join_game', 'message': 'Failed to join game: game is already started'}
-        else:
-            games[game_id].connect(player_id)
-            return {
-                'type': 'ack_join_game',
-                'player_id': player_id,
-                'game_id': game_id
-            }
-    elif req_json['type'] == 'action':
-        player_id = req_json['body']['player_id']
-        game_id = req_json['body']['game_id']
-        card_string = req_json['body']['card']
-        pile_idx = int(req_json['body']['pile'])
-        take_upcard = req_json['body']['take_upcard']
-        if not all([a in req_json['body'].keys() for a in ['player_id', 'game_id', 'card', 'pile', 'take_upcard']]):
-            return {'type': 'err_action', 'message': 'insufficient fields'}
-
-        if game_id not in games.keys():
-            return {'type': 'err_action', 'message': 'Game does not exist'}
-        game = games[game_id]
-        if player_id != game.p1 and player_id != game.p2:
-            return {'type': 'err_action', 'message': 'Player is not in the game'}
-        is_p1 = player_id == game.p1
-        try: 
-            game.game_state.player_act(parse_card(card_string), pile_idx, take_upcard, is_p1)
-            return {
-                'type': "ack_action",
-                'player_id': player_id,
-                'game_id': game_id,
-            }
-        except game_logic.IllegalPlayError as e:
-            return {
-                'type': 'err_action',
-                'message': f'Illegal play. {e.message}'
-            }
-        
-async def broadcast_to_game(json_to_broadcast, game_id):
+
+async def handle_bot_game(client, req_type, body):
+    player_id = body['player_id']
+    if player_id not in players:
+        return {'type': 'err_bot_game', 'message': 'Failed to create game: user does not exist'}
+    game_id = get_game_id()
+    game = games[game_id] = Game(player_id)
+    game.connect(BOT_PLAYER_ID)
+    bots[game_id] = bot.Bot(is_p1=False, budget=BOT_BUDGET)
+    player_games.setdefault(player_id, set()).add(game_id)
+    return {
+        'type': 'ack_bot_game',
+        'player_id': player_id,
+        'game_id': game_id,
+    }
+
+async def handle_quick_match(client, req_type, body):
+    player_id = body['player_id']
+    if player_id not in players or player_id not in id_to_client:
+        return {'type': 'err_quick_match', 'message': 'Failed to match: user does not exist'}
+    if player_id in match_queue:
+        return {'type': 'err_quick_match', 'message': 'Failed to match: already queued'}
+    if not match_queue:
+        match_queue[player_id] = None
+        return {'type': 'ack_quick_match', 'player_id': player_id, 'queued': True}
+    # the longest waiting player moves first
+    opponent, _ = match_queue.popitem(last=False)
+    game_id = get_game_id()
+    game = games[game_id] = Game(opponent)
+    game.connect(player_id)
+    for game_player in (opponent, player_id):
+        player_games.setdefault(game_player, set()).add(game_id)
+    return {
+        'type': 'ack_quick_match',
+        'player_id': player_id,
+        'game_id': game_id,
+    }
+
+async def handle_cancel_match(client, req_type, body):
+    player_id = body['player_id']
+    if player_id not in match_queue:
+        return {'type': 'err_cancel_match', 'message': 'Failed to cancel: not queued'}
+    del match_queue[player_id]
+    return {'type': 'ack_cancel_match', 'player_id': player_id}
+
+async def handle_spectate(client, req_type, body):
+    # spectate and unspectate both
+    err_type = 'err_' + req_type
+    player_id = body['player_id']
+    game_id = body['game_id']
+    if player_id not in players:
+        return {'type': err_type, 'message': 'user does not exist'}
+    if game_id not in games.keys():
+        return {'type': err_type, 'message': 'Game does not exist'}
+    if req_type == 'spectate':
+        games[game_id].spectators.add(client)
+        spectating.setdefault(client, set()).add(game_id)
+    else:
+        games[game_id].spectators.discard(client)
+        game_ids = spectating.get(client)
+        if game_ids is not None:
+            game_ids.discard(game_id)
+            if not game_ids:
+                del spectating[client]
+    return {
+        'type': 'ack_' + req_type,
+        'player_id': player_id,
+        'game_id': game_id,
+    }
+
+async def handle_action(client, req_type, body):
+    player_id = body['player_id']
+    game_id = body['game_id']
+    if game_id not in games.keys():
+        return {'type': 'err_action', 'message': 'Game does not exist'}
     game = games[game_id]
-    p1_websocket = id_to_client[game.p1]
-    p2_websocket = id_to_client[game.p2]
-    await p1_websocket.send(json_to_broadcast)
-    await p2_websocket.send(json_to_broadcast)
+    # players only: nobody gets to move for a bot
+    if player_id not in players or (player_id != game.p1 and player_id != game.p2):
+        return {'type': 'err_action', 'message': 'Player is not in the game'}
+    if game.game_state is None:
+        return {'type': 'err_action', 'message': 'Game has not started'}
+    is_p1 = player_id == game.p1
+    try: 
+        async with game.lock:
+            await play_move(game_id, body['card'], body['pile'], body['take_upcard'], is_p1)
+        return {
+            'type': "ack_action",
+            'player_id': player_id,
+            'game_id': game_id,
+        }
+    except game_logic.IllegalPlayError as e:
+        return {
+            'type': 'err_action',
+            'message': f'Illegal play. {e.message}'
+        }
+
+async def handle_resync(client, req_type, body):
+    player_id = body['player_id']
+    game_id = body['game_id']
+    if game_id not in games.keys() or games[game_id].game_state is None:
+        return {'type': 'err_resync', 'message': 'Game does not exist or has not started'}
+    if player_id != games[game_id].p1 and player_id != games[game_id].p2:
+        return {'type': 'err_resync', 'message': 'Player is not in the game'}
+    return {
+        'type': 'ack_resync',
+        'player_id': player_id,
+        'game_id': game_id,
+        'from_seq': body['from_seq'],
+    }
+
+# request type -> handler; schema.REQUESTS lists the same types
+REQUEST_HANDLERS = {
+    'connect': handle_connect,
+    'new_game': handle_new_game,
+    'join_game': handle_join_game,
+    'action': handle_action,
+    'resync': handle_resync,
+    'quick_match': handle_quick_match,
+    'cancel_match': handle_cancel_match,
+    'spectate': handle_spectate,
+    'unspectate': handle_spectate,
+    'bot_game': handle_bot_game,
+}
+assert REQUEST_HANDLERS.keys() == schema.REQUESTS.keys()
 
-async def send_to_game(p1_json, p2_json, game_id):
+def broadcast_to_game(message, game_id):
+    send_to_game(message, message, game_id)
+
+def send_to_game(p1_message, p2_message, game_id):
+    # only queues: each client's writer task does the actual sending. A player
+    # who has dropped gets nothing and catches up when they reconnect
+    start = time.perf_counter()
     game = games[game_id]
-    p1_websocket = id_to_client[game.p1]
-    p2_websocket = id_to_client[game.p2]
-    await p1_websocket.send(p1_json)
-    await p2_websocket.send(p2_json)
-
-async def handle_after_ack(websocket, ack):
-    if ack['type'] == 'ack_join_game':
-        await broadcast_to_game(
-            json.dumps({
-                'type': 'game_start',
-            }), 
-            ack['game_id']
-        )
-        print('sending to p1')
-        print(games[ack['game_id']].game_state.p1_json())
-        print('sending to p2')
-        print(games[ack['game_id']].game_state.p2_json())
-        await send_to_game(
-            json.dumps({
-                'type': 'send_game_state',
-                'game_state': games[ack['game_id']].game_state.p1_json()
-            }), 
-            json.dumps({
-                'type': 'send_game_state',
-                'game_state': games[ack['game_id']].game_state.p2_json()
-            }), 
-            ack['game_id']
-        )
+    for player_id, message in ((game.p1, p1_message), (game.p2, p2_message)):
+        client = id_to_client.get(player_id)
+        if client is not None:
+            client.send(encode_for(client, message))
+    if server_metrics is not None:
+        server_metrics.send_to_game_seconds.observe(time.perf_counter() - start)
+
+def send_to_spectators(game, message):
+    """
+    queues a message for everyone watching a game, encoded once per protocol
+    rather than once per spectator
+    """
+    encoded = {}
+    for client in game.spectators:
+        data = encoded.get(client.protocol)
+        if data is None:
+            data = encoded[client.protocol] = encode_for(client, message)
+        client.send(data)
+
+def resync_snapshots(client):
+    """
+    returns fresh snapshots of every game the client plays or watches, sent in
+    place of a backlog the client could not keep up with
+    """
+    player_id = client_to_id.get(client)
+    messages = []
+    for game_id in sorted(player_games.get(player_id, ())):
+        game = games[game_id]
+        if game.game_state is not None:
+            game_state = game.game_state.p1_json() if player_id == game.p1 else game.game_state.p2_json()
+            messages.append(encode_for(client, {'type': 'send_game_state', 'game_state': game_state}))
+    for game_id in sorted(spectating.get(client, ())):
+        if game_id in games and games[game_id].game_state is not None:
+            messages.append(encode_for(client, {'type': 'send_public_state',
+                                                'game_state': games[game_id].game_state.public_json()}))
+    return messages or [encode_for(client, {'type': 'err', 'message': 'Dropped messages: client too slow'})]
+
+def resync_messages(game, player_id, from_seq):
+    """
+    returns the messages that bring a player who has applied every update up
+    to from_seq back in step: the missed updates while the game still holds
+    them, otherwise a full snapshot; none for anyone not playing in the game
+    """
+    if player_id != game.p1 and player_id != game.p2:
+        return []
+    is_p1 = player_id == game.p1
+    seq = game.game_state.seq
+    oldest = game.updates[0][0]['seq'] if game.updates else seq + 1
+    if oldest - 1 <= from_seq <= seq:
+        return [{'type': 'send_game_update', 'update': update[0] if is_p1 else update[1]}
+                for update in game.updates if update[0]['seq'] > from_seq]
+    game_state = game.game_state.p1_json() if is_p1 else game.game_state.p2_json()
+    return [{'type': 'send_game_state', 'game_state': game_state}]
+
+def connection_stats():
+    """
+    returns gauges of the send queues of every connected client, and how many
+    messages they have dropped or coalesced away so far
+    """
+    depths = [len(client.pending) for client in connected_clients]
+    return {
+        'send_queue_depth': sum(depths),
+        'send_queue_max_depth': max(depths, default=0),
+        'send_dropped_total': connection.totals['dropped'],
+        'send_coalesced_total': connection.totals['coalesced'],
+        'send_closed_slow_total': connection.totals['closed_slow'],
+    }
+
+def metrics_gauges():
+    return {**lifecycle_stats(), **connection_stats()}
+
+def start_game(game_id):
+    """
+    tells both players a game has started and sends each their view of it
+    """
+    broadcast_to_game(
+        {
+            'type': 'game_start',
+            'game_id': game_id,
+        },
+        game_id
+    )
+    if state_log.isEnabledFor(logging.DEBUG):
+        state_log.debug('sending to p1 %s', games[game_id].game_state.p1_json())
+        state_log.debug('sending to p2 %s', games[game_id].game_state.p2_json())
+    send_to_game(
+        {
+            'type': 'send_game_state',
+            'game_state': games[game_id].game_state.p1_json()
+        },
+        {
+            'type': 'send_game_state',
+            'game_state': games[game_id].game_state.p2_json()
+        },
+        game_id
+    )
+    if games[game_id].spectators:
+        send_to_spectators(games[game_id], {'type': 'send_public_state', 'game_state': games[game_id].game_state.public_json()})
+
+def handle_after_ack(client, ack):
+    if snapshot_store is not None and 'game_id' in ack and ack['type'] in (
+            'ack_new_game', 'ack_join_game', 'ack_action', 'ack_quick_match', 'ack_bot_game'):
+        snapshot_store.mark(ack['game_id'])
+
+    if ack['type'] == 'ack_connect' and ack.get('reattached'):
+        # bring the player back in step: the updates they missed when they say
+        # where they got to, otherwise a snapshot of every game still running
+        player_id = ack['player_id']
+        if ack.get('game_id') in games and games[ack['game_id']].game_state is not None:
+            messages = resync_messages(games[ack['game_id']], player_id, ack['from_seq'])
+        else:
+            player_game_list = [games[game_id] for game_id in sorted(player_games.get(player_id, ()))]
+            messages = [{'type': 'send_game_state',
+                         'game_state': game.game_state.p1_json() if player_id == game.p1 else game.game_state.p2_json()}
+                        for game in player_game_list
+                        if game.game_state is not None and not game.game_state.over]
+        for message in messages:
+            client.send(encode_for(client, message))
+
+    if ack['type'] in ('ack_join_game', 'ack_bot_game') or (ack['type'] == 'ack_quick_match' and 'game_id' in ack):
+        start_game(ack['game_id'])
 
     if ack['type'] == 'ack_action':
-        await send_to_game(
-            json.dumps({
-                'type': 'send_game_update',
-                'update': games[ack['game_id']].game_state.get_last_update_p1()
-            }), 
-            json.dumps({
-                'type': 'send_game_update',
-                'update': games[ack['game_id']].game_state.get_last_update_p2()
-            }), 
-            ack['game_id']
-        )
-
-async def handler(websocket, path):
-    connected_clients.add(websocket)
+        publish_move(ack['game_id'])
+        if ack['game_id'] in bots:
+            asyncio.ensure_future(bot_move(ack['game_id']))
+
+    if ack['type'] == 'ack_spectate' and games[ack['game_id']].game_state is not None:
+        client.send(encode_for(client, {'type': 'send_public_state',
+                                        'game_state': games[ack['game_id']].game_state.public_json()}))
+
+    if ack['type'] == 'ack_resync':
+        for message in resync_messages(games[ack['game_id']], ack['player_id'], ack['from_seq']):
+            client.send(encode_for(client, message))
+
+async def handler(websocket, path=None):
+    client = Connection(websocket, resync=resync_snapshots)
+    client.start()
+    connected_clients.add(client)
     try:
         while True:
             message = await websocket.recv()
             # try:
-            ack =  handle_client_request(websocket, message)
-            print(ack)
-            await websocket.send(json.dumps(ack))
-            await handle_after_ack(websocket, ack)
+            start = time.perf_counter()
+            ack = await handle_client_request(client, message)
+            acked = time.perf_counter()
+            ack_log.debug('%s', ack)
+            client.send(encode_for(client, ack), keep=True)
+            handle_after_ack(client, ack)
+            if server_metrics is not None:
+                server_metrics.observe_request(ack['type'], acked - start, time.perf_counter() - acked)
             # except Exception as e:
             #     print(e)
     except websockets.exceptions.ConnectionClosed:
-        print(f'Client {client_to_id.get(websocket, " that never connected ")} exited')
+        client_log.info('Client %s exited', client_to_id.get(client, ' that never connected '))
+    finally:
+        connected_clients.remove(client)
+        for game_id in spectating.pop(client, ()):
+            if game_id in games:
+                games[game_id].spectators.discard(client)
+        player_id = client_to_id.pop(client, None)
+        # a player who reattached elsewhere is still connected
+        if player_id is not None and id_to_client.get(player_id) is client:
+            del id_to_client[player_id]
+            match_queue.pop(player_id, None)
+            disconnected_at[player_id] = time.monotonic()
+        await client.stop()
+
+HOST = "172.16.11.15"
+PORT = 8000
+
+async def start_server(host=HOST, port=PORT):
+    if move_executor is None and MOVE_EXECUTOR is not None:
+        configure_move_executor()
+    if snapshot_store is not None:
+        asyncio.ensure_future(snapshot_loop())
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(snapshot_now()))
+    if SWEEP_INTERVAL:
+        asyncio.ensure_future(sweep_loop())
+    if server_metrics is not None:
+        await server_metrics.serve(METRICS_HOST, METRICS_PORT)
+    # restored bot games where the bot was about to move
+    for game_id in list(bots):
+        asyncio.ensure_future(bot_move(game_id))
+    return await websockets.serve(handler, host, port)
+
+def run_server(host=HOST, port=PORT):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # stop cleanly on SIGTERM too (the router stops its shards with it), so a
+    # move process pool is not left running
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_until_complete(start_server(host, port))
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
     finally:
-        connected_clients.remove(websocket)
+        configure_move_executor(None)
 
-start_server = websockets.serve(handler, "172.16.11.15", 8000)
+def run_shard(shard_index, shard_count, port, router_key, move_log_path=None, snapshot_path=None, metrics_port=None,
+              cache_entries=0, move_executor_kind=None, move_workers=MOVE_WORKERS):
+    # the writer thread does not survive the fork; the settings do
+    logs.configure()
+    configure_shard(shard_index, shard_count, router_key)
+    configure_completion_cache(cache_entries)
+    configure_move_executor(move_executor_kind, move_workers)
+    if metrics_port:
+        configure_metrics(metrics_port + shard_index)
+    if move_log_path:
+        configure_move_log(f'{move_log_path}.{shard_index}')
+    if snapshot_path:
+        configure_snapshots(f'{snapshot_path}.{shard_index}')
+    run_server('127.0.0.1', port)
 
-asyncio.get_event_loop().run_until_complete(start_server)
-asyncio.get_event_loop().run_forever()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--shards', type=int, default=1,
+                        help='worker processes, each owning a share of the games, behind a router on --port')
+    parser.add_argument('--move-log', help='append finished games to this move log file (one per shard)')
+    parser.add_argument('--snapshot', help='snapshot games to this file and restore from it at startup (one per shard)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this port (shard i on the port plus i)')
+    parser.add_argument('--cache-entries', type=int, default=COMPLETION_CACHE_ENTRIES,
+                        help='share a best completion cache of this many entries between games (per shard)')
+    parser.add_argument('--move-executor', choices=('inline', 'thread', 'process'), default=MOVE_EXECUTOR or 'inline',
+                        help='where moves are judged (see MOVE_EXECUTOR)')
+    parser.add_argument('--move-workers', type=int, default=MOVE_WORKERS,
+                        help='threads or processes judging moves (per shard)')
+    parser.add_argument('--log-level', default='INFO', help='level of every log category (see logs.py)')
+    parser.add_argument('--log', action='append', default=[], type=logs.parse_category, metavar='CATEGORY=LEVEL',
+                        help='level of one log category, e.g. server.request=DEBUG')
+    args = parser.parse_args()
+    logs.configure(args.log_level.upper(), dict(args.log))
+    move_executor_kind = None if args.move_executor == 'inline' else args.move_executor
+    if args.shards > 1:
+        import router
+        router.run(args.host, args.port, args.shards, args.move_log, args.snapshot, args.metrics_port,
+                   args.cache_entries, move_executor_kind, args.move_workers)
+    else:
+        configure_completion_cache(args.cache_entries)
+        configure_move_executor(move_executor_kind, args.move_workers)
+        configure_metrics(args.metrics_port)
+        configure_move_log(args.move_log)
+        configure_snapshots(args.snapshot)
+        run_server(args.host, args.port)
@@ -0,0 +1,173 @@
+"""
+Headless self-play of game_logic.GameState, for measuring throughput.
+
+usage: python simulate.py --games 1000 --p1 random --p2 greedy --workers 4
+
+Every game is seeded from --seed and its index, so a run is reproducible
+regardless of how the games are split across workers. --log writes every
+game to a move log file (see movelog.py) for offline replay.
+"""
+import argparse
+import io
+import json
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import game_logic
+import movelog
+import solver
+
+
+def random_policy(state, rng):
+    return rng.choice(state.legal_moves())
+
+
+def greedy_policy(state, rng):
+    """
+    plays the card and pile that leave our own side of that pile with the
+    strongest reachable hand; takes the up card when it is a ten or better
+    """
+    moves = state.legal_moves()
+    draws = {take_upcard for _, _, take_upcard in moves}
+    take_upcard = True if True in draws and (False not in draws or state.up_card.rank >= 10) else False
+    best_score = None
+    best_move = None
+    for card, pile_idx, take in moves:
+        if take != take_upcard:
+            continue
+        pile = state.piles[pile_idx]
+        pile_mask = (pile.p1_mask if state.is_p1_turn else pile.p2_mask) | card.bit
+        score, _ = solver.best_completion(pile_mask, state.pool_mask & ~card.bit)
+        if best_score is None or score > best_score:
+            best_score = score
+            best_move = (card, pile_idx, take)
+    return best_move
+
+
+POLICIES = {
+    'random': random_policy,
+    'greedy': greedy_policy,
+}
+
+
+def play_game(seed, game_idx, p1_policy, p2_policy, cache=None):
+    """
+    plays one game to the end, returns (final state, move log, per-move player_act latencies)
+    """
+    rng = random.Random(f'{seed}:{game_idx}')
+    # an integer deck seed, so the move log can rebuild the game
+    log = movelog.MoveLog(rng.getrandbits(64))
+    state = game_logic.GameState(seed=log.seed, cache=cache)
+    latencies = []
+    while not state.over:
+        if not state.legal_moves():
+            break
+        policy = p1_policy if state.is_p1_turn else p2_policy
+        card, pile_idx, take_upcard = policy(state, rng)
+        start = time.perf_counter()
+        state.player_act(card, pile_idx, take_upcard, state.is_p1_turn)
+        latencies.append(time.perf_counter() - start)
+        log.append(card, pile_idx, take_upcard)
+    return state, log, latencies
+
+
+def run_games(seed, game_indices, p1_name, p2_name, cache_entries=0, record=False):
+    """
+    plays the given games and returns their raw statistics
+    cache_entries > 0 shares a completion cache of that size between the games;
+    record keeps every game's move log record, keyed by game index, in stats['log']
+    """
+    cache = solver.CompletionCache(cache_entries) if cache_entries > 0 else None
+    stats = {'games': 0, 'moves': 0, 'outcomes': {1: 0, -1: 0, 0: 0}, 'latencies': [], 'log': b''}
+    records = io.BytesIO()
+    for game_idx in game_indices:
+        state, log, latencies = play_game(seed, game_idx, POLICIES[p1_name], POLICIES[p2_name], cache)
+        stats['games'] += 1
+        stats['moves'] += len(latencies)
+        stats['outcomes'][state.winner] += 1
+        stats['latencies'] += latencies
+        if record:
+            movelog.write_record(records, game_idx, log, [pile.verdict for pile in state.piles], state.winner)
+    stats['log'] = records.getvalue()
+    return stats
+
+
+def merge_stats(all_stats):
+    merged = {'games': 0, 'moves': 0, 'outcomes': {1: 0, -1: 0, 0: 0}, 'latencies': [], 'log': b''}
+    for stats in all_stats:
+        merged['games'] += stats['games']
+        merged['moves'] += stats['moves']
+        for winner, count in stats['outcomes'].items():
+            merged['outcomes'][winner] += count
+        merged['latencies'] += stats['latencies']
+        merged['log'] += stats['log']
+    return merged
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def simulate(games, p1_name='random', p2_name='random', seed=0, workers=1, cache_entries=0, log_path=None):
+    """
+    plays games games, across a process pool when workers > 1, and returns a summary dict
+    log_path, if given, receives every game's move log record
+    """
+    start = time.perf_counter()
+    record = log_path is not None
+    if workers > 1:
+        chunks = [range(i, games, workers) for i in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            stats = merge_stats(pool.map(run_games, [seed] * workers, chunks, [p1_name] * workers, [p2_name] * workers,
+                                         [cache_entries] * workers, [record] * workers))
+    else:
+        stats = run_games(seed, range(games), p1_name, p2_name, cache_entries, record)
+    elapsed = time.perf_counter() - start
+    if record:
+        with open(log_path, 'wb') as f:
+            f.write(stats['log'])
+
+    latencies = sorted(stats['latencies'])
+    return {
+        'games': stats['games'],
+        'moves': stats['moves'],
+        'workers': workers,
+        'seconds': elapsed,
+        'games_per_sec': stats['games'] / elapsed,
+        'moves_per_sec': stats['moves'] / elapsed,
+        'p1_wins': stats['outcomes'][1],
+        'p2_wins': stats['outcomes'][-1],
+        'undecided': stats['outcomes'][0],
+        'move_latency_us': {
+            'p50': percentile(latencies, 50) * 1e6,
+            'p90': percentile(latencies, 90) * 1e6,
+            'p99': percentile(latencies, 99) * 1e6,
+            'max': latencies[-1] * 1e6 if latencies else 0.0,
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--p1', choices=sorted(POLICIES), default='random')
+    parser.add_argument('--p2', choices=sorted(POLICIES), default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--cache', type=int, default=0, help='completion cache entries shared per worker')
+    parser.add_argument('--json', action='store_true', help='print the summary as json')
+    parser.add_argument('--log', help='write every game to this move log file')
+    args = parser.parse_args()
+
+    summary = simulate(args.games, args.p1, args.p2, args.seed, args.workers, args.cache, args.log)
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        latency = summary['move_latency_us']
+        print(f"{summary['games']} games, {summary['moves']} moves in {summary['seconds']:.2f}s on {summary['workers']} worker(s)")
+        print(f"{summary['games_per_sec']:,.1f} games/s, {summary['moves_per_sec']:,.0f} moves/s")
+        print(f"player_act latency: p50 {latency['p50']:.0f}us p90 {latency['p90']:.0f}us "
+              f"p99 {latency['p99']:.0f}us max {latency['max']:.0f}us")
+        print(f"p1 wins {summary['p1_wins']}, p2 wins {summary['p2_wins']}, undecided {summary['undecided']}")
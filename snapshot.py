@@ -0,0 +1,206 @@
+"""
+Snapshots of every game on the server in a memory-mapped file, so a restart
+can pick up where the last snapshot left off.
+
+The file is a header followed by fixed size slots, one per game:
+
+    header  magic:4s version:H next_game_id:I next_player_id:I slots:I
+    slot    game_id:I state:B p1:I p1_token:8s p2:I p2_token:8s
+            seed:Q count:H GameState.pack() moves:50H
+
+state is EMPTY for a free slot, else the Game state ('created' games have no
+GameState and a zero p2). A game keeps its slot for its whole life, so a
+snapshot only rewrites the games marked dirty since the last one, a chunk at
+a time between event loop iterations.
+"""
+import asyncio
+import mmap
+import os
+import struct
+import game_logic
+import movelog
+
+MAGIC = b'PKSN'
+VERSION = 1
+HEADER = struct.Struct('<4sHIII')
+HEADER_SIZE = 64
+GAME = struct.Struct('<IBI8sI8sQH')
+MAX_MOVES = 50
+SLOT_SIZE = 288
+assert GAME.size + game_logic.STATE_RECORD.size + 2 * MAX_MOVES <= SLOT_SIZE
+
+EMPTY = 0
+GAME_STATES = {'created': 1, 'connected': 2}
+STATE_NAMES = {code: name for name, code in GAME_STATES.items()}
+NO_TOKEN = bytes(8)
+CHUNK = 512
+
+
+def _token(tokens, player_id):
+    return bytes.fromhex(tokens[player_id]) if player_id in tokens else NO_TOKEN
+
+
+def pack_game(game_id, game, tokens):
+    """
+    returns the slot contents for a server_main.Game
+    """
+    p2 = game.p2 or 0
+    log = game.log if game.log is not None else movelog.MoveLog(0)
+    head = GAME.pack(game_id, GAME_STATES[game.state], game.p1, _token(tokens, game.p1),
+                     p2, _token(tokens, p2), log.seed, len(log))
+    state = game.game_state.pack() if game.game_state is not None else bytes(game_logic.STATE_RECORD.size)
+    return head + state + log.to_bytes()
+
+
+def unpack_game(slot, cache=None):
+    """
+    returns (game_id, state name, p1, p1 token, p2, p2 token, GameState or None, MoveLog or None)
+    for a slot, or None for an empty one
+    """
+    game_id, state, p1, p1_token, p2, p2_token, seed, count = GAME.unpack_from(slot)
+    if state == EMPTY:
+        return None
+    offset = GAME.size
+    game_state = log = None
+    if STATE_NAMES[state] == 'connected':
+        game_state = game_logic.GameState.unpack(slot[offset:offset + game_logic.STATE_RECORD.size], cache)
+        offset += game_logic.STATE_RECORD.size
+        log = movelog.MoveLog(seed, slot[offset:offset + 2 * count])
+    return (game_id, STATE_NAMES[state], p1, p1_token.hex(), p2 or None, p2_token.hex() if p2 else None,
+            game_state, log)
+
+
+def highest_player_id(path, ignore=()):
+    """
+    returns the highest player id with a game in the snapshot file at path,
+    leaving out the ids in ignore, or 0 when there is none
+    """
+    if not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE:
+        return 0
+    highest = 0
+    with open(path, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        while True:
+            slot = f.read(SLOT_SIZE)
+            if len(slot) < GAME.size:
+                return highest
+            _, state, p1, _, p2, _, _, _ = GAME.unpack_from(slot)
+            if state == EMPTY:
+                continue
+            for player_id in (p1, p2):
+                if player_id not in ignore:
+                    highest = max(highest, player_id)
+
+
+class SnapshotStore:
+    """
+    Opening an existing file adopts the games in it: they keep their slots,
+    and load() returns them.
+    """
+
+    def __init__(self, path, capacity=1024):
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if exists:
+            magic, version, _, _, capacity = HEADER.unpack(self.file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{path} is not a version {VERSION} snapshot')
+        self.capacity = 0
+        self.mm = None
+        # game id -> slot index; freed slots are reused lowest first
+        self.slots = {}
+        self.free = []
+        self.dirty = set()
+        self.writes = 0
+        # one flush at a time: a flush may grow (and so remap) the file
+        self.flushing = asyncio.Lock()
+        self._resize(capacity)
+        if exists:
+            for slot in range(capacity):
+                game_id, state = GAME.unpack_from(self.mm, HEADER_SIZE + slot * SLOT_SIZE)[:2]
+                if state != EMPTY:
+                    self.slots[game_id] = slot
+            taken = set(self.slots.values())
+            self.free = [slot for slot in self.free if slot not in taken]
+
+    def _resize(self, capacity):
+        if self.mm is not None:
+            self.mm.close()
+        self.file.truncate(HEADER_SIZE + capacity * SLOT_SIZE)
+        self.mm = mmap.mmap(self.file.fileno(), HEADER_SIZE + capacity * SLOT_SIZE)
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def load(self, cache=None):
+        """
+        returns (next_game_id, next_player_id, games) where games lists the
+        unpack_game tuples of every game in the file
+        """
+        _, _, next_game_id, next_player_id, _ = HEADER.unpack_from(self.mm)
+        games = []
+        for slot in sorted(self.slots.values()):
+            offset = HEADER_SIZE + slot * SLOT_SIZE
+            games.append(unpack_game(self.mm[offset:offset + SLOT_SIZE], cache))
+        return next_game_id, next_player_id, games
+
+    def mark(self, game_id):
+        self.dirty.add(game_id)
+
+    def _slot(self, game_id):
+        slot = self.slots.get(game_id)
+        if slot is None:
+            if not self.free:
+                self._resize(self.capacity * 2)
+            slot = self.slots[game_id] = self.free.pop()
+        return slot
+
+    def write(self, game_id, game, tokens):
+        offset = HEADER_SIZE + self._slot(game_id) * SLOT_SIZE
+        record = pack_game(game_id, game, tokens)
+        self.mm[offset:offset + len(record)] = record
+        self.writes += 1
+
+    def drop(self, game_id):
+        """
+        frees a removed game's slot
+        """
+        self.dirty.discard(game_id)
+        slot = self.slots.pop(game_id, None)
+        if slot is not None:
+            offset = HEADER_SIZE + slot * SLOT_SIZE
+            self.mm[offset:offset + GAME.size] = bytes(GAME.size)
+            self.free.append(slot)
+
+    def write_header(self, next_game_id, next_player_id):
+        self.mm[:HEADER.size] = HEADER.pack(MAGIC, VERSION, next_game_id, next_player_id, self.capacity)
+
+    async def flush(self, games, tokens, next_game_id, next_player_id, chunk=CHUNK):
+        """
+        writes every dirty game, chunk games per event loop iteration, then
+        syncs the file from a worker thread; returns the number of games written
+        A game with a move in flight stays dirty for the next flush.
+        """
+        async with self.flushing:
+            pending = list(self.dirty)
+            self.dirty.clear()
+            written = 0
+            for start in range(0, len(pending), chunk):
+                for game_id in pending[start:start + chunk]:
+                    game = games.get(game_id)
+                    if game is None:
+                        continue
+                    if game.lock.locked():
+                        self.dirty.add(game_id)
+                        continue
+                    self.write(game_id, game, tokens)
+                    written += 1
+                await asyncio.sleep(0)
+            self.write_header(next_game_id, next_player_id)
+            await asyncio.get_running_loop().run_in_executor(None, self.mm.flush)
+            return written
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
@@ -0,0 +1,194 @@
+"""
+Exact best completion of a partial pile.
+
+Rather than enumerating every combination of pool cards, the solver walks the
+hand classes of evaluator strongest first and stops at the first one that can
+still be built from the pile plus the pool. Everything it skips is provably
+unreachable, so the first hit is the exact optimum, and the walk is bounded by
+the 7462 classes no matter how large the pool is.
+
+Piles and pools are card masks (see game_logic.Card.bit).
+"""
+import threading
+from collections import OrderedDict
+import evaluator
+
+RANK_BITS = 0x1FFF
+# the top bit of each of the 13 four bit rank-count fields
+GUARDS = int('1000' * 13, 2)
+
+
+def rank_counts(mask):
+    """
+    returns the number of cards of each rank in mask, packed 4 bits per rank
+    """
+    counts = 0
+    for suit in range(4):
+        ranks = (mask >> (13 * suit)) & RANK_BITS
+        while ranks:
+            low = ranks & -ranks
+            counts += 1 << (4 * (low.bit_length() - 1))
+            ranks ^= low
+    return counts
+
+
+def _pick_by_rank(pool_mask, need):
+    """
+    returns a mask of pool cards holding need[rank] cards of each rank
+    """
+    picked = 0
+    rank_idx = 0
+    while need:
+        count = need & 0xF
+        if count:
+            for suit in range(4):
+                bit = 1 << (13 * suit + rank_idx)
+                if pool_mask & bit:
+                    picked |= bit
+                    count -= 1
+                    if not count:
+                        break
+        need >>= 4
+        rank_idx += 1
+    return picked
+
+
+def best_completion(pile_mask, pool_mask):
+    """
+    returns (strength, hand_mask) for the strongest 5 card hand holding every
+    card of pile_mask plus cards from pool_mask
+    returns (-1, 0) if the pool cannot complete the pile
+    """
+    pool_mask &= ~pile_mask
+    size = pile_mask.bit_count()
+    if size == 5:
+        return evaluator.evaluate_mask(pile_mask), pile_mask
+    if size > 5 or size + pool_mask.bit_count() < 5:
+        return -1, 0
+    if size == 4:
+        # one card short: trying each pool card is cheaper than the class walk
+        best = -1
+        best_mask = 0
+        while pool_mask:
+            low = pool_mask & -pool_mask
+            strength = evaluator.evaluate_mask(pile_mask | low)
+            if strength > best:
+                best = strength
+                best_mask = pile_mask | low
+            pool_mask ^= low
+        return best, best_mask
+
+    # Unsuited classes: a class is reachable when, rank by rank, the pile has
+    # no more cards than the class and the pool covers the rest. The guard
+    # bits turn both checks into one subtraction over all 13 ranks.
+    pile_counts = rank_counts(pile_mask)
+    pool_counts = rank_counts(pool_mask)
+    best = -1
+    best_need = 0
+    for strength, counts in evaluator.UNSUITED_CLASSES:
+        if ((counts | GUARDS) - pile_counts) & GUARDS != GUARDS:
+            continue
+        need = counts - pile_counts
+        if ((pool_counts | GUARDS) - need) & GUARDS == GUARDS:
+            best = strength
+            best_need = need
+            break
+
+    # Flush classes only need checking above the best unsuited hand, and only
+    # in the suit the pile is already committed to.
+    pile_suits = [suit for suit in range(4) if (pile_mask >> (13 * suit)) & RANK_BITS]
+    if len(pile_suits) <= 1:
+        suits = pile_suits or range(4)
+        for strength, ranks in evaluator.FLUSH_CLASSES:
+            if strength <= best:
+                break
+            for suit in suits:
+                have = (pile_mask >> (13 * suit)) & RANK_BITS
+                if have & ~ranks:
+                    continue
+                missing = ranks & ~have
+                if missing & ~(pool_mask >> (13 * suit)) & RANK_BITS:
+                    continue
+                return strength, pile_mask | (missing << (13 * suit))
+
+    # An unsuited class picked here is never realised as a flush: if it only
+    # could be, that flush would have been reachable and returned above.
+    return best, pile_mask | _pick_by_rank(pool_mask, best_need)
+
+
+def canonical_suits(pile_mask, pool_mask):
+    """
+    returns the suits ordered so that suit-isomorphic (pile, pool) pairs line up
+    """
+    slices = [((pile_mask >> (13 * suit)) & RANK_BITS, (pool_mask >> (13 * suit)) & RANK_BITS, suit)
+              for suit in range(4)]
+    slices.sort(reverse=True)
+    return [suit for _, _, suit in slices]
+
+
+def permute_suits(mask, suits):
+    """
+    moves the ranks of suits[i] in mask to suit i
+    """
+    permuted = 0
+    for i, suit in enumerate(suits):
+        permuted |= ((mask >> (13 * suit)) & RANK_BITS) << (13 * i)
+    return permuted
+
+
+def unpermute_suits(mask, suits):
+    """
+    inverse of permute_suits
+    """
+    restored = 0
+    for i, suit in enumerate(suits):
+        restored |= ((mask >> (13 * i)) & RANK_BITS) << (13 * suit)
+    return restored
+
+
+class CompletionCache:
+    """
+    Bounded LRU cache in front of best_completion.
+
+    Entries are keyed on the suit-normalised (pile, pool) masks, so piles that
+    differ only by a relabelling of suits share one entry. Each entry costs
+    roughly 250 bytes, so max_entries=100000 caps the cache at about 25MB.
+    A single instance can be shared by every game in a process.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def best_completion(self, pile_mask, pool_mask):
+        pool_mask &= ~pile_mask
+        suits = canonical_suits(pile_mask, pool_mask)
+        key = (permute_suits(pile_mask, suits) << 52) | permute_suits(pool_mask, suits)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            entry = best_completion(key >> 52, key & ((1 << 52) - 1))
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = entry
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        strength, hand_mask = entry
+        return strength, unpermute_suits(hand_mask, suits)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
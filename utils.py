@@ -11,6 +11,7 @@ RANKS_MAP = {
     'J': 11, 'Q': 12, 'K': 13, 'A': 14
 }
 ALL_SUITS = ['S', 'H', 'D', 'C']
+SUIT_INDEX = {suit: idx for idx, suit in enumerate(ALL_SUITS)}
 
 HAND_STRENGTHS = ['STRAIGHT_FLUSH', 'QUADS', 'FULL_HOUSE', 'FLUSH', 'STRAIGHT', 'SET', 'TWO_PAIR', 'ONE_PAIR', 'HIGH_CARD']
 HAND_STRENGTHS = HAND_STRENGTHS[::-1]